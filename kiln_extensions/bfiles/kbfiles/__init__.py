@@ -27,6 +27,7 @@ import bfcommands
 reposetup = bfsetup.reposetup
 uisetup = bfsetup.uisetup
 
-commands.norepo += " kbfconvert"
+commands.norepo += " kbfconvert kbftransferd kbfunbundle"
+commands.optionalrepo += " kbffsck"
 
 cmdtable = bfcommands.cmdtable
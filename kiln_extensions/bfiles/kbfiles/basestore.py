@@ -3,7 +3,8 @@
 import os
 import tempfile
 import binascii
-import bfutil
+import threading
+import bfutil, bfledger
 
 from mercurial import util, node, error, url as url_, hg
 from mercurial.i18n import _
@@ -26,17 +27,58 @@ class StoreError(Exception):
         return "%s: %s" % (self.url, self.detail)
 
 class basestore(object):
+    # Whether the store is on another machine: only then is it worth
+    # keeping a ledger of what it has.
+    remote = False
+
     def __init__(self, ui, repo, url):
         self.ui = ui
         self.repo = repo
         self.url = url
+        self._ledger = None
+        # put() and exists() may run in worker threads, which must not
+        # touch ui: what they have to say waits for flush().
+        self._thread = threading.currentThread()
+        self._messages = []
+        self._messageslock = threading.Lock()
+
+    def _say(self, level, msg):
+        '''Pass msg to ui.<level>() (note or debug), now if we are in
+        the thread that opened the store, or else at the next flush().'''
+        if threading.currentThread() is self._thread:
+            getattr(self.ui, level)(msg)
+            return
+        self._messageslock.acquire()
+        try:
+            self._messages.append((level, msg))
+        finally:
+            self._messageslock.release()
+
+    def flush(self):
+        '''Show what worker threads had to say.  Call this from the
+        thread that opened the store.'''
+        self._messageslock.acquire()
+        try:
+            messages, self._messages = self._messages, []
+        finally:
+            self._messageslock.release()
+        for level, msg in messages:
+            getattr(self.ui, level)(msg)
+
+    def ledger(self):
+        '''Return the ledger of hashes known to be in this store.'''
+        if self._ledger is None:
+            self._ledger = bfledger.ledger(self.ui, self.url)
+        return self._ledger
 
     def put(self, source, hash):
-        '''Put source file into the store under <filename>/<hash>.'''
+        '''Put source file into the store under <filename>/<hash>.
+        May be called from worker threads: see _say().'''
         raise NotImplementedError('abstract method')
 
     def exists(self, hash):
-        '''Check to see if the store contains the given hash.'''
+        '''Check to see if the store contains the given hash.  May be
+        called from worker threads: see _say().'''
         raise NotImplementedError('abstract method')
 
     def get(self, files):
@@ -52,47 +94,117 @@ class basestore(object):
         missing = []
         ui = self.ui
 
-        at = 0
+        # Several big files often have the same contents: fetch, verify
+        # and cache each hash once, then put it everywhere it is needed.
+        byhash = {}
+        hashes = []
         for filename, hash in files:
-            ui.progress(_('Getting kbfiles'), at, unit='kbfile', total=len(files))
-            at += 1
-            ui.note(_('getting %s\n') % filename)
-            outfilename = self.repo.wjoin(filename)
-            destdir = os.path.dirname(outfilename)
-            util.makedirs(destdir)
-            if not os.path.isdir(destdir):
-                self.abort(error.RepoError(_('cannot create dest directory %s') % destdir))
-
-            # No need to pass mode='wb' to fdopen(), since mkstemp() already
-            # opened the file in binary mode.
-            (tmpfd, tmpfilename) = tempfile.mkstemp(
-                dir=destdir, prefix=os.path.basename(filename))
-            tmpfile = os.fdopen(tmpfd, 'w')
+            if hash not in byhash:
+                byhash[hash] = []
+                hashes.append(hash)
+            byhash[hash].append(filename)
 
-            try:
-                bhash = self._getfile(tmpfile, filename, hash)
-            except StoreError, err:
-                ui.warn(err.longmessage())
-                os.remove(tmpfilename)
-                missing.append(filename)
-                continue
+        # Progress is in bytes if the standins record sizes.
+        sizes = self._sizes(byhash)
+        if None in sizes.values():
+            unit, weights = _('bfile'), dict.fromkeys(hashes, 1)
+        else:
+            unit, weights = _('bytes'), sizes
+            ui.note(_('getting %d big files (%s)\n')
+                    % (len(hashes), util.bytecount(sum(sizes.values()))))
+        total = sum(weights.values())
 
-            hhash = binascii.hexlify(bhash)
-            if hhash != hash:
-                ui.warn(_('%s: data corruption (expected %s, got %s)\n')
-                        % (filename, hash, hhash))
-                os.remove(tmpfilename)
-                missing.append(filename)
-            else:
-                if os.path.exists(outfilename):          # for windows
-                    os.remove(outfilename)
-                os.rename(tmpfilename, outfilename)
-                bfutil.copy_to_cache(self.repo, self.repo['.'].node(), filename, True)
-                success.append((filename, hhash))
+        self._prefetch([hash for hash in hashes
+                        if not bfutil.in_system_cache(ui, hash)])
+
+        at = 0
+        hows = []
+        for hash in hashes:
+            ui.progress(_('Getting bfiles'), at, unit=unit, total=total)
+            at += weights[hash]
+            filenames = byhash[hash]
+            for filename in filenames:
+                ui.note(_('getting %s\n') % filename)
+
+            # Somebody else may have put it in the system cache meanwhile.
+            if not bfutil.in_system_cache(ui, hash) and not self._fetch(filenames[0], hash):
+                missing.extend(filenames)
+                continue
+            for filename in filenames:
+                hows.append(self._materialize(filename, hash))
+                success.append((filename, hash))
 
         ui.progress(_('Getting bfiles'), None)
+        bfutil.report_copies(ui, hows)
         return (success, missing)
 
+    def _sizes(self, byhash):
+        '''Return {hash: size} for the hashes in byhash ({hash: [filename,
+        ...]}), from the working copy standins of their files.  The size
+        is None where a standin does not record it.'''
+        sizes = {}
+        for hash, filenames in byhash.iteritems():
+            try:
+                (standinhash, size) = bfutil.read_standin_entry(
+                    self.repo, bfutil.standin(filenames[0]))
+            except IOError:
+                (standinhash, size) = (None, None)
+            if standinhash != hash:
+                size = None
+            sizes[hash] = size
+        return sizes
+
+    def _fetch(self, filename, hash):
+        '''Download hash (the contents of filename) into the system cache.
+        Return False, after telling the user why, if that fails.'''
+        ui = self.ui
+        # Download straight into the system cache, where other
+        # repositories on this machine can find the file too, and
+        # only then put it in the working copy.
+        cachefile = bfutil.system_cache_path(ui, hash)
+        cachedir = os.path.dirname(cachefile)
+        util.makedirs(cachedir)
+        if not os.path.isdir(cachedir):
+            self.abort(error.RepoError(_('cannot create cache directory %s') % cachedir))
+
+        # No need to pass mode='wb' to fdopen(), since mkstemp() already
+        # opened the file in binary mode.
+        (tmpfd, tmpfilename) = tempfile.mkstemp(dir=cachedir,
+                                                prefix='.tmp-' + hash)
+        tmpfile = os.fdopen(tmpfd, 'w')
+
+        try:
+            bhash = self._getfile(tmpfile, filename, hash)
+        except StoreError, err:
+            ui.warn(err.longmessage())
+            os.remove(tmpfilename)
+            return False
+
+        hhash = binascii.hexlify(bhash)
+        if hhash != hash:
+            ui.warn(_('%s: data corruption (expected %s, got %s)\n')
+                    % (filename, hash, hhash))
+            os.remove(tmpfilename)
+            return False
+        bfutil.put_in_system_cache(ui, hash, tmpfilename, move=True)
+        if self.remote:
+            self.ledger().add([hash])
+        return True
+
+    def _materialize(self, filename, hash):
+        '''Put hash, which is in the system cache (or an alternate), into
+        the repository cache and into the working copy as filename.  Return
+        how bfutil.materialize() made the working copy file.'''
+        cachefile = bfutil.find_system_file(self.ui, hash)
+        if not bfutil.in_cache(self.repo, hash):
+            bfutil.link_to_cache(self.repo, hash)
+        return bfutil.materialize(self.ui, cachefile, self.repo.wjoin(filename))
+
+    def _prefetch(self, hashes):
+        '''Try to get hashes into the system cache by some faster means
+        than get() downloading them one by one.  Optional.'''
+        pass
+
     def verify(self, revs, contents=False):
         '''Verify the existence (and, optionally, contents) of every big
         file revision referenced by every changeset in revs.
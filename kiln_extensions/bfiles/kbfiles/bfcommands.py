@@ -1,12 +1,17 @@
 '''High-level command functions: bfadd() et. al, plus the cmdtable.'''
 
 import os
+import time
 import shutil
+import tempfile
+import binascii
 
-from mercurial import util, match as match_, hg, node, context, error
+from mercurial import util, match as match_, hg, node, context, error, \
+        cmdutil
 from mercurial.i18n import _
 
-import bfutil, basestore
+import bfutil, basestore, bfindex, bfqueue
+import bundlefile, bfpack, bfscan
 
 # -- Commands ----------------------------------------------------------
 
@@ -100,9 +105,10 @@ def bfconvert(ui, src, dest, *pats, **opts):
                     pass
 
         else:
+            bfpaths = bfutil.resolver(rsrc).find(_revision_hashes(rsrc, None))
             for ctx in ctxs:
                 ui.progress(_('Converting revisions'), ctx.rev(), unit=_('revision'), total=rsrc['tip'].rev())
-                _addchangeset(ui, rsrc, rdst, ctx, revmap)
+                _addchangeset(ui, rsrc, rdst, ctx, revmap, bfpaths)
 
             ui.progress(_('Converting revisions'), None)
     except:
@@ -112,7 +118,239 @@ def bfconvert(ui, src, dest, *pats, **opts):
     finally:
         dst_lock.release()
 
-def _addchangeset(ui, rsrc, rdst, ctx, revmap):
+def bfrebuild(ui, repo):
+    '''rebuild the bfiles dirstate
+
+    Discard the state kbfiles keeps about big files in the working copy
+    and rebuild it by comparing every big file against its standin.
+    Big files are hashed in parallel (see [kilnbfiles] workers).  If a
+    rebuild is interrupted, running this command again resumes it.
+    '''
+    wlock = repo.wlock()
+    try:
+        dirstate = repo.join(os.path.join(bfutil.long_name, 'dirstate'))
+        if os.path.exists(dirstate):
+            os.unlink(dirstate)
+        bfutil.open_bfdirstate(ui, repo)
+    finally:
+        wlock.release()
+
+def bfwatch(ui, repo, **opts):
+    '''watch big files for changes (Linux only)
+
+    Start a daemon that uses inotify to keep track of which big files
+    might have changed.  While it runs, status only has to look at those
+    files instead of every big file in the working copy.  Status falls
+    back to checking every big file whenever the daemon is not running,
+    does not answer within [kilnbfiles] watchtimeout seconds (default:
+    2), or has lost track of events.
+    '''
+    import bfinotify
+    if opts.get('stop'):
+        bfinotify.stop(ui, repo)
+        return
+    w = bfinotify.watcher(ui, repo)
+    cmdutil.service(opts, initfn=w.start, runfn=w.run)
+
+def bfupload(ui, repo):
+    '''upload queued big files to the central store
+
+    With [kilnbfiles] uploadqueue enabled, commit queues the big files it
+    adds for upload and starts this command in the background.  Run it
+    by hand to retry uploads that failed (see .hg/kilnbfiles/upload.log).
+    '''
+    bfqueue.run(ui, repo)
+
+def bftransferd(ui, **opts):
+    '''run the big file transfer daemon
+
+    Start a daemon that downloads big files into the system cache for
+    every repository on this machine, so that concurrent updates needing
+    the same big file download it only once.  Clients find it through
+    the Unix socket [kilnbfiles] transfersocket (by default
+    .transfer.sock in the system cache) and download files themselves
+    when it is not running.
+    '''
+    import bftransfer
+    d = bftransfer.transferd(ui)
+    cmdutil.service(opts, initfn=d.start, runfn=d.run)
+
+def _revision_hashes(repo, revs):
+    '''Return the sorted hashes of the big files in revs (a list of
+    revision specifications), or in every revision if revs is empty.'''
+    index = bfindex.get(repo)
+    hashes = set()
+    if revs:
+        for rev in cmdutil.revrange(repo, revs):
+            hashes.update(index.hashes(rev).itervalues())
+    else:
+        for rev in repo:
+            hashes.update([h for h in index.changed(rev).itervalues() if h != '-'])
+    return sorted(hashes)
+
+def bfbundle(ui, repo, filename, **opts):
+    '''write big files to a bundle file
+
+    Write the big file revisions used by the given revisions (by
+    default, all revisions) to FILE, so that they can be carried to
+    another machine and added to its system cache with kbfunbundle.
+    Every big file revision must be in a local cache.
+    '''
+    hashes = _revision_hashes(repo, opts.get('rev'))
+    paths = bfutil.resolver(repo).find(hashes)
+    sources = []
+    for hash in hashes:
+        source = paths[hash]
+        if source is None:
+            raise util.Abort(_('big file %s is not in any local cache') % hash)
+        sources.append((hash, source))
+    bundlefile.write(ui, filename, sources)
+    ui.status(_('%d big files written to %s\n') % (len(sources), filename))
+
+def bfunbundle(ui, filename):
+    '''add the big files in a bundle file to the system cache
+
+    Big files already in the system cache are skipped; the others are
+    verified against their hashes as they are read.
+    '''
+    (added, skipped) = bundlefile.read(ui, filename)
+    ui.status(_('%d big files added, %d already present\n') % (added, skipped))
+
+def bfsync(ui, repo, src, dst, **opts):
+    '''copy big files from one store to another
+
+    Copy every big file revision referenced by the given revisions (by
+    default, all revisions of this repository) that DST does not have
+    from SRC to DST.  SRC and DST are paths or URLs, as for push and
+    pull.  Files are copied in parallel ([kilnbfiles] workers) and their
+    hashes are checked on the way; files that DST already has are
+    skipped, so an interrupted copy can simply be run again.
+    '''
+    hashes = _revision_hashes(repo, opts.get('rev'))
+    srcstore = basestore._open_store(repo, ui.expandpath(src))
+    dststore = basestore._open_store(repo, ui.expandpath(dst), put=True)
+    workers = bfutil.get_workers(ui)
+
+    ui.status(_('checking %d big files in %s\n') % (len(hashes), dst))
+    missing = []
+    at = 0
+    for hash, present in bfutil.threadmap(dststore.exists, hashes, workers):
+        dststore.flush()
+        ui.progress(_('Checking bfiles'), at, unit=_('bfile'), total=len(hashes))
+        at += 1
+        if not present:
+            missing.append(hash)
+    ui.progress(_('Checking bfiles'), None)
+    if not missing:
+        ui.status(_('no big files to copy\n'))
+        return 0
+
+    admin = repo.join(bfutil.long_name)
+    bfutil.create_dir(admin)
+    def copy(hash):
+        '''Copy hash from srcstore to dststore.  Return the number of
+        bytes copied, or an error message.'''
+        try:
+            return _copy(hash)
+        except util.Abort, err:
+            return str(err)
+    def _copy(hash):
+        source = bfutil.find_system_file(ui, hash) or bfutil.cache_path(repo, hash)
+        if os.path.exists(source) and not bfutil.is_compressed(source):
+            # Already here: no need to download it first.
+            if bfutil.hashfile(source) == hash:
+                dststore.put(source, hash)
+                return os.path.getsize(source)
+        (tmpfd, tmpfilename) = tempfile.mkstemp(dir=admin, prefix='sync-')
+        try:
+            try:
+                bhash = srcstore._getfile(os.fdopen(tmpfd, 'wb'), hash, hash)
+            except basestore.StoreError, err:
+                return err.detail
+            if binascii.hexlify(bhash) != hash:
+                return _('data corruption (got %s)') % binascii.hexlify(bhash)
+            dststore.put(tmpfilename, hash)
+            return os.path.getsize(tmpfilename)
+        finally:
+            os.unlink(tmpfilename)
+
+    ui.status(_('copying %d big files to %s\n') % (len(missing), dst))
+    start = time.time()
+    copied = 0
+    size = 0
+    failed = 0
+    at = 0
+    for hash, result in bfutil.threadmap(copy, missing, workers):
+        srcstore.flush()
+        dststore.flush()
+        ui.progress(_('Copying bfiles'), at, unit=_('bfile'), total=len(missing))
+        at += 1
+        if isinstance(result, str):
+            ui.warn(_('%s: %s\n') % (hash, result))
+            failed += 1
+        else:
+            copied += 1
+            size += result
+    ui.progress(_('Copying bfiles'), None)
+    elapsed = max(time.time() - start, 0.001)
+    ui.status(_('copied %d big files (%s) in %.1f seconds (%s/sec)\n')
+              % (copied, util.bytecount(size), elapsed, util.bytecount(size / elapsed)))
+    if failed:
+        ui.warn(_('%d big files could not be copied\n') % failed)
+        return 1
+    return 0
+
+def bffsck(ui, repo, **opts):
+    '''check the integrity of the local big file caches
+
+    Re-hash every big file revision in the system cache and, when run in
+    a repository, in its cache, loose or packed, with [kilnbfiles]
+    workers processes.  Damaged revisions are moved to the .quarantine
+    directory of their cache, so that they are downloaded again when
+    needed.  An interrupted check carries on where it stopped the next
+    time it is run, unless --restart is given.  [kilnbfiles] fsckrate
+    limits the reading rate in KB/s, for checks run from cron.
+
+    Returns 1 if damaged revisions were found, 0 otherwise.
+    '''
+    caches = []
+    if repo is not None and os.path.isdir(repo.join(bfutil.long_name)):
+        caches.append((repo.join(bfutil.long_name), False))
+    systemcache = os.path.dirname(bfutil.system_cache_path(ui, 'x'))
+    if os.path.isdir(systemcache):
+        caches.append((systemcache, True))
+    (checked, size, damaged) = bfscan.scan(ui, caches, opts.get('restart'))
+    ui.status(_('checked %d big files (%s), %d damaged\n')
+              % (checked, util.bytecount(size), damaged))
+    return damaged and 1 or 0
+
+def bfrepack(ui, repo, **opts):
+    '''pack small cached big files together
+
+    Move the big file revisions of at most --max-size bytes ([kilnbfiles]
+    packmaxsize, default 1 MB) in the repository cache and in the system
+    cache into one pack file per cache, merging any existing packs.
+    Packed revisions are found and read like loose ones; packing them
+    saves inodes and makes the caches much faster to walk and back up.
+    '''
+    maxsize = opts.get('max_size') or ui.config(bfutil.long_name, 'packmaxsize', None)
+    try:
+        maxsize = int(maxsize or 1024 * 1024)
+    except ValueError:
+        raise util.Abort(_('invalid pack size: %s') % maxsize)
+    caches = [(repo.join(bfutil.long_name), False),
+              (os.path.dirname(bfutil.system_cache_path(ui, 'x')), True)]
+    for cachedir, lock in caches:
+        if not os.path.isdir(cachedir):
+            continue
+        (objects, loose, packs) = bfpack.repack(ui, cachedir, maxsize, lock)
+        if objects:
+            ui.status(_('%s: packed %d big files (%d loose, %d packs removed)\n')
+                      % (cachedir, objects, loose, packs))
+        else:
+            ui.status(_('%s: nothing to pack\n') % cachedir)
+
+def _addchangeset(ui, rsrc, rdst, ctx, revmap, bfpaths):
  # Convert src parents to dst parents
     parents = []
     for p in ctx.parents():
@@ -148,12 +386,10 @@ def _addchangeset(ui, rsrc, rdst, ctx, revmap):
             if renamed:
                 renamed = bfutil.split_standin(renamed[0])
 
-            hash = fctx.data().strip()
-            path = bfutil.find_file(rsrc, hash)
+            hash = bfutil.standin_hash(fctx.data())
+            path = bfpaths.get(hash) or bfutil.find_file(rsrc, hash)
             ### TODO: What if the file is not cached?
-            data = ''
-            with open(path, 'rb') as fd:
-                data = fd.read()
+            data = ''.join(bfutil.cachedstream(path))
             return context.memfilectx(f, data, 'l' in fctx.flags(),
                                       'x' in fctx.flags(), renamed)
         else:
@@ -211,6 +447,7 @@ def _bfconvert_addchangeset(rsrc, rdst, ctx, revmap, bfiles, normalfiles, matche
             if mc[f] != mp1.get(f, None) or mc[f] != mp2.get(f, None):
                 files.add(f)
 
+    standinsizes = rdst.ui.configbool(bfutil.long_name, 'standinsizes', False)
     dstfiles = []
     for f in files:
         if f not in bfiles and f not in normalfiles:
@@ -250,7 +487,10 @@ def _bfconvert_addchangeset(rsrc, rdst, ctx, revmap, bfiles, normalfiles, matche
                         fd.write(ctx[f].data())
                     executable = 'x' in ctx[f].flags()
                     os.chmod(fullpath, bfutil.get_mode(executable))
-                    bfutil.write_standin(rdst, bfutil.standin(f), hash, executable)
+                    bfsize = None
+                    if standinsizes:
+                        bfsize = ctx[f].size()
+                    bfutil.write_standin(rdst, bfutil.standin(f), hash, executable, bfsize)
                     bfiletohash[f] = hash
         else:
             # normal file
@@ -271,7 +511,11 @@ def _bfconvert_addchangeset(rsrc, rdst, ctx, revmap, bfiles, normalfiles, matche
                 # doesn't change after rename or copy
                 renamed = bfutil.standin(renamed[0])
 
-            return context.memfilectx(f, bfiletohash[srcfname], 'l' in fctx.flags(),
+            # the same contents as the standin written above
+            data = bfiletohash[srcfname]
+            if standinsizes:
+                data = '%s %d\n' % (data, fctx.size())
+            return context.memfilectx(f, data, 'l' in fctx.flags(),
                                       'x' in fctx.flags(), renamed)
         else:
             try:
@@ -314,32 +558,93 @@ def _is_bfile(file, ctx, matcher, size):
     except error.LookupError:
         return False
 
-def upload_bfiles(ui, rsrc, rdst, files):
-    '''upload big files to the central store'''
+def upload_bfiles(ui, rsrc, rdst, files, sizes=None):
+    '''upload big files to the central store, or link them into the cache
+    of a local destination repository.  sizes maps hashes to
+    their sizes where the caller knows them already (as from
+    outgoing_bfiles()).'''
 
     if not files:
         return
 
-    # Don't upload locally. All bfiles are in the system wide cache
-    # so the other repo can just get them from there.
-    if not rdst.path.startswith('http'):
+    # Only HTTP stores take uploads.  A local destination's store is its
+    # repository cache (see localstore), which gets links to the bfiles
+    # it does not have yet.
+    if rdst.local():
+        store = basestore._open_store(rsrc, rdst.root, put=True)
+    elif rdst.path.startswith('http'):
+        store = basestore._open_store(rsrc, rdst.path, put=True)
+    else:
         return
-
-    store = basestore._open_store(rsrc, rdst.path, put=True)
+    if store.remote:
+        # Whatever the upload queue is already taking care of, we just wait for.
+        files = bfqueue.wait(ui, rsrc, rdst.path, files)
+        if not files:
+            return
+
+    paths = bfutil.resolver(rsrc).find(files)
+    known = sizes or {}
+    sizes = {}
+    for hash in files:
+        sizes[hash] = known.get(hash)
+        if sizes[hash] is None:
+            sizes[hash] = paths[hash] and bfutil.cached_object_size(paths[hash]) or 0
+    total = sum(sizes.values())
+    ui.note(_('uploading up to %d big files (%s)\n')
+            % (len(files), util.bytecount(total)))
 
     at = 0
     for hash in files:
-        ui.progress(_('Uploading bfiles'), at, unit='bfile', total=len(files))
-        if store.exists(hash):
-            at += 1
-            continue
-        source = bfutil.find_file(rsrc, hash)
-        if not source:
-            raise util.Abort(_('Missing bfile %s needs to be uploaded') % hash)
-        # XXX check for errors here
-        store.put(source, hash)
-        at += 1
-    ui.progress('Uploading bfiles', None)
+        ui.progress(_('Uploading bfiles'), at, unit=_('bytes'), total=total)
+        if not store.exists(hash) and (store.remote or paths[hash]):
+            if store.remote or bfutil.is_packed(paths[hash]):
+                source, temporary = bfutil.raw_file(rsrc, hash, paths[hash])
+            else:
+                # local stores link compressed objects as they are
+                source, temporary = paths[hash], False
+            if not source:
+                raise util.Abort(_('Missing bfile %s needs to be uploaded') % hash)
+            try:
+                # XXX check for errors here
+                store.put(source, hash)
+            finally:
+                if temporary:
+                    os.unlink(source)
+        at += sizes[hash]
+    ui.progress(_('Uploading bfiles'), None)
+
+# Results of outgoing_bfiles(), for the rest of this process.
+_outgoing_cache = {}
+
+def outgoing_bfiles(repo, remote, revs=None, force=False):
+    '''Return a sorted list of (bfile, hash, size) for every big file
+    revision added by the changesets that would be pushed to remote, or
+    None if there are no outgoing changesets.  size is the size in bytes
+    of that revision, or None if it is not in any local cache.
+
+    Big files are found from the per-changeset deltas in the standin
+    index, never by scanning manifests, and the answer is remembered
+    for as long as neither side gets new heads.'''
+    key = (repo.root, tuple(sorted(repo.heads())), tuple(sorted(remote.heads())),
+           tuple(revs or ()), force)
+    if key in _outgoing_cache:
+        return _outgoing_cache[key]
+
+    result = None
+    o = bfutil.findoutgoing(repo, remote, force)
+    if o:
+        index = bfindex.get(repo)
+        found = set()
+        for n in repo.changelog.nodesbetween(o, revs)[0]:
+            for bfile, hash in index.changed(n).iteritems():
+                if hash != '-':
+                    found.add((bfile, hash))
+        paths = bfutil.resolver(repo).find([hash for (bfile, hash) in found])
+        result = [(bfile, hash,
+                   paths[hash] and bfutil.cached_object_size(paths[hash]))
+                  for (bfile, hash) in sorted(found)]
+    _outgoing_cache[key] = result
+    return result
 
 def verify_bfiles(ui, repo, all=False, contents=False):
     '''Verify that every big file revision in the current changeset
@@ -364,7 +669,10 @@ def revert_bfiles(ui, repo):
         (unsure, modified, added, removed, missing, unknown, ignored, clean) = s
 
         bfiles = bfutil.list_bfiles(repo)
+        whashes = bfindex.hashes(repo)
+        phashes = bfindex.hashes(repo, repo['.'])
         toget = []
+        torestore = []
         at = 0
         updated = 0
         for bfile in bfiles:
@@ -374,33 +682,39 @@ def revert_bfiles(ui, repo):
             if os.path.exists(repo.wjoin(bfutil.standin(os.path.join(bfile + '.orig')))):
                 shutil.copyfile(repo.wjoin(bfile), repo.wjoin(bfile + '.orig'))
             at += 1
-            expectedhash = repo[None][bfutil.standin(bfile)].data().strip()
+            expectedhash = whashes.get(bfile)
             mode = os.stat(repo.wjoin(bfutil.standin(bfile))).st_mode
             if not os.path.exists(repo.wjoin(bfile)) or expectedhash != bfutil.hashfile(repo.wjoin(bfile)):
-                path = bfutil.find_file(repo, expectedhash)
-                if path is None:
-                    toget.append((bfile, expectedhash))
-                else:
-                    util.makedirs(os.path.dirname(repo.wjoin(bfile)))
-                    shutil.copy(path, repo.wjoin(bfile))
-                    os.chmod(repo.wjoin(bfile), mode)
-                    updated += 1
-                    if bfutil.standin(bfile) not in repo['.']:
-                        bfdirstate.add(bfutil.unixpath(bfile))
-                    elif expectedhash == repo['.'][bfutil.standin(bfile)].data().strip():
-                        bfdirstate.normal(bfutil.unixpath(bfile))
-                    else:
-                        bfutil.dirstate_normaldirty(bfdirstate, bfutil.unixpath(bfile))
+                torestore.append((bfile, expectedhash, mode))
             elif os.path.exists(repo.wjoin(bfile)) and mode != os.stat(repo.wjoin(bfile)).st_mode:
-                os.chmod(repo.wjoin(bfile), mode)
+                bfutil.set_mode(repo.wjoin(bfile), mode)
                 updated += 1
-                if bfutil.standin(bfile) not in repo['.']:
+                if bfile not in phashes:
                     bfdirstate.add(bfutil.unixpath(bfile))
-                elif expectedhash == repo['.'][bfutil.standin(bfile)].data().strip():
+                elif expectedhash == phashes[bfile]:
                     bfdirstate.normal(bfutil.unixpath(bfile))
                 else:
                     bfutil.dirstate_normaldirty(bfdirstate, bfutil.unixpath(bfile))
 
+        paths = bfutil.resolver(repo).find([hash for (bfile, hash, mode) in torestore])
+        hows = []
+        for bfile, expectedhash, mode in torestore:
+            path = paths[expectedhash]
+            if path is None:
+                toget.append((bfile, expectedhash))
+                continue
+            hows.append(bfutil.materialize(ui, path, repo.wjoin(bfile)))
+            bfutil.set_mode(repo.wjoin(bfile), mode)
+            updated += 1
+            if bfile not in phashes:
+                bfdirstate.add(bfutil.unixpath(bfile))
+            elif expectedhash == phashes[bfile]:
+                bfdirstate.normal(bfutil.unixpath(bfile))
+            else:
+                bfutil.dirstate_normaldirty(bfdirstate, bfutil.unixpath(bfile))
+
+        bfutil.report_copies(ui, hows)
+
         if toget:
             store = basestore._open_store(repo)
             (success, missing) = store.get(toget)
@@ -409,11 +723,11 @@ def revert_bfiles(ui, repo):
 
         for (filename, hash) in success:
             mode = os.stat(repo.wjoin(bfutil.standin(filename))).st_mode
-            os.chmod(repo.wjoin(filename), mode)
+            bfutil.set_mode(repo.wjoin(filename), mode)
             updated += 1
-            if bfutil.standin(filename) not in repo['.']:
+            if filename not in phashes:
                 bfdirstate.add(bfutil.unixpath(filename))
-            elif hash == repo['.'][bfutil.standin(filename)].data().strip():
+            elif hash == phashes[filename]:
                 bfdirstate.normal(bfutil.unixpath(filename))
             else:
                 bfutil.dirstate_normaldirty(bfdirstate, bfutil.unixpath(filename))
@@ -424,7 +738,7 @@ def revert_bfiles(ui, repo):
                 if os.path.exists(repo.wjoin(bfile)):
                     os.unlink(repo.wjoin(bfile))
                     removed += 1
-                    if bfutil.standin(bfile) in repo['.']:
+                    if bfile in phashes:
                         bfdirstate.remove(bfutil.unixpath(bfile))
                     else:
                         bfdirstate.forget(bfutil.unixpath(bfile))
@@ -442,69 +756,154 @@ def revert_bfiles(ui, repo):
     finally:
         wlock.release()
 
-def update_bfiles(ui, repo):
+def _changed_bfiles(repo, bfdirstate, oldnode, newnode, whashes):
+    '''Return the set of big files that an update (or merge) from oldnode
+    to newnode may have to touch: those whose standins differ between
+    oldnode and the working copy, plus those that bfdirstate does not know
+    to be clean.'''
+    ohashes = bfindex.hashes(repo, oldnode)
+    changed = set([f for f in whashes if ohashes.get(f) != whashes[f]])
+    changed.update([f for f in ohashes if f not in whashes])
+
+    # A change of the executable bit does not change the hash.
+    m1 = repo[oldnode].manifest()
+    m2 = repo[newnode].manifest()
+    for standin in m2:
+        if bfutil.is_standin(standin) and m1.flags(standin) != m2.flags(standin):
+            changed.add(bfutil.split_standin(standin))
+
+    s = bfdirstate.status(match_.always(repo.root, repo.getcwd()), [], False, False, False)
+    (unsure, modified, added, removed, missing, unknown, ignored, clean) = s
+    changed.update(unsure + modified + added + removed + missing)
+    changed.update([f for f in whashes if f not in bfdirstate])
+    return changed
+
+def update_bfiles(ui, repo, oldnode=None, newnode=None):
+    '''Bring the big files in the working copy in line with their
+    standins.  If the caller knows which changeset the working copy was
+    updated (or merged) from and to, only the big files that differ
+    between them are looked at; otherwise every big file is hashed.'''
     wlock = repo.wlock()
     try:
         bfdirstate = bfutil.open_bfdirstate(ui, repo)
-        s = bfdirstate.status(match_.always(repo.root, repo.getcwd()), [], False, False, False)
-        (unsure, modified, added, removed, missing, unknown, ignored, clean) = s
 
-        bfiles = bfutil.list_bfiles(repo)
-        toget = []
-        at = 0
+        allbfiles = bfutil.list_bfiles(repo)
+        whashes = bfindex.hashes(repo)
+        workers = bfutil.get_workers(ui)
         updated = 0
         removed = 0
         printed = False
-        if bfiles:
+        if allbfiles:
             ui.status(_('Getting changed bfiles\n'))
             printed = True
 
+        if oldnode is not None:
+            changed = _changed_bfiles(repo, bfdirstate, oldnode, newnode, whashes)
+            bfiles = [f for f in allbfiles if f in changed]
+        else:
+            bfiles = allbfiles
+
+        # bfdirstate changes, applied in one go at the end
+        normal = []
+        forget = []
+
+        # Plan: work out which big files need to be (re)written.  Items
+        # are (bfile, expected hash, mode of the standin).
+        tocheck = []
+        tofetch = []
         for bfile in bfiles:
-            at += 1
             if os.path.exists(repo.wjoin(bfile)) and not os.path.exists(repo.wjoin(bfutil.standin(bfile))):
                 os.unlink(repo.wjoin(bfile))
                 removed += 1
-                bfdirstate.forget(bfutil.unixpath(bfile))
+                forget.append(bfile)
                 continue
-            expectedhash = repo[None][bfutil.standin(bfile)].data().strip()
-            mode = os.stat(repo.wjoin(bfutil.standin(bfile))).st_mode
-            if not os.path.exists(repo.wjoin(bfile)) or expectedhash != bfutil.hashfile(repo.wjoin(bfile)):
-                path = bfutil.find_file(repo, expectedhash)
-                if not path:
-                    toget.append((bfile, expectedhash))
-                else:
-                    util.makedirs(os.path.dirname(repo.wjoin(bfile)))
-                    shutil.copy(path,  repo.wjoin(bfile))
-                    os.chmod(repo.wjoin(bfile), mode)
+            item = (bfile, whashes.get(bfile),
+                    os.stat(repo.wjoin(bfutil.standin(bfile))).st_mode)
+            if os.path.exists(repo.wjoin(bfile)):
+                tocheck.append(item)
+            else:
+                tofetch.append(item)
+
+        # Copy what we already have while we download the rest.
+        def materialize(entry):
+            ((bfile, expectedhash, mode), path) = entry
+            how = bfutil.materialize(ui, path, repo.wjoin(bfile))
+            bfutil.set_mode(repo.wjoin(bfile), mode)
+            return how
+        copying = []
+        stores = []
+        modes = {}
+        def fetch(items):
+            '''Start copying the items that are cached, download the
+            others and return the (bfile, hash) pairs downloaded.'''
+            paths = bfutil.resolver(repo).find([item[1] for item in items])
+            fromcache = [(item, paths[item[1]]) for item in items
+                         if paths[item[1]]]
+            toget = [item for item in items if not paths[item[1]]]
+            copying.append(bfutil.backgroundmap(materialize, fromcache, workers))
+            if not toget:
+                return []
+            for (bfile, hash, mode) in toget:
+                modes[bfile] = mode
+            if not stores:
+                stores.append(basestore._open_store(repo))
+            (success, missing) = stores[0].get(
+                [(bfile, hash) for (bfile, hash, mode) in toget])
+            return success
+
+        # Hash the big files that are there while we fetch the ones that
+        # are missing: neither has to wait for the other.
+        def hashitem(item):
+            return bfutil.hashfile(repo.wjoin(item[0]))
+        hashing = bfutil.backgroundmap(hashitem, tocheck, workers)
+        try:
+            success = fetch(tofetch)
+            tofetch = []
+            for item, curhash in hashing.result():
+                (bfile, expectedhash, mode) = item
+                if curhash != expectedhash:
+                    tofetch.append(item)
+                elif mode != os.stat(repo.wjoin(bfile)).st_mode:
+                    bfutil.set_mode(repo.wjoin(bfile), mode)
                     updated += 1
-                    bfdirstate.normal(bfutil.unixpath(bfile))
-            elif os.path.exists(repo.wjoin(bfile)) and mode != os.stat(repo.wjoin(bfile)).st_mode:
-                os.chmod(repo.wjoin(bfile), mode)
-                updated += 1
-                bfdirstate.normal(bfutil.unixpath(bfile))
+                    normal.append(bfile)
+            if tofetch:
+                success += fetch(tofetch)
 
-        if toget:
-            store = basestore._open_store(repo)
-            (success, missing) = store.get(toget)
-        else:
-            success, missing = [],[]
-
-        for (filename, hash) in success:
-            mode = os.stat(repo.wjoin(bfutil.standin(filename))).st_mode
-            os.chmod(repo.wjoin(filename), mode)
-            updated += 1
-            bfdirstate.normal(bfutil.unixpath(filename))
+            for (filename, hash) in success:
+                bfutil.set_mode(repo.wjoin(filename), modes[filename])
+                updated += 1
+                normal.append(filename)
 
+            hows = []
+            for c in copying:
+                for ((bfile, expectedhash, mode), path), how in c.result():
+                    updated += 1
+                    normal.append(bfile)
+                    hows.append(how)
+            bfutil.report_copies(ui, hows)
+        finally:
+            # Nothing may still be writing to the working copy once we
+            # let go of the wlock.
+            hashing.cancel()
+            for c in copying:
+                c.cancel()
+
+        allbfiles = set(allbfiles)
         for bfile in bfdirstate:
-            if bfile not in bfiles:
+            if bfile not in allbfiles:
                 if os.path.exists(repo.wjoin(bfile)):
                     if not printed:
                         ui.status(_('Getting changed bfiles\n'))
                         printed = True
                     os.unlink(repo.wjoin(bfile))
                     removed += 1
-                    bfdirstate.forget(bfutil.unixpath(bfile))
+                    forget.append(bfile)
 
+        for bfile in normal:
+            bfdirstate.normal(bfutil.unixpath(bfile))
+        for bfile in forget:
+            bfdirstate.forget(bfutil.unixpath(bfile))
         bfdirstate.write()
         if printed:
             ui.status(_('%d big files updated, %d removed\n') % (updated, removed))
@@ -520,4 +919,30 @@ cmdtable = {
                       '(in megabytes) will be considered bfiles. This can also be specified in your hgrc as [bfiles].size.'),
                   ('','tonormal',False, 'Convert from a bfiles repo to a normal repo')],
                   _('hg kbfconvert SOURCE DEST [FILE ...]')),
+    'kbfrebuild': (bfrebuild, [], _('hg kbfrebuild')),
+    'kbfbundle': (bfbundle,
+                  [('r', 'rev', [], _('only bundle the big files of these revisions'))],
+                  _('hg kbfbundle [-r REV]... FILE')),
+    'kbfunbundle': (bfunbundle, [], _('hg kbfunbundle FILE')),
+    'kbffsck': (bffsck,
+                [('', 'restart', None, _('check everything, even after an interrupted check'))],
+                _('hg kbffsck [--restart]')),
+    'kbfrepack': (bfrepack,
+                  [('', 'max-size', '', _('only pack big files of at most this many bytes'))],
+                  _('hg kbfrepack [--max-size BYTES]')),
+    'kbfsync': (bfsync,
+                [('r', 'rev', [], _('only copy the big files of these revisions'))],
+                _('hg kbfsync [-r REV]... SRC DST')),
+    'kbftransferd': (bftransferd,
+                     [('d', 'daemon', None, _('run in background')),
+                      ('', 'daemon-pipefds', '', _('used internally by daemon mode')),
+                      ('', 'pid-file', '', _('name of file to write process ID to'))],
+                     _('hg kbftransferd [-d]')),
+    'kbfupload': (bfupload, [], _('hg kbfupload')),
+    'kbfwatch': (bfwatch,
+                 [('d', 'daemon', None, _('run in background')),
+                  ('', 'daemon-pipefds', '', _('used internally by daemon mode')),
+                  ('', 'pid-file', '', _('name of file to write process ID to')),
+                  ('', 'stop', None, _('stop the running daemon'))],
+                 _('hg kbfwatch [-d] [--stop]')),
     }
@@ -0,0 +1,345 @@
+'''Persistent index of the big files in each changeset.
+
+Reading the standins of a changeset costs one filelog read per big file.
+This index remembers, for every changeset, which big files it has and
+their hashes, so that code needing that information for many files does
+dictionary lookups instead.
+
+The index lives in .hg/kilnbfiles/standins.i and standins.d.  standins.i
+holds one fixed-size record per changelog revision:
+
+  node (20 bytes), data offset, data length, delta parent, chain length
+
+standins.d holds zlib-compressed "<hash> <bfile>" lines: either the full
+list of big files (a snapshot, delta parent -1) or only the big files
+that differ from the delta parent ("- <bfile>" for removed ones).  As in
+a revlog, a snapshot is stored whenever the delta chain gets long.
+
+The index is brought up to date with the changelog lazily, whenever it
+is used, and is discarded from the first revision that no longer matches
+the changelog (after a strip or rollback).  Each use indexes at most
+_max_update revisions, so the first use in a large repository does not
+stall on the whole history; revisions beyond those are read from their
+manifests until the index catches up.
+'''
+
+import os
+import errno
+import mmap
+import struct
+import zlib
+
+from mercurial import util, error, lock as lock_
+from mercurial.i18n import _
+
+import bfutil
+
+_record_format = '>20sQIii'
+_record_size = struct.calcsize(_record_format)
+_max_chain = 64
+_max_update = 1000
+
+class standinindex(object):
+    def __init__(self, repo):
+        self.repo = repo
+        self.ui = repo.ui
+        admin = repo.join(bfutil.long_name)
+        self.indexfile = os.path.join(admin, 'standins.i')
+        self.datafile = os.path.join(admin, 'standins.d')
+        self.lockfile = os.path.join(admin, 'standins.lock')
+        self._records = None
+        self._data = None
+        self._pending = []              # records not yet written to disk
+        self._pendingdata = []
+        self._cache = {}
+
+    def hashes(self, rev):
+        '''Return {bfile: hash} for changeset rev (a revision number,
+        node or changectx).'''
+        rev = self._rev(rev)
+        if rev == -1:
+            return {}
+        if not self.update(rev):
+            return _manifest_hashes(self.repo[rev])
+        return self._reconstruct(rev)
+
+    def changed(self, rev):
+        '''Return {bfile: hash} for the big files that changeset rev adds
+        or modifies relative to its first parent.  Big files it removes
+        map to '-'.'''
+        rev = self._rev(rev)
+        if rev == -1:
+            return {}
+        if self.update(rev) and self._record(rev)[3] != -1:
+            return self._parse(self._chunk(rev))
+        hashes = self.hashes(rev)
+        parent = self.hashes(self.repo.changelog.parentrevs(rev)[0])
+        changed = dict((f, h) for (f, h) in hashes.iteritems()
+                       if parent.get(f) != h)
+        for f in parent:
+            if f not in hashes:
+                changed[f] = '-'
+        return changed
+
+    def update(self, rev=None):
+        '''Index the changesets up to rev (by default, all of them) that
+        are not indexed yet, but no more than _max_update of them.  Return
+        True if rev is indexed now.'''
+        cl = self.repo.changelog
+        if rev is None:
+            rev = len(cl) - 1
+        self._load()
+        count = len(self._records) + len(self._pending)
+        if count > rev:
+            return True
+        stop = min(rev + 1, count + _max_update)
+
+        # The big files of the revision just indexed, updated in place
+        # for its child: on a linear history this avoids copying them.
+        last = None
+        for r in xrange(count, stop):
+            self.ui.progress(_('Indexing bfiles'), r - count, unit=_('revision'),
+                             total=stop - count)
+            last = self._add(r, last)
+        self.ui.progress(_('Indexing bfiles'), None)
+        self._flush()
+        return stop > rev
+
+    # -- Internals -------------------------------------------------------
+
+    def _rev(self, rev):
+        if hasattr(rev, 'rev'):
+            return rev.rev()
+        elif isinstance(rev, str):
+            return self.repo.changelog.rev(rev)
+        return rev
+
+    def _parse(self, chunk):
+        return dict([line.split(' ', 1)[::-1] for line in chunk.splitlines()])
+
+    def _load(self):
+        if self._records is not None:
+            return
+        index = _readmap(self.indexfile)
+        data = _readmap(self.datafile)
+        cl = self.repo.changelog
+        count = min(len(index) // _record_size, len(cl))
+        # A strip or rollback only ever removes the newest revisions, so
+        # the valid records are a prefix of the index.
+        while count:
+            rec = self._unpack(index, count - 1)
+            if rec[0] == cl.node(count - 1) and rec[1] + rec[2] <= len(data):
+                break
+            count -= 1
+        self._records = [self._unpack(index, rev) for rev in xrange(count)]
+        self._data = data
+        if count * _record_size != len(index):
+            self._truncate(count)
+
+    def _unpack(self, index, rev):
+        return struct.unpack(_record_format,
+                             index[rev * _record_size:(rev + 1) * _record_size])
+
+    def _truncate(self, count):
+        l = self._lock()
+        if l is None:
+            return
+        try:
+            datalen = 0
+            if count:
+                last = self._records[count - 1]
+                datalen = last[1] + last[2]
+            data = self._data[:datalen]
+            # Replace the files rather than truncating them: other
+            # processes may have them mapped.
+            for path, content in ((self.datafile, data),
+                                  (self.indexfile, ''.join(
+                    [struct.pack(_record_format, *rec) for rec in self._records]))):
+                fd = util.atomictempfile(path, 'wb')
+                fd.write(content)
+                fd.rename()
+            self._data = data
+        finally:
+            l.release()
+
+    def _record(self, rev):
+        if rev < len(self._records):
+            return self._records[rev]
+        return self._pending[rev - len(self._records)]
+
+    def _chunk(self, rev):
+        rec = self._record(rev)
+        if rev < len(self._records):
+            chunk = self._data[rec[1]:rec[1] + rec[2]]
+        else:
+            chunk = self._pendingdata[rev - len(self._records)]
+        return zlib.decompress(chunk)
+
+    def _reconstruct(self, rev):
+        if rev in self._cache:
+            return self._cache[rev]
+        chain = []
+        base = rev
+        while base != -1 and base not in self._cache:
+            chain.append(base)
+            base = self._record(base)[3]
+        if base == -1:
+            hashes = {}
+        else:
+            hashes = self._cache[base].copy()
+        for r in reversed(chain):
+            for bfile, hash in self._parse(self._chunk(r)).iteritems():
+                if hash == '-':
+                    hashes.pop(bfile, None)
+                else:
+                    hashes[bfile] = hash
+        if len(self._cache) > 16:
+            self._cache.clear()
+        self._cache[rev] = hashes
+        return hashes
+
+    def _add(self, rev, last):
+        repo = self.repo
+        ctx = repo[rev]
+        p1, p2 = repo.changelog.parentrevs(rev)
+
+        if p1 == -1:
+            hashes = _manifest_hashes(ctx)
+            changed = []
+        else:
+            if last is not None and last[0] == p1:
+                hashes = last[1]
+            else:
+                hashes = self._reconstruct(p1).copy()
+            if p2 == -1:
+                changed = [f for f in ctx.files() if bfutil.is_standin(f)]
+            else:
+                # ctx.files() does not list files merged in from p2
+                mc = ctx.manifest()
+                mp1 = ctx.parents()[0].manifest()
+                changed = [f for f in mc if bfutil.is_standin(f) and mc[f] != mp1.get(f)]
+                changed += [f for f in mp1 if bfutil.is_standin(f) and f not in mc]
+
+        delta = {}
+        for f in changed:
+            bfile = bfutil.split_standin(f)
+            if f in ctx:
+                hashes[bfile] = delta[bfile] = _standin_hash(ctx, f)
+            elif bfile in hashes:
+                del hashes[bfile]
+                delta[bfile] = '-'
+
+        chainlen = p1 != -1 and self._record(p1)[4] + 1 or 0
+        if p1 == -1 or chainlen >= _max_chain:
+            delta = hashes
+            deltaparent = -1
+            chainlen = 0
+        else:
+            deltaparent = p1
+
+        chunk = zlib.compress(''.join(['%s %s\n' % (delta[f], f)
+                                       for f in sorted(delta)]))
+        offset = len(self._data) + sum([len(c) for c in self._pendingdata])
+        self._pending.append((ctx.node(), offset, len(chunk), deltaparent, chainlen))
+        self._pendingdata.append(chunk)
+        return (rev, hashes)
+
+    def _lock(self):
+        try:
+            return lock_.lock(self.lockfile, 0)
+        except error.LockHeld:
+            # Someone else is updating the index; we will simply keep our
+            # records in memory for the rest of this command.
+            return None
+
+    def _flush(self):
+        l = self._lock()
+        if l is None:
+            return
+        try:
+            # Somebody may have extended the index since we loaded it.
+            if _filesize(self.indexfile) != len(self._records) * _record_size:
+                return
+            if _filesize(self.datafile) != len(self._data):
+                return
+            fd = open(self.datafile, 'ab')
+            try:
+                fd.write(''.join(self._pendingdata))
+            finally:
+                fd.close()
+            # The index is written last: a record is only ever visible
+            # once the data it points at is on disk.
+            fd = open(self.indexfile, 'ab')
+            try:
+                fd.write(''.join([struct.pack(_record_format, *rec)
+                                  for rec in self._pending]))
+            finally:
+                fd.close()
+            self._records = None
+            self._pending = []
+            self._pendingdata = []
+            self._load()
+        finally:
+            l.release()
+
+def _standin_hash(ctx, standin):
+    return bfutil.standin_hash(ctx[standin].data())
+
+def _manifest_hashes(ctx):
+    '''Return {bfile: hash} for ctx by reading every standin in it.'''
+    return dict((bfutil.split_standin(f), _standin_hash(ctx, f))
+                for f in ctx.manifest() if bfutil.is_standin(f))
+
+def _filesize(path):
+    try:
+        return os.path.getsize(path)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return 0
+
+def _readmap(path):
+    '''Return the contents of path as a read-only memory map (or an empty
+    string if it is missing or empty).'''
+    try:
+        fd = open(path, 'rb')
+    except IOError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return ''
+    try:
+        size = os.fstat(fd.fileno()).st_size
+        if not size:
+            return ''
+        return mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        fd.close()
+
+def get(repo):
+    '''Return the standin index for repo, shared by everything that runs
+    in this process.'''
+    index = getattr(repo, '_bfstandinindex', None)
+    if index is None:
+        index = repo._bfstandinindex = standinindex(repo)
+    return index
+
+def hashes(repo, ctx=None):
+    '''Return {bfile: hash} for changeset ctx (a changectx, revision
+    number or node), or for the working copy if ctx is None.'''
+    if ctx is None or getattr(ctx, 'rev', lambda: 0)() is None:
+        return working_hashes(repo)
+    return get(repo).hashes(ctx)
+
+def working_hashes(repo):
+    '''Return {bfile: hash} for the standins in the working copy.  Only
+    the standins that the dirstate does not consider clean are read from
+    disk; the others are taken from the first parent's index entry.'''
+    hashes = get(repo).hashes(repo.dirstate.parents()[0]).copy()
+    matcher = bfutil.get_standin_matcher(repo)
+    s = repo.dirstate.status(matcher, [], False, False, False)
+    (unsure, modified, added, removed, missing, unknown, ignored, clean) = s
+    for standin in unsure + modified + added:
+        hashes[bfutil.split_standin(standin)] = bfutil.read_standin(repo, standin)
+    for standin in removed + missing:
+        hashes.pop(bfutil.split_standin(standin), None)
+    return hashes
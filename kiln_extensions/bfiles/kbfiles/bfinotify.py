@@ -0,0 +1,283 @@
+'''kbfwatch daemon: record which big files may have changed, using the
+Linux inotify API.  The client side lives in bfutil.read_watch().'''
+
+import os
+import sys
+import errno
+import struct
+import signal
+import time
+
+from mercurial import util
+from mercurial.i18n import _
+
+import bfutil
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_dirmask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+            IN_MOVE_SELF | IN_ONLYDIR)
+_adminmask = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR
+_structural = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+_event_format = 'iIII'
+_event_size = struct.calcsize(_event_format)
+
+class inotify(object):
+    '''Minimal ctypes binding for inotify(7).'''
+    def __init__(self):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self._get_errno = ctypes.get_errno
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            err = self._get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add(self, path, mask):
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = self._get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def remove(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self):
+        '''Block until events are available, and return them as a list
+        of (wd, mask, name) tuples.'''
+        while True:
+            try:
+                data = os.read(self.fd, 256 * 1024)
+                break
+            except OSError, err:
+                if err.errno != errno.EINTR:
+                    raise
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, namelen = struct.unpack(
+                _event_format, data[pos:pos + _event_size])
+            pos += _event_size
+            name = data[pos:pos + namelen].rstrip('\0')
+            pos += namelen
+            events.append((wd, mask, name))
+        return events
+
+class watcher(object):
+    '''Watch every directory that holds a big file (and its parents)
+    and journal every path that changes to .hg/kilnbfiles/watch.dirty.
+
+    A file stays "possibly dirty" until a client has looked at it after
+    its last change and rewritten watch.synced, which lets the daemon
+    drop the journal lines the client had read.  Restarting the daemon
+    or overflowing the kernel event queue starts a new token and so
+    forces clients back to a full status.'''
+
+    def __init__(self, ui, repo):
+        self.ui = ui
+        self.repo = repo
+        self.admin = repo.join(bfutil.long_name)
+        self.inotify = None
+        self.wds = {}                   # wd -> repo-relative dir
+        self.dirwds = {}                # repo-relative dir -> wd
+        self.logged = set()
+        self.log = None
+        self.token = None
+        self.base = 0
+
+    def start(self):
+        if not sys.platform.startswith('linux'):
+            raise util.Abort(_('kbfwatch requires Linux'))
+        util.makedirs(self.admin)
+        self.inotify = inotify()
+        self.adminwd = self.inotify.add(self.admin, _adminmask)
+        self.reset()
+        self.ui.status(_('watching %d directories\n') % len(self.dirwds))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                self.process(self.inotify.read())
+        finally:
+            try:
+                os.unlink(os.path.join(self.admin, bfutil.watch_state))
+            except OSError:
+                pass
+
+    def reset(self):
+        '''Start a new token with an empty journal.'''
+        self.token = '%d.%d' % (os.getpid(), int(time.time() * 1000))
+        self.base = 0
+        self.writelog([])
+        self.refresh(initial=True)
+        self.writestate()
+
+    def writelog(self, lines):
+        '''Replace the journal with lines, and reopen it for appending.'''
+        if self.log:
+            self.log.close()
+        path = os.path.join(self.admin, bfutil.watch_dirty)
+        fd = util.atomictempfile(path, 'wb')
+        header = '%s %d' % (self.token, self.base)
+        fd.write(''.join(['%s\n' % l for l in [header] + lines]))
+        fd.rename()
+        self.logged = set([tuple(l.split(' ', 1)) for l in lines])
+        self.log = open(path, 'ab')
+
+    def compact(self):
+        '''Drop the journal lines that a client has accounted for in
+        watch.synced.'''
+        synced = bfutil._readlines(os.path.join(self.admin,
+                                                bfutil.watch_synced))
+        try:
+            token, offset = synced[0].split(' ')
+            offset = int(offset)
+        except (TypeError, IndexError, ValueError):
+            return
+        if token != self.token or offset <= self.base:
+            return
+        lines = bfutil._readlines(os.path.join(self.admin,
+                                               bfutil.watch_dirty))
+        lines = lines[1 + offset - self.base:]
+        self.base = offset
+        self.writelog(lines)
+
+    def wanted(self):
+        dirs = set([''])
+        # Never build the bfdirstate here: that writes it without the
+        # wlock.  The daemon refreshes when it is written.
+        bfdirstate = bfutil.open_bfdirstate(self.ui, self.repo, create=False)
+        for bfile in bfdirstate or []:
+            dir = os.path.dirname(bfile)
+            while dir not in dirs:
+                dirs.add(dir)
+                dir = os.path.dirname(dir)
+        return dirs
+
+    def refresh(self, initial=False):
+        '''Watch every directory that holds big files now.  Files in
+        directories that were not watched until now are journaled: the
+        daemon has not seen what happened to them so far.'''
+        for dir in sorted(self.wanted()):
+            if dir in self.dirwds:
+                continue
+            try:
+                wd = self.inotify.add(self.repo.wjoin(dir), _dirmask)
+            except OSError, err:
+                if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                continue
+            self.wds[wd] = dir
+            self.dirwds[dir] = wd
+            if not initial:
+                for name in os.listdir(self.repo.wjoin(dir)):
+                    self.record('f', self.join(dir, name))
+
+    def join(self, dir, name):
+        if dir:
+            return dir + '/' + name
+        return name
+
+    def record(self, kind, path):
+        if (kind, path) not in self.logged:
+            self.logged.add((kind, path))
+            self.log.write('%s %s\n' % (kind, path))
+
+    def unwatch(self, path):
+        '''Forget the watches on path and every directory under it.'''
+        for dir in self.dirwds.keys():
+            if dir == path or dir.startswith(path + '/') or not path:
+                wd = self.dirwds.pop(dir)
+                del self.wds[wd]
+                self.inotify.remove(wd)
+
+    def process(self, events):
+        cookies = []
+        reload = False
+        dirschanged = False
+        compact = False
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.ui.warn(_('kbfwatch: event queue overflowed, '
+                               'starting over\n'))
+                self.reset()
+                return self.process([e for e in events if e[0] == self.adminwd])
+            if wd == self.adminwd:
+                if name.startswith(bfutil.watch_cookie) and mask & IN_CREATE:
+                    cookies.append(name)
+                    # The client reads the journal after this, and may
+                    # then sync without the paths it already holds: any
+                    # later change to them must be journaled again.
+                    self.logged = set()
+                elif name in ('dirstate', 'dirstate.journal'):
+                    reload = True
+                elif name == bfutil.watch_synced:
+                    compact = True
+                continue
+            dir = self.wds.get(wd)
+            if dir is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                self.record('r', dir)
+                if dir in self.dirwds:
+                    self.unwatch(dir)
+                dirschanged = reload = True
+            elif mask & IN_ISDIR and mask & _structural:
+                path = self.join(dir, name)
+                self.record('r', path)
+                self.unwatch(path)
+                dirschanged = reload = True
+            else:
+                self.record('f', self.join(dir, name))
+
+        if reload:
+            before = len(self.dirwds)
+            self.refresh()
+            dirschanged = dirschanged or len(self.dirwds) != before
+        self.log.flush()
+        if compact:
+            self.compact()
+        if dirschanged:
+            self.writestate()
+        # Everything queued before these cookies is now on disk.
+        for name in cookies:
+            try:
+                os.unlink(os.path.join(self.admin, name))
+            except OSError:
+                pass
+
+    def writestate(self):
+        fd = util.atomictempfile(os.path.join(self.admin, bfutil.watch_state), 'wb')
+        lines = ['%d %s' % (os.getpid(), self.token)] + sorted(self.dirwds)
+        fd.write(''.join(['%s\n' % l for l in lines]))
+        fd.rename()
+
+def stop(ui, repo):
+    '''Stop the kbfwatch daemon for repo, if one is running.'''
+    state = bfutil._readlines(repo.join(os.path.join(bfutil.long_name,
+                                                     bfutil.watch_state)))
+    if not state:
+        raise util.Abort(_('no kbfwatch daemon is running'))
+    try:
+        os.kill(int(state[0].split(' ', 1)[0]), signal.SIGTERM)
+    except (ValueError, OSError):
+        raise util.Abort(_('no kbfwatch daemon is running'))
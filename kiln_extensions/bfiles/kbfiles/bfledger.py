@@ -0,0 +1,145 @@
+'''Ledger of the hashes known to be present in a central store.
+
+Every store URL has its own ledger in the .present directory of the
+system cache, shared by all repositories on this machine.  A hash goes
+in once the store has confirmed it has it (an upload, a download or an
+existence check), and later existence checks for it are answered
+without asking the store.  [kilnbfiles] recheck (--bf-recheck) ignores
+the ledger.
+
+A ledger is a sorted file of binary hashes, searched in place, plus a
+journal of hashes added since it was last sorted.
+'''
+
+import os
+import errno
+import mmap
+import threading
+import binascii
+
+from mercurial import util
+
+import bfutil
+
+_hashlen = 20
+_maxjournal = 4096
+
+class ledger(object):
+    def __init__(self, ui, url):
+        dir = os.path.join(os.path.dirname(bfutil.system_cache_path(ui, 'x')),
+                           '.present')
+        self.path = os.path.join(dir, util.sha1(url).hexdigest())
+        self.journalpath = self.path + '.new'
+        self.recheck = ui.configbool(bfutil.long_name, 'recheck', False)
+        self.lock = threading.Lock()
+        self._sorted = None
+        self._journal = None
+
+    def __contains__(self, hash):
+        if self.recheck:
+            return False
+        key = binascii.unhexlify(hash)
+        self.lock.acquire()
+        try:
+            self._load()
+            if key in self._journal:
+                return True
+            lo, hi = 0, len(self._sorted) // _hashlen
+            while lo < hi:
+                mid = (lo + hi) // 2
+                rec = self._sorted[mid * _hashlen:(mid + 1) * _hashlen]
+                if rec < key:
+                    lo = mid + 1
+                elif rec > key:
+                    hi = mid
+                else:
+                    return True
+            return False
+        finally:
+            self.lock.release()
+
+    def add(self, hashes):
+        '''Record that the store has hashes.'''
+        keys = [binascii.unhexlify(hash) for hash in hashes]
+        self.lock.acquire()
+        try:
+            self._load()
+            keys = [key for key in keys if key not in self._journal]
+            if not keys:
+                return
+            bfutil.create_dir(os.path.dirname(self.path))
+            # One append per call, so that concurrent writers do not
+            # interleave partial records.
+            fd = os.open(self.journalpath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            try:
+                os.write(fd, ''.join(keys))
+            finally:
+                os.close(fd)
+            self._journal.update(keys)
+            if len(self._journal) > _maxjournal:
+                self._compact()
+        finally:
+            self.lock.release()
+
+    def _load(self):
+        if self._sorted is not None:
+            return
+        self._sorted = _readmap(self.path)
+        data = _read(self.journalpath)
+        self._journal = set([data[i:i + _hashlen]
+                             for i in xrange(0, len(data) - _hashlen + 1, _hashlen)])
+        if len(data) % _hashlen:
+            # A writer died half-way through a record: start afresh so
+            # that later records are aligned again.
+            self._compact()
+
+    def _compact(self):
+        '''Merge the journal into the sorted file.  Hashes appended by
+        other processes meanwhile may be lost, which only costs a
+        check with the store later on.'''
+        lock = bfutil.filelock(self.path + '.lock')
+        try:
+            data = _read(self.journalpath)
+            keys = set([self._sorted[i:i + _hashlen]
+                        for i in xrange(0, len(self._sorted), _hashlen)])
+            keys.update(self._journal)
+            keys.update([data[i:i + _hashlen]
+                         for i in xrange(0, len(data) - _hashlen + 1, _hashlen)])
+            fd = util.atomictempfile(self.path, 'wb')
+            fd.write(''.join(sorted(keys)))
+            fd.rename()
+            try:
+                os.unlink(self.journalpath)
+            except OSError:
+                pass
+        finally:
+            lock.release()
+        self._sorted = _readmap(self.path)
+        self._journal = set()
+
+def _read(path):
+    try:
+        fd = open(path, 'rb')
+    except IOError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return ''
+    try:
+        return fd.read()
+    finally:
+        fd.close()
+
+def _readmap(path):
+    try:
+        fd = open(path, 'rb')
+    except IOError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return ''
+    try:
+        size = os.fstat(fd.fileno()).st_size
+        if not size:
+            return ''
+        return mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        fd.close()
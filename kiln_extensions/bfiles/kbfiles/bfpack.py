@@ -0,0 +1,124 @@
+'''Packing small big file revisions.
+
+Caches with many small objects use up inodes and are slow to walk and
+back up.  repack() moves the small loose objects of a cache directory
+and all of its existing packs into a single new pack, in the format
+described in bfutil, and removes what it packed.  Readers find objects
+in packs transparently, so a cache stays usable while it is repacked.
+'''
+
+import os
+import re
+import struct
+import tempfile
+import binascii
+
+from mercurial import util
+from mercurial.i18n import _
+
+import bfutil
+
+_objectname = re.compile(r'^[0-9a-f]{40}(\.z)?$')
+
+def repack(ui, cachedir, maxsize, lock=False):
+    '''Pack the loose objects of at most maxsize bytes in cachedir
+    together with the objects of its existing packs.  If lock is True
+    each loose object is removed under its system cache lock.  Return
+    (objects, loose, packs): the number of objects in the new pack and
+    the number of loose objects and old packs removed.'''
+    packdir = bfutil.pack_dir(cachedir)
+    bfutil.create_dir(packdir)
+    packlock = bfutil.filelock(os.path.join(packdir, 'lock'))
+    try:
+        oldpacks = bfutil.list_packs(cachedir)
+        # hash -> (path, offset, length, size) of the stored data
+        objects = {}
+        for pack in oldpacks:
+            for hash, offset, length, size in bfutil.pack_entries(pack):
+                objects.setdefault(hash, (pack, offset, length, size))
+        loose = []
+        for name in os.listdir(cachedir):
+            if not _objectname.match(name):
+                continue
+            path = os.path.join(cachedir, name)
+            size = bfutil.cached_object_size(path)
+            if size > maxsize:
+                continue
+            hash = name[:40]
+            loose.append((hash, path))
+            if hash in objects:
+                continue
+            if bfutil.is_compressed(path):
+                headersize = struct.calcsize(bfutil._zheader)
+                objects[hash] = (path, headersize,
+                                 os.path.getsize(path) - headersize, size)
+            else:
+                objects[hash] = (path, 0, size, size)
+        if not loose and len(oldpacks) < 2:
+            return (0, 0, 0)
+
+        newpack = _write(ui, packdir, objects)
+        for pack in oldpacks:
+            if pack == newpack:
+                continue
+            # The index first, so that nobody finds a pack that is gone.
+            os.unlink(pack[:-len('.pack')] + '.idx')
+            os.unlink(pack)
+        for hash, path in loose:
+            if not lock:
+                os.unlink(path)
+                continue
+            objlock = bfutil.lock_system_cache(ui, hash)
+            try:
+                os.unlink(path)
+            finally:
+                objlock.release()
+        return (len(objects), len(loose), len(oldpacks) - (newpack in oldpacks))
+    finally:
+        packlock.release()
+
+def _write(ui, packdir, objects):
+    '''Write objects into a new pack in packdir and return its path.'''
+    hashes = sorted(objects)
+    (tmpfd, tmpfilename) = tempfile.mkstemp(dir=packdir, prefix='.tmp-pack')
+    try:
+        outfile = os.fdopen(tmpfd, 'wb')
+        try:
+            outfile.write(bfutil._packmagic)
+            offset = len(bfutil._packmagic)
+            index = []
+            at = 0
+            for hash in hashes:
+                ui.progress(_('Packing bfiles'), at, unit=_('bfile'),
+                            total=len(hashes))
+                at += 1
+                path, start, length, size = objects[hash]
+                infile = open(path, 'rb')
+                try:
+                    infile.seek(start)
+                    for data in bfutil.readchunks(infile, length):
+                        outfile.write(data)
+                except IOError:
+                    raise util.Abort(_('%s: truncated big file %s')
+                                     % (path, hash))
+                finally:
+                    infile.close()
+                index.append(struct.pack(bfutil._packrecord,
+                                         binascii.unhexlify(hash),
+                                         offset, length, size))
+                offset += length
+            ui.progress(_('Packing bfiles'), None)
+        finally:
+            outfile.close()
+        index = ''.join(index)
+        name = os.path.join(packdir, 'pack-' + util.sha1(index).hexdigest())
+        if not os.path.exists(name + '.idx'):
+            # The pack must be in place before its index makes it visible.
+            os.rename(tmpfilename, name + '.pack')
+            idx = util.atomictempfile(name + '.idx', 'wb')
+            idx.write(index)
+            idx.rename()
+        return name + '.pack'
+    finally:
+        if os.path.exists(tmpfilename):
+            os.unlink(tmpfilename)
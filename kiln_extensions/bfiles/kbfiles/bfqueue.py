@@ -0,0 +1,254 @@
+'''Background upload queue for big files.
+
+With [kilnbfiles] uploadqueue enabled, every commit queues the big files
+it adds for upload to the default push store.  When the command exits
+(however many commits it made, as convert, rebase or MQ do), a
+background "hg kbfupload" is started to drain the queue, unless one is
+already draining it.  push then only has to wait for the uploads that
+are still queued when it runs.
+
+The queue is the directory .hg/kilnbfiles/uploads: one file per hash,
+containing the path of the store it goes to.  A file is only removed
+once the store confirms that it has the hash, so the queue survives
+crashes and failed uploads are retried by the next worker.  Only one
+process drains the queue at a time (.hg/kilnbfiles/upload.lock); it
+uploads with [kilnbfiles] uploadworkers connections (default: 2) and at
+most [kilnbfiles] uploadrate KB/s (default: no limit).
+'''
+
+import os
+import time
+import atexit
+import threading
+import subprocess
+
+from mercurial import util, error, lock as lock_
+from mercurial.i18n import _
+
+import bfutil, basestore
+
+def enabled(ui):
+    return ui.configbool(bfutil.long_name, 'uploadqueue', False)
+
+def queuedir(repo):
+    return repo.join(os.path.join(bfutil.long_name, 'uploads'))
+
+def enqueue(repo, hashes):
+    '''Queue hashes for upload to the default push store.  Return False
+    if there is no such store.'''
+    path = repo.ui.expandpath('default-push', 'default')
+    if path in ('default-push', 'default'):
+        return False
+    bfutil.create_dir(queuedir(repo))
+    for hash in hashes:
+        entry = os.path.join(queuedir(repo), hash)
+        if not os.path.exists(entry):
+            fd = util.atomictempfile(entry, 'wb')
+            fd.write(path + '\n')
+            fd.rename()
+    return True
+
+def pending(repo):
+    '''Return {hash: store path} for every queued upload.'''
+    try:
+        names = os.listdir(queuedir(repo))
+    except OSError:
+        return {}
+    queue = {}
+    for name in names:
+        # skip the temporary files of enqueue()
+        if len(name) != 40:
+            continue
+        lines = bfutil._readlines(os.path.join(queuedir(repo), name))
+        if lines:
+            queue[name] = lines[0]
+    return queue
+
+# Roots of the repositories for which a drainer is started at exit.
+_scheduled = set()
+
+def schedule(repo):
+    '''Start a drainer for repo when this process exits.'''
+    if repo.root not in _scheduled:
+        _scheduled.add(repo.root)
+        atexit.register(_spawnatexit, repo)
+
+def _spawnatexit(repo):
+    try:
+        spawn(repo)
+    except EnvironmentError:
+        # The queue stays, for the next commit or push to drain.
+        pass
+
+def spawn(repo):
+    '''Start a detached "hg kbfupload" for repo, unless some process is
+    draining its queue already: that one keeps going until the queue is
+    empty.  Its output goes to .hg/kilnbfiles/upload.log.'''
+    lock = _lock(repo)
+    if lock is None:
+        return
+    lock.release()
+    log = open(repo.join(os.path.join(bfutil.long_name, 'upload.log')), 'a')
+    try:
+        kwargs = {}
+        if os.name == 'posix':
+            kwargs['preexec_fn'] = os.setsid
+            kwargs['close_fds'] = True
+        subprocess.Popen([util.hgexecutable() or 'hg', '-R', repo.root, 'kbfupload'],
+                         stdin=open(os.devnull), stdout=log,
+                         stderr=subprocess.STDOUT, **kwargs)
+    finally:
+        log.close()
+
+def run(ui, repo):
+    '''Drain the queue until it is empty, unless some other process is
+    already draining it.  Failed uploads stay queued.'''
+    failed = set()
+    while True:
+        todo = [hash for hash in pending(repo) if hash not in failed]
+        if not todo:
+            return
+        result = drain(ui, repo, todo)
+        if result is None:
+            return
+        failed.update(result)
+
+def wait(ui, repo, dest, hashes):
+    '''Wait until none of hashes is queued for upload to dest (the path
+    of the repository pushed to), draining the queue ourselves when no
+    other process does.  Abort if some of them cannot be uploaded.
+    Return the hashes that were not queued for dest.
+
+    Queued paths are compared with dest as strings: opening them to
+    compare what they resolve to would cost a round trip per path.  A
+    hash queued under another spelling of dest is simply returned, for
+    the caller to upload.'''
+    queue = pending(repo)
+    dest = dest.rstrip('/')
+    queued = set([hash for hash in hashes
+                  if hash in queue and queue[hash].rstrip('/') == dest])
+
+    while True:
+        left = [hash for hash in queued
+                if os.path.exists(os.path.join(queuedir(repo), hash))]
+        if not left:
+            break
+        failed = drain(ui, repo, left)
+        if failed is None:
+            ui.progress(_('Waiting for queued uploads'), len(queued) - len(left),
+                        unit=_('bfile'), total=len(queued))
+            time.sleep(0.5)
+        elif failed:
+            raise util.Abort(_('could not upload %d queued big files')
+                             % len(failed))
+    ui.progress(_('Waiting for queued uploads'), None)
+    return [hash for hash in hashes if hash not in queued]
+
+def _lock(repo):
+    try:
+        return lock_.lock(repo.join(os.path.join(bfutil.long_name, 'upload.lock')), 0)
+    except error.LockHeld:
+        return None
+
+def drain(ui, repo, hashes):
+    '''Upload the queued hashes among hashes.  Return the list of those
+    that failed, or None if another process is draining the queue.'''
+    lock = _lock(repo)
+    if lock is None:
+        return None
+    try:
+        return _drain(ui, repo, hashes)
+    finally:
+        lock.release()
+
+def _drain(ui, repo, hashes):
+    queue = pending(repo)
+    bypath = {}
+    for hash in hashes:
+        if hash in queue:
+            bypath.setdefault(queue[hash], []).append(hash)
+
+    workers = int(ui.config(bfutil.long_name, 'uploadworkers', '2') or 2)
+    rate = int(ui.config(bfutil.long_name, 'uploadrate', '0') or 0)
+    limiter = rate and ratelimiter(rate * 1024) or None
+
+    failed = []
+    for path, hashes in sorted(bypath.iteritems()):
+        try:
+            store = basestore._open_store(repo, path, put=True)
+        except (error.RepoError, util.Abort, EnvironmentError), err:
+            ui.warn(_('could not upload %d big files to %s: %s\n')
+                    % (len(hashes), path, err))
+            failed.extend(hashes)
+            continue
+        # Local stores are filled by push itself, see upload_bfiles().
+        if not store.url.startswith('http'):
+            for hash in hashes:
+                _dequeue(repo, hash)
+            continue
+        store.ratelimit = limiter
+
+        todo = []
+        for hash in hashes:
+            path = bfutil.find_file(repo, hash)
+            if path is None:
+                ui.warn(_('queued bfile %s is missing from the caches\n') % hash)
+                failed.append(hash)
+            else:
+                todo.append((hash, path))
+
+        def upload(item):
+            hash, path = item
+            try:
+                # Decompress each file only when its turn comes, so that
+                # at most one temporary copy per worker is on disk.
+                source, temporary = bfutil.raw_file(repo, hash, path)
+                try:
+                    store.put(source, hash)
+                finally:
+                    if temporary:
+                        os.unlink(source)
+                # ask the store itself, not its ledger
+                if not store._verify(hash):
+                    return _('store did not keep it')
+            except Exception, err:
+                return str(err) or err.__class__.__name__
+            return None
+
+        at = 0
+        for (hash, path), err in bfutil.threadmap(upload, todo, workers):
+            store.flush()
+            ui.progress(_('Uploading bfiles'), at, unit=_('bfile'), total=len(todo))
+            at += 1
+            if err is None:
+                _dequeue(repo, hash)
+            else:
+                ui.warn(_('could not upload %s: %s\n') % (hash, err))
+                failed.append(hash)
+        ui.progress(_('Uploading bfiles'), None)
+    return failed
+
+def _dequeue(repo, hash):
+    try:
+        os.unlink(os.path.join(queuedir(repo), hash))
+    except OSError:
+        pass
+
+class ratelimiter(object):
+    '''Limit the combined throughput of several threads to rate bytes
+    per second.'''
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.next = time.time()
+
+    def consume(self, size):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.next = max(self.next, now) + size / self.rate
+            delay = self.next - now
+        finally:
+            self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
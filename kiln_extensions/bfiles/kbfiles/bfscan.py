@@ -0,0 +1,255 @@
+'''Integrity scan of the local big file caches.
+
+scan() re-hashes every object, loose or packed, in a set of cache
+directories with a pool of worker processes, and moves the objects that
+do not match their hash into the .quarantine directory of their cache,
+where nothing looks for them.  A damaged object in a pack takes the
+whole pack to quarantine, after its intact objects have been put back
+into the cache as loose objects.
+
+Objects are checked in a fixed order, and the last one checked is
+recorded in a checkpoint every few seconds, so an interrupted scan
+carries on where it stopped the next time it runs.  Workers read at
+most [kilnbfiles] fsckrate KB/s between them (default: no limit) at low
+priority, so that a scan can run from cron without getting in the way.
+'''
+
+import os
+import re
+import time
+import errno
+import zlib
+import tempfile
+import binascii
+import itertools
+
+from mercurial import util
+from mercurial.i18n import _
+
+import bfutil, bfqueue
+
+_objectname = re.compile(r'^[0-9a-f]{40}(\.z)?$')
+_checkpointinterval = 5
+
+def _objects(cachedir):
+    '''Return the sorted (name, path) pairs of the objects in cachedir,
+    where name is what the object is checked by.'''
+    objects = []
+    for name in os.listdir(cachedir):
+        if _objectname.match(name):
+            objects.append((name, os.path.join(cachedir, name)))
+    for pack in bfutil.list_packs(cachedir):
+        packname = os.path.basename(pack)
+        for hash, offset, length, size in bfutil.pack_entries(pack):
+            objects.append(('%s/%s' % (packname, hash), os.path.join(pack, hash)))
+    return sorted(objects)
+
+# Per worker process state, set up by _initworker().
+_limiter = None
+
+def _initworker(rate):
+    global _limiter
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(10)
+        except OSError:
+            pass
+    _limiter = rate and bfqueue.ratelimiter(rate) or None
+
+def _check(path):
+    '''Return (path, hash of the object at path or None if it cannot be
+    read, size read).'''
+    hasher = util.sha1('')
+    size = 0
+    try:
+        for data in bfutil.cachedstream(path):
+            if _limiter:
+                _limiter.consume(len(data))
+            hasher.update(data)
+            size += len(data)
+    except (IOError, zlib.error, util.Abort):
+        return (path, None, size)
+    return (path, hasher.hexdigest(), size)
+
+def _gone(path):
+    '''Return True if the object at path, which could not be read, was
+    removed after it was listed.  (Objects that a concurrent repack moved
+    are read from their new pack, see bfutil.cachedstream().)'''
+    if bfutil.is_packed(path):
+        return not os.path.exists(os.path.dirname(path))
+    return not os.path.exists(path)
+
+def _pool(workers, rate):
+    '''Return a function like itertools.imap that maps over a pool of
+    worker processes, or over threads where processes are unavailable.'''
+    try:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers, _initworker, (rate / workers,))
+        return (lambda fn, items: pool.imap(fn, items, 16)), pool.terminate
+    except (ImportError, OSError, NotImplementedError):
+        _initworker(rate)
+        def imap(fn, items):
+            for item, result in bfutil.threadmap(fn, items, workers):
+                yield result
+        return imap, lambda: None
+
+def scan(ui, caches, restart=False):
+    '''Check every object in caches, a list of (cachedir, lock) pairs
+    where lock is True for the system cache, whose objects are changed
+    under their locks.  Unless restart is True, carry on from where the
+    last interrupted scan of the same caches stopped.  Return (checked,
+    size, damaged).'''
+    cachedirs = [cachedir for (cachedir, lock) in caches]
+    checkpoint = os.path.join(
+        os.path.dirname(bfutil.system_cache_path(ui, 'x')), '.fsck',
+        util.sha1('\0'.join(cachedirs)).hexdigest())
+    resumeat = None
+    if not restart and os.path.exists(checkpoint):
+        resumeat = _readcheckpoint(checkpoint)
+        if resumeat is not None:
+            ui.status(_('resuming interrupted check\n'))
+
+    # Objects are keyed by (index of their cache in caches, name), which
+    # is the order they are checked in.
+    items = []
+    for i, (cachedir, lock) in enumerate(caches):
+        for name, path in _objects(cachedir):
+            key = (i, name)
+            if resumeat is None or key > resumeat:
+                items.append((key, path, cachedir, lock))
+
+    workers = bfutil.get_workers(ui)
+    rate = int(ui.config(bfutil.long_name, 'fsckrate', 0) or 0) * 1024
+    imap, stop = _pool(workers, rate)
+    ui.status(_('checking %d big files\n') % len(items))
+    checked = 0
+    size = 0
+    damaged = 0
+    bad = []
+    quarantined = set()
+    lastcheckpoint = time.time()
+    try:
+        results = imap(_check, [item[1] for item in items])
+        for (key, path, cachedir, lock), (path, hash, objsize) in \
+                itertools.izip(items, results):
+            ui.progress(_('Checking bfiles'), checked, unit=_('bfile'),
+                        total=len(items))
+            checked += 1
+            size += objsize
+            if os.path.dirname(path) in quarantined:
+                # Checked when its pack was unpacked.
+                continue
+            if hash is None and _gone(path):
+                # Not damaged, just removed while the scan was running.
+                ui.note(_('%s: removed during the check\n') % path)
+                continue
+            if hash != os.path.basename(path)[:40]:
+                if hash is None:
+                    ui.warn(_('%s: unreadable\n') % path)
+                else:
+                    ui.warn(_('%s: content hashes to %s\n') % (path, hash))
+                damaged += 1
+                bad.append((path, cachedir, lock))
+            if time.time() - lastcheckpoint > _checkpointinterval:
+                quarantined.update(_quarantine(ui, bad))
+                bad = []
+                _writecheckpoint(checkpoint, key)
+                lastcheckpoint = time.time()
+        ui.progress(_('Checking bfiles'), None)
+        _quarantine(ui, bad)
+    finally:
+        stop()
+    try:
+        os.unlink(checkpoint)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+    return (checked, size, damaged)
+
+def _readcheckpoint(checkpoint):
+    '''Return the key of the last object checked, from checkpoint, or
+    None if it cannot be read.'''
+    try:
+        index, name = open(checkpoint, 'rb').read().split('\0', 1)
+        return (int(index), name)
+    except ValueError:
+        return None
+
+def _writecheckpoint(checkpoint, key):
+    bfutil.create_dir(os.path.dirname(checkpoint))
+    fd = util.atomictempfile(checkpoint, 'wb')
+    fd.write('%d\0%s' % key)
+    fd.rename()
+
+def _quarantine(ui, bad):
+    '''Move the damaged objects in bad, a list of (path, cachedir, lock)
+    triples, to quarantine.  Return the packs that were moved.'''
+    packs = {}
+    for path, cachedir, lock in bad:
+        qdir = os.path.join(cachedir, '.quarantine')
+        bfutil.create_dir(qdir)
+        if bfutil.is_packed(path):
+            packs.setdefault(os.path.dirname(path), (cachedir, lock, set()))[2].add(
+                os.path.basename(path))
+            continue
+        objlock = lock and bfutil.lock_system_cache(ui, os.path.basename(path)[:40])
+        try:
+            try:
+                os.rename(path, os.path.join(qdir, os.path.basename(path)))
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                continue
+        finally:
+            if objlock:
+                objlock.release()
+        ui.warn(_('%s: moved to %s\n') % (path, qdir))
+    moved = []
+    for pack, (cachedir, lock, hashes) in sorted(packs.iteritems()):
+        if _quarantinepack(ui, pack, hashes, cachedir, lock):
+            moved.append(pack)
+    return moved
+
+def _quarantinepack(ui, pack, badhashes, cachedir, lock):
+    '''Move pack to quarantine and put its intact objects back into
+    cachedir as loose objects.  Return False if pack has gone already
+    (repacked since it was checked: the next scan will find its damaged
+    objects in their new pack).'''
+    qdir = os.path.join(cachedir, '.quarantine')
+    qpack = os.path.join(qdir, os.path.basename(pack))
+    packlock = bfutil.filelock(os.path.join(bfutil.pack_dir(cachedir), 'lock'))
+    try:
+        idx = pack[:-len('.pack')] + '.idx'
+        if not os.path.exists(idx):
+            return False
+        # The index first, so that nobody finds a pack that is gone.
+        os.rename(idx, qpack[:-len('.pack')] + '.idx')
+        os.rename(pack, qpack)
+    finally:
+        packlock.release()
+    restored = 0
+    for hash, offset, length, size in bfutil.pack_entries(qpack):
+        if hash in badhashes:
+            continue
+        (tmpfd, tmpfilename) = tempfile.mkstemp(dir=cachedir, prefix='.tmp-' + hash)
+        try:
+            try:
+                actual = binascii.hexlify(bfutil.copy_and_hash(
+                    bfutil.cachedstream(os.path.join(qpack, hash)),
+                    os.fdopen(tmpfd, 'wb')))
+            except (IOError, zlib.error, util.Abort):
+                actual = None
+            if actual != hash:
+                ui.warn(_('%s: damaged\n') % os.path.join(pack, hash))
+            elif lock:
+                bfutil.put_in_system_cache(ui, hash, tmpfilename, move=True)
+                restored += 1
+            else:
+                os.rename(tmpfilename, os.path.join(cachedir, hash))
+                restored += 1
+        finally:
+            if os.path.exists(tmpfilename):
+                os.unlink(tmpfilename)
+    ui.warn(_('%s: moved to %s (%d intact big files unpacked)\n')
+            % (pack, qdir, restored))
+    return True
@@ -8,7 +8,7 @@ from mercurial import hg, extensions, commands, util, context, cmdutil, \
         match as match_, filemerge, node, archival, httprepo, error
 from mercurial.i18n import _
 from mercurial.node import hex
-import bfutil, bfcommands
+import bfutil, bfcommands, bfindex, bfqueue
 
 def hgversion():
     from mercurial.__version__ import version
@@ -107,39 +107,55 @@ def reposetup(ui, repo):
                 except TypeError:
                     result = super(bfiles_repo, self).status(node1, node2, m, True, True, True)
                 if working:
-                    # Hold the wlock while we read bfiles and update the bfdirstate
-                    wlock = repo.wlock()
-                    try:
-                        # Any non bfiles that were explicitly listed must be taken out or
-                        # bfdirstate.status will report an error. The status of these files
-                        # was already computed using super's status.
+                    # Like the dirstate, the bfdirstate is read and bfiles
+                    # are hashed without the wlock, so that a slow status
+                    # does not hold up other commands.  Only rebuilding a
+                    # missing bfdirstate needs the lock.
+                    if os.path.exists(self.join(os.path.join(bfutil.long_name, 'dirstate'))):
                         bfdirstate = bfutil.open_bfdirstate(ui, self)
-                        match._files = [f for f in match._files if f in bfdirstate]
-                        s = bfdirstate.status(match, [], listignored, listclean, listunknown)
-                        (unsure, modified, added, removed, missing, unknown, ignored, clean) = s
-                        if parentworking:
-                            for bfile in unsure:
-                                if ctx1[bfutil.standin(bfile)].data().strip() != bfutil.hashfile(self.wjoin(bfile)):
+                    else:
+                        wlock = repo.wlock()
+                        try:
+                            bfdirstate = bfutil.open_bfdirstate(ui, self)
+                        finally:
+                            wlock.release()
+                    # Any non bfiles that were explicitly listed must be taken out or
+                    # bfdirstate.status will report an error. The status of these files
+                    # was already computed using super's status.
+                    match._files = [f for f in match._files if f in bfdirstate]
+                    # Unknown and ignored files come from super's status
+                    # below, so bfdirstate need not walk the working copy
+                    # (and can consult the kbfwatch daemon instead).
+                    s = bfdirstate.status(match, [], False, listclean, False)
+                    (unsure, modified, added, removed, missing, unknown, ignored, clean) = s
+                    hashes1 = bfindex.hashes(self, ctx1)
+                    if parentworking:
+                        checked = []
+                        for bfile in unsure:
+                            # Taken before hashing, so that a change made
+                            # while we hash is not marked clean.
+                            key = bfutil.stat_key(self, bfile)
+                            if (bfutil.size_changed(self, bfile, hashes1.get(bfile)) or
+                                hashes1.get(bfile) != bfutil.hashfile(self.wjoin(bfile))):
+                                modified.append(bfile)
+                            else:
+                                clean.append(bfile)
+                                checked.append((bfile, key))
+                        if checked:
+                            bfutil.mark_clean(ui, self, checked)
+                    else:
+                        tocheck = unsure + modified + added + clean
+                        modified, added, clean = [], [], []
+
+                        for bfile in tocheck:
+                            if bfile in hashes1:
+                                if (bfutil.size_changed(self, bfile, hashes1[bfile]) or
+                                    hashes1[bfile] != bfutil.hashfile(self.wjoin(bfile))):
                                     modified.append(bfile)
                                 else:
                                     clean.append(bfile)
-                                    bfdirstate.normal(bfutil.unixpath(bfile))
-                            bfdirstate.write()
-                        else:
-                            tocheck = unsure + modified + added + clean
-                            modified, added, clean = [], [], []
-
-                            for bfile in tocheck:
-                                standin = bfutil.standin(bfile)
-                                if inctx(standin, ctx1):
-                                    if ctx1[standin].data().strip() != bfutil.hashfile(self.wjoin(bfile)):
-                                        modified.append(bfile)
-                                    else:
-                                        clean.append(bfile)
-                                else:
-                                    added.append(bfile)
-                    finally:
-                        wlock.release()
+                            else:
+                                added.append(bfile)
 
                     for standin in ctx1.manifest():
                         if not bfutil.is_standin(standin):
@@ -152,10 +168,10 @@ def reposetup(ui, repo):
                     # Handle unknown and ignored differently
                     bfiles = (modified, added, removed, missing, [], [], clean)
                     result = list(result)
-                    # Unknown files
-                    result[4] = [f for f in unknown if repo.dirstate[f] == '?' and not bfutil.is_standin(f)]
+                    # Unknown files must be unknown to both the dirstate and bfdirstate
+                    result[4] = [f for f in result[4] if f not in bfdirstate and not bfutil.is_standin(f)]
                     # Ignored files must be ignored by both the dirstate and bfdirstate
-                    result[5] = set(ignored).intersection(set(result[5]))
+                    result[5] = [f for f in result[5] if f not in bfdirstate]
                     # combine normal files and bfiles
                     normals = [[fn for fn in filelist if not bfutil.is_standin(fn)] for filelist in result]
                     result = [sorted(list1 + list2) for (list1, list2) in zip(normals, bfiles)]
@@ -180,10 +196,15 @@ def reposetup(ui, repo):
         def commitctx(self, *args, **kwargs):
             node = super(bfiles_repo, self).commitctx(*args, **kwargs)
             ctx = self[node]
+            hashes = []
             for filename in ctx.files():
                 if bfutil.is_standin(filename) and filename in ctx.manifest():
                     realfile = bfutil.split_standin(filename)
                     bfutil.copy_to_cache(self, ctx.node(), realfile)
+                    hashes.append(bfutil.standin_hash(ctx[filename].data()))
+
+            if hashes and bfqueue.enabled(ui) and bfqueue.enqueue(self, hashes):
+                bfqueue.schedule(self)
 
             return node
 
@@ -201,11 +222,20 @@ def reposetup(ui, repo):
                 if (match is None) or (not match.anypats() and not match.files()):
                     bfiles = bfutil.list_bfiles(self)
                     bfdirstate = bfutil.open_bfdirstate(ui, self)
+                    # Only the big files that bfdirstate does not know to be
+                    # clean can need their standins refreshed.
+                    s = bfdirstate.status(match_.always(self.root, self.getcwd()), [], False, False, False)
+                    (unsure, modified, added, removed, missing, unknown, ignored, clean) = s
+                    dirty = set(unsure + modified + added)
                     # this only loops through bfiles that exist (not removed/renamed)
-                    for bfile in bfiles:
-                        if os.path.exists(self.wjoin(bfutil.standin(bfile))):
-                            bfutil.update_standin(self, bfutil.standin(bfile))
-                            bfdirstate.normal(bfutil.unixpath(bfile))
+                    torefresh = [bfile for bfile in bfiles
+                                 if (bfile in dirty or bfile not in bfdirstate) and
+                                    os.path.exists(self.wjoin(bfutil.standin(bfile)))]
+                    def refresh(bfile):
+                        bfutil.update_standin(self, bfutil.standin(bfile), cache=True)
+                    for bfile, result in bfutil.threadmap(refresh, torefresh,
+                                                          bfutil.get_workers(ui)):
+                        bfdirstate.normal(bfutil.unixpath(bfile))
                     for bfile in bfdirstate:
                         if not os.path.exists(repo.wjoin(bfutil.standin(bfile))):
                             bfdirstate.forget(bfutil.unixpath(bfile))
@@ -238,7 +268,7 @@ def reposetup(ui, repo):
                 for standin in standins:
                     bfile = bfutil.split_standin(standin)
                     if bfdirstate[bfile] is not 'r':
-                        bfutil.update_standin(self, standin)
+                        bfutil.update_standin(self, standin, cache=True)
                         bfdirstate.normal(bfutil.unixpath(bfile))
                     else:
                         bfdirstate.forget(bfutil.unixpath(bfile))
@@ -287,30 +317,10 @@ def reposetup(ui, repo):
                 wlock.release()
 
         def push(self, remote, force=False, revs=None, newbranch=False):
-            o = bfutil.findoutgoing(repo, remote, force)
-            if o:
-                toupload = set()
-                o = repo.changelog.nodesbetween(o, revs)[0]
-                for n in o:
-                    parents = [p for p in repo.changelog.parents(n) if p != node.nullid]
-                    ctx = repo[n]
-                    files = set(ctx.files())
-                    if len(parents) == 2:
-                        mc = ctx.manifest()
-                        mp1 = ctx.parents()[0].manifest()
-                        mp2 = ctx.parents()[1].manifest()
-                        for f in mp1:
-                            if f not in mc:
-                                files.add(f)
-                        for f in mp2:
-                            if f not in mc:
-                                files.add(f)
-                        for f in mc:
-                            if mc[f] != mp1.get(f, None) or mc[f] != mp2.get(f, None):
-                                files.add(f)
-
-                    toupload = toupload.union(set([ctx[f].data().strip() for f in files if bfutil.is_standin(f) and f in ctx]))
-                bfcommands.upload_bfiles(ui, self, remote, toupload)
+            outgoing = bfcommands.outgoing_bfiles(repo, remote, revs, force)
+            if outgoing:
+                sizes = dict([(hash, size) for (bfile, hash, size) in outgoing])
+                bfcommands.upload_bfiles(ui, self, remote, set(sizes), sizes)
             # Mercurial >= 1.6 takes the newbranch argument, try that first.
             try:
                 return super(bfiles_repo, self).push(remote, force, revs, newbranch)
@@ -486,6 +496,8 @@ def override_status(orig, ui, repo, *pats, **opts):
         repo.bfstatus = False
 
 def override_verify(orig, ui, repo, *pats, **opts):
+    if opts.pop('bf_recheck', False):
+        ui.setconfig(bfutil.long_name, 'recheck', 'true')
     bf = opts.pop('bf', False)
     all = opts.pop('bfa', False)
     contents = opts.pop('bfc', False)
@@ -511,7 +523,9 @@ def override_update(orig, ui, repo, *pats, **opts):
             mod = len(modified) > 0
             for bfile in unsure:
                 standin = bfutil.standin(bfile)
-                if repo['.'][standin].data().strip() != bfutil.hashfile(repo.wjoin(bfile)):
+                hash = bfutil.standin_hash(repo['.'][standin].data())
+                if (bfutil.size_changed(repo, bfile, hash) or
+                    hash != bfutil.hashfile(repo.wjoin(bfile))):
                     mod = True
                 else:
                     bfdirstate.normal(bfutil.unixpath(bfile))
@@ -547,9 +561,11 @@ def override_filemerge(origfn, repo, mynode, orig, fcd, fco, fca):
         else:
             repo.ui.status(_('merging %s\n') % bfutil.split_standin(fcdest.path()))
 
-        if fcancestor.path() != fcother.path() and fcother.data() == fcancestor.data():
+        if (fcancestor.path() != fcother.path() and
+            bfutil.standin_hash(fcother.data()) == bfutil.standin_hash(fcancestor.data())):
             return 0
-        if fcancestor.path() != fcdest.path() and fcdest.data() == fcancestor.data():
+        if (fcancestor.path() != fcdest.path() and
+            bfutil.standin_hash(fcdest.data()) == bfutil.standin_hash(fcancestor.data())):
             repo.wwrite(fcdest.path(), fcother.data(), fcother.flags())
             return 0
 
@@ -731,24 +747,28 @@ def override_revert(orig, ui, repo, *pats, **opts):
         bfcommands.revert_bfiles(ui, repo)
         for bfile in modified:
             if os.path.exists(repo.wjoin(bfutil.standin(bfile))) and bfile in repo['.']:
-                bfutil.write_standin(repo, bfutil.standin(bfile), repo['.'][bfile].data().strip(), 'x' in repo['.'][bfile].flags())
+                (hash, size) = bfutil.parse_standin(repo['.'][bfile].data())
+                bfutil.write_standin(repo, bfutil.standin(bfile), hash, 'x' in repo['.'][bfile].flags(), size)
     finally:
         wlock.release()
 
 def hg_update(orig, repo, node):
+    oldnode = repo.dirstate.parents()[0]
     result = orig(repo, node)
     # XXX check if it worked first
-    bfcommands.update_bfiles(repo.ui, repo)
+    bfcommands.update_bfiles(repo.ui, repo, oldnode, repo.dirstate.parents()[0])
     return result
 
 def hg_clean(orig, repo, node, show_stats=True):
+    oldnode = repo.dirstate.parents()[0]
     result = orig(repo, node, show_stats)
-    bfcommands.update_bfiles(repo.ui, repo)
+    bfcommands.update_bfiles(repo.ui, repo, oldnode, repo.dirstate.parents()[0])
     return result
 
 def hg_merge(orig, repo, node, force=None, remind=True):
+    oldnode = repo.dirstate.parents()[0]
     result = orig(repo, node, force, remind)
-    bfcommands.update_bfiles(repo.ui, repo)
+    bfcommands.update_bfiles(repo.ui, repo, oldnode, repo.dirstate.parents()[1])
     return result
 
 # When we rebase a repository with remotely changed bfiles, we need
@@ -820,17 +840,18 @@ def override_archive(orig, repo, dest, node, kind, decode=True, matchfn=None,
 
         write('.hg_archival.txt', 0644, False, metadata)
 
+    bfhashes = bfindex.hashes(repo, ctx)
+    bfpaths = bfutil.resolver(repo).find(bfhashes.values())
     for f in ctx:
         ff = ctx.flags(f)
         getdata = ctx[f].data
         if bfutil.is_standin(f):
-            path = bfutil.find_file(repo, getdata().strip())
+            path = bfpaths[bfhashes[bfutil.split_standin(f)]]
             ### TODO: What if the file is not cached?
             f = bfutil.split_standin(f)
 
             def getdatafn():
-                with open(path, 'rb') as fd:
-                    return fd.read()
+                return ''.join(bfutil.cachedstream(path))
 
             getdata = getdatafn
         write(f, 'x' in ff and 0755 or 0644, 'l' in ff, getdata)
@@ -928,56 +949,47 @@ def get_outgoing_bfiles(ui, repo, dest=None, **opts):
         remote = hg.repository(remoteui(repo, opts), dest)
     except error.RepoError:
         return None
-    o = bfutil.findoutgoing(repo, remote, False)
-    if not o:
-        return None
-    o = repo.changelog.nodesbetween(o, revs)[0]
-    if opts.get('newest_first'):
-        o.reverse()
-
-    toupload = set()
-    for n in o:
-        parents = [p for p in repo.changelog.parents(n) if p != node.nullid]
-        ctx = repo[n]
-        files = set(ctx.files())
-        if len(parents) == 2:
-            mc = ctx.manifest()
-            mp1 = ctx.parents()[0].manifest()
-            mp2 = ctx.parents()[1].manifest()
-            for f in mp1:
-                if f not in mc:
-                        files.add(f)
-            for f in mp2:
-                if f not in mc:
-                    files.add(f)
-            for f in mc:
-                if mc[f] != mp1.get(f, None) or mc[f] != mp2.get(f, None):
-                    files.add(f)
-        toupload = toupload.union(set([f for f in files if bfutil.is_standin(f) and f in ctx]))
-    return toupload
+    return bfcommands.outgoing_bfiles(repo, remote, revs)
+
+def _outgoing_size(outgoing):
+    '''Return the total size of the distinct big file revisions in
+    outgoing, counting those that are in no local cache as empty.'''
+    sizes = dict([(hash, size) for (bfile, hash, size) in outgoing])
+    return util.bytecount(sum([size or 0 for size in sizes.itervalues()]))
+
+def override_push(orig, ui, repo, dest=None, **opts):
+    if opts.pop('bf_recheck', False):
+        ui.setconfig(bfutil.long_name, 'recheck', 'true')
+    return orig(ui, repo, dest, **opts)
 
 def override_outgoing(orig, ui, repo, dest=None, **opts):
     orig(ui, repo, dest, **opts)
 
     if opts.pop('bf', None):
-        toupload = get_outgoing_bfiles(ui, repo, dest, **opts)
-        if toupload is None:
+        outgoing = get_outgoing_bfiles(ui, repo, dest, **opts)
+        if outgoing is None:
             ui.status(_('kbfiles: No remote repo\n'))
         else:
             ui.status(_('kbfiles to upload:\n'))
-            for file in toupload:
-                ui.status(bfutil.split_standin(file) + '\n')
+            for file in sorted(set([bfile for (bfile, hash, size) in outgoing])):
+                ui.status(file + '\n')
+            ui.note(_('total: %s\n') % _outgoing_size(outgoing))
             ui.status('\n')
 
 def override_summary(orig, ui, repo, *pats, **opts):
     orig(ui, repo, *pats, **opts)
 
     if opts.pop('bf', None):
-        toupload = get_outgoing_bfiles(ui, repo, None, **opts)
-        if toupload is None:
+        outgoing = get_outgoing_bfiles(ui, repo, None, **opts)
+        if outgoing is None:
             ui.status(_('kbfiles: No remote repo\n'))
         else:
-            ui.status(_('kbfiles: %d to upload\n') % len(toupload))
+            count = len(set([bfile for (bfile, hash, size) in outgoing]))
+            if ui.verbose:
+                ui.status(_('kbfiles: %d to upload (%s)\n')
+                          % (count, _outgoing_size(outgoing)))
+            else:
+                ui.status(_('kbfiles: %d to upload\n') % count)
 
 def override_addremove(orig, ui, repo, *pats, **opts):
     # Check if the parent or child has bfiles if they do don't allow it.
@@ -1017,9 +1029,14 @@ def uisetup(ui):
     entry = extensions.wrapcommand(commands.table, 'verify', override_verify)
     verifyopt = [('', 'bf', None, _('verify bfiles')),
                  ('', 'bfa', None, _('verify all revisions of bfiles not just current')),
-                 ('', 'bfc', None, _('verify bfile contents not just existence'))]
+                 ('', 'bfc', None, _('verify bfile contents not just existence')),
+                 ('', 'bf-recheck', None, _('ask the store about every bfile, even those known to be there'))]
     entry[1].extend(verifyopt)
 
+    entry = extensions.wrapcommand(commands.table, 'push', override_push)
+    pushopt = [('', 'bf-recheck', None, _('ask the store about every bfile, even those known to be there'))]
+    entry[1].extend(pushopt)
+
     entry = extensions.wrapcommand(commands.table, 'outgoing', override_outgoing)
     outgoingopt = [('', 'bf', None, _('display outgoing bfiles'))]
     entry[1].extend(outgoingopt)
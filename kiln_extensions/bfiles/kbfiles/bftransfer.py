@@ -0,0 +1,222 @@
+'''kbftransferd: a machine-wide daemon that downloads big files into the
+system cache on behalf of every hg process on the machine.
+
+Clients talk to it over a Unix socket ([kilnbfiles] transfersocket, by
+default .transfer.sock in the system cache).  A client sends the URL of
+a store and the hashes it wants, one per line, followed by an empty
+line.  The daemon answers with one "<hash> ok" or "<hash> error <detail>"
+line per hash, in the order the downloads finish.  Several clients
+asking for the same hash at the same time share a single download.
+
+If no daemon is running, or it does not answer within [kilnbfiles]
+transfertimeout seconds (default 60), clients simply download the files
+themselves.
+'''
+
+import os
+import re
+import socket
+import tempfile
+import threading
+import binascii
+import SocketServer
+
+from mercurial import util
+from mercurial.i18n import _
+
+import bfutil
+
+_hashre = re.compile(r'^[0-9a-f]{40}$')
+
+def socket_path(ui):
+    path = ui.config(bfutil.long_name, 'transfersocket', None)
+    if not path:
+        path = os.path.join(os.path.dirname(bfutil.system_cache_path(ui, 'x')),
+                            '.transfer.sock')
+    return path
+
+def prefetch(ui, url, hashes):
+    '''Ask the transfer daemon to put hashes from the store at url into
+    the system cache.  Do nothing if no daemon is running; any hash it
+    fails to get is left for the caller to download.'''
+    path = socket_path(ui)
+    if not hashes or not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return
+    try:
+        timeout = float(ui.config(bfutil.long_name, 'transfertimeout', '60'))
+    except ValueError:
+        raise util.Abort(_('kilnbfiles.transfertimeout must be a number'))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error, err:
+            ui.debug('kbftransferd not reachable: %s\n' % err)
+            return
+        ui.debug('fetching %d bfiles through kbftransferd\n' % len(hashes))
+        try:
+            sock.sendall(''.join(['%s\n' % l for l in [url] + list(hashes)]) + '\n')
+            fp = sock.makefile('rb')
+            at = 0
+            for line in fp:
+                ui.progress(_('Getting kbfiles'), at, unit='kbfile', total=len(hashes))
+                at += 1
+                hash, status = line.rstrip('\n').split(' ', 1)
+                if status != 'ok':
+                    ui.debug('kbftransferd: %s: %s\n' % (hash, status))
+            fp.close()
+            ui.progress(_('Getting kbfiles'), None)
+        except socket.timeout:
+            ui.progress(_('Getting kbfiles'), None)
+            ui.debug('kbftransferd did not answer, downloading directly\n')
+        except socket.error, err:
+            ui.progress(_('Getting kbfiles'), None)
+            ui.debug('kbftransferd failed: %s\n' % err)
+    finally:
+        sock.close()
+
+class _download(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+class _handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        url = self.rfile.readline().rstrip('\n')
+        hashes = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line == '\n':
+                break
+            hashes.append(line.rstrip('\n'))
+        server = self.server.daemon
+        # Hashes become file names in the system cache: never accept
+        # anything else.
+        for hash in hashes:
+            if not _hashre.match(hash):
+                self.wfile.write('%s error invalid hash\n' % hash)
+        hashes = [hash for hash in hashes if _hashre.match(hash)]
+        fetch = lambda hash: server.fetch(url, hash)
+        for hash, error in bfutil.threadmap(fetch, hashes, server.workers):
+            if error is None:
+                self.wfile.write('%s ok\n' % hash)
+            else:
+                self.wfile.write('%s error %s\n' % (hash, error.replace('\n', ' ')))
+            self.wfile.flush()
+
+class _server(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class transferd(object):
+    def __init__(self, ui):
+        self.ui = ui
+        self.path = socket_path(ui)
+        self.workers = bfutil.get_workers(ui)
+        self.server = None
+        self.lock = threading.Lock()
+        self.inflight = {}              # hash -> _download
+        self.stores = {}                # url -> httpstore
+        # Bounds the number of simultaneous downloads over all clients.
+        self.slots = threading.Semaphore(self.workers)
+
+    def start(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise util.Abort(_('kbftransferd requires Unix domain sockets'))
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                try:
+                    probe.connect(self.path)
+                except socket.error:
+                    os.unlink(self.path)
+                else:
+                    raise util.Abort(_('kbftransferd is already running on %s')
+                                     % self.path)
+            finally:
+                probe.close()
+        bfutil.create_dir(os.path.dirname(self.path))
+        self.server = _server(self.path, _handler)
+        self.server.daemon = self
+        self.ui.status(_('listening on %s\n') % self.path)
+
+    def run(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def fetch(self, url, hash):
+        '''Put hash into the system cache, sharing the download with any
+        other client that wants it.  Return None, or an error message.'''
+        self.lock.acquire()
+        try:
+            if bfutil.in_system_cache(self.ui, hash):
+                return None
+            download = self.inflight.get(hash)
+            owner = download is None
+            if owner:
+                download = self.inflight[hash] = _download()
+        finally:
+            self.lock.release()
+
+        if not owner:
+            download.done.wait()
+            return download.error
+        try:
+            try:
+                self.slots.acquire()
+                try:
+                    download.error = self._get(url, hash)
+                finally:
+                    self.slots.release()
+            except Exception, err:
+                download.error = str(err) or err.__class__.__name__
+        finally:
+            self.lock.acquire()
+            try:
+                del self.inflight[hash]
+            finally:
+                self.lock.release()
+            download.done.set()
+        return download.error
+
+    def _store(self, url):
+        # One store (and so one opener, with its keep-alive connections)
+        # per URL, shared by all downloads from it.
+        self.lock.acquire()
+        try:
+            if url not in self.stores:
+                import httpstore
+                self.stores[url] = httpstore.httpstore(self.ui, None, url)
+            return self.stores[url]
+        finally:
+            self.lock.release()
+
+    def _get(self, url, hash):
+        import basestore
+        store = self._store(url)
+        cachedir = os.path.dirname(bfutil.system_cache_path(self.ui, hash))
+        bfutil.create_dir(cachedir)
+        (tmpfd, tmpfilename) = tempfile.mkstemp(dir=cachedir,
+                                                prefix='.tmp-' + hash)
+        tmpfile = os.fdopen(tmpfd, 'w')
+        try:
+            try:
+                hhash = binascii.hexlify(store._getfile(tmpfile, hash, hash))
+            except basestore.StoreError, err:
+                return err.detail
+            except util.Abort, err:
+                return str(err)
+            if hhash != hash:
+                return 'data corruption (got %s)' % hhash
+            bfutil.put_in_system_cache(self.ui, hash, tmpfilename, move=True)
+        finally:
+            tmpfile.close()
+            if os.path.exists(tmpfilename):
+                os.unlink(tmpfilename)
+        return None
@@ -1,13 +1,22 @@
 '''bfiles utility code: must not import other modules in this package.'''
 
 import os
+import sys
 import errno
 import inspect
+import mmap
 import shutil
 import stat
+import struct
+import tempfile
+import binascii
+import threading
+import time
+import zlib
+import Queue
 
 from mercurial import \
-    util, dirstate, cmdutil, match as match_
+    util, dirstate, cmdutil, error, match as match_
 from mercurial.i18n import _
 
 short_name = '.kbf'
@@ -76,6 +85,380 @@ def findoutgoing(repo, remote, force):
         from mercurial import discovery
         return discovery.findoutgoing(repo, remote, force=force)
 
+# -- bfiles dirstate ---------------------------------------------------
+
+_journal_format = '>cllll'
+_journal_header = 'kbfjournal %d %d %d\n'
+
+class journaleddirstate(dirstate.dirstate):
+    '''A dirstate that saves small changes by appending them to a journal
+    (dirstate.journal) instead of rewriting the whole dirstate file.
+
+    The journal starts with a header naming the inode, size and mtime of
+    the dirstate file it applies to, followed by dirstate-format entries
+    (state '?' means the file was forgotten).  It is replayed on load, and
+    discarded when its header does not match the dirstate file: that way a
+    reader racing with a compaction sees either the old dirstate plus its
+    journal or the new dirstate alone.  Once the journal holds more than
+    [kilnbfiles] journalentries entries it is folded back into the
+    dirstate file.  Like the dirstate itself, it must only be written
+    while holding the wlock.'''
+
+    def __init__(self, admin, *args):
+        dirstate.dirstate.__init__(self, *args)
+        self._admin = admin
+        self._journalpath = os.path.join(admin, 'dirstate.journal')
+        self._dirstatepath = os.path.join(admin, 'dirstate')
+        self._changed = set()
+        self._fullwrite = False
+        self._journalentries = 0
+        self._journalvalid = False
+
+    def _dirstateid(self):
+        try:
+            st = os.stat(self._dirstatepath)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        return (st.st_ino, st.st_size, int(st.st_mtime))
+
+    def _read(self):
+        dirstate.dirstate._read(self)
+        self._journalentries = 0
+        self._journalvalid = False
+        try:
+            data = open(self._journalpath, 'rb').read()
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return
+        pos = data.find('\n') + 1
+        ident = self._dirstateid()
+        if ident is None or data[:pos] != _journal_header % ident:
+            return
+        self._journalvalid = True
+
+        esize = struct.calcsize(_journal_format)
+        while pos + esize <= len(data):
+            e = struct.unpack(_journal_format, data[pos:pos + esize])
+            pos += esize
+            f = data[pos:pos + e[4]]
+            if len(f) < e[4]:
+                pos -= esize
+                break
+            pos += e[4]
+            if e[0] == '?':
+                self._map.pop(f, None)
+            else:
+                self._map[f] = e[:4]
+            self._journalentries += 1
+        if pos != len(data):
+            # A partially appended entry: the writer died part way.
+            # Appending after it would misalign every later entry, so
+            # the next write rewrites the dirstate instead.
+            self._fullwrite = True
+
+    def invalidate(self):
+        dirstate.dirstate.invalidate(self)
+        self._changed = set()
+        self._fullwrite = False
+
+    def write(self):
+        if not self._dirty:
+            return
+        try:
+            limit = int(self._ui.config(long_name, 'journalentries', 10000))
+        except ValueError:
+            limit = 10000
+        ident = self._dirstateid()
+        if (self._fullwrite or ident is None or
+            self._journalentries + len(self._changed) > limit):
+            dirstate.dirstate.write(self)
+            try:
+                os.unlink(self._journalpath)
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+            self._journalentries = 0
+            self._journalvalid = False
+        else:
+            if self._journalvalid:
+                journal = open(self._journalpath, 'ab')
+            else:
+                journal = open(self._journalpath, 'wb')
+                journal.write(_journal_header % ident)
+                self._journalentries = 0
+                self._journalvalid = True
+            try:
+                # Same trick as dirstate.write(): the journal's mtime is
+                # the filesystem's idea of "now", and a file modified in
+                # that same second must be looked at again next time.
+                now = int(util.fstat(journal).st_mtime)
+                entries = []
+                for f in sorted(self._changed):
+                    e = self._map.get(f)
+                    if e is None:
+                        e = ('?', 0, 0, 0)
+                    elif e[0] == 'n' and e[3] == now:
+                        e = (e[0], 0, -1, -1)
+                        self._map[f] = e
+                    entries.append(struct.pack(_journal_format, e[0], e[1],
+                                               e[2], e[3], len(f)))
+                    entries.append(f)
+                # A single write, so readers see all of it or a truncated
+                # tail that they ignore.
+                journal.write(''.join(entries))
+            finally:
+                journal.close()
+            self._journalentries += len(self._changed)
+        self._changed = set()
+        self._fullwrite = False
+        self._dirty = False
+
+    def status(self, match, subrepos, ignored, clean, unknown):
+        # Listing unknown or ignored files needs a full walk anyway, and
+        # that is the only thing the kbfwatch daemon could save us.
+        watch = None
+        if not ignored and not unknown:
+            watch = read_watch(self._ui, self._admin)
+        if watch is None:
+            return dirstate.dirstate.status(self, match, subrepos,
+                                            ignored, clean, unknown)
+        if watch.synced is None:
+            s = dirstate.dirstate.status(self, match, subrepos,
+                                         ignored, clean, unknown)
+        else:
+            s = self._watchedstatus(match, watch, clean)
+        if not match.files() and not match.anypats():
+            # Files that changed before the daemon started are not in
+            # its journal: remember them so we keep checking them.  This
+            # also lets the daemon drop the journal entries read so far.
+            notclean = s[0] + s[1] + s[4]
+            if (watch.synced is None or watch.synced != set(notclean) or
+                watch.offset - watch.syncedat >= _watch_compact):
+                watch.sync(notclean)
+        return s
+
+    def _watchedstatus(self, match, watch, listclean):
+        '''Like status(), but only lstat() the files that the kbfwatch
+        daemon says might have changed.'''
+        lookup, modified, added, removed, deleted, clean = [], [], [], [], [], []
+        for fn, (state, mode, size, mtime) in self._map.iteritems():
+            if not match(fn):
+                continue
+            if state == 'r':
+                removed.append(fn)
+                continue
+            st = None
+            if state != 'n' or watch.dirty(fn):
+                try:
+                    st = os.lstat(self._join(fn))
+                except OSError, err:
+                    if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                        raise
+                    deleted.append(fn)
+                    continue
+            if state == 'a':
+                added.append(fn)
+            elif state == 'm' or size == -2 or fn in self._copymap:
+                modified.append(fn)
+            elif st is None:
+                if mtime == -1:
+                    lookup.append(fn)
+                elif listclean:
+                    clean.append(fn)
+            elif (size >= 0 and
+                  (size != st.st_size
+                   or ((mode ^ st.st_mode) & 0100 and self._checkexec))):
+                modified.append(fn)
+            elif mtime != int(st.st_mtime):
+                lookup.append(fn)
+            elif listclean:
+                clean.append(fn)
+        return (lookup, modified, added, removed, deleted, [], [], clean)
+
+def _journaled(name):
+    orig = getattr(dirstate.dirstate, name)
+    def method(self, f, *args, **kwargs):
+        self._changed.add(f)
+        return orig(self, f, *args, **kwargs)
+    return method
+
+def _rewritten(name):
+    orig = getattr(dirstate.dirstate, name)
+    def method(self, *args, **kwargs):
+        self._fullwrite = True
+        return orig(self, *args, **kwargs)
+    return method
+
+for _name in ('_addpath', 'normal', 'normallookup', 'normaldirty',
+              'otherparent', 'add', 'remove', 'merge', 'forget'):
+    if hasattr(dirstate.dirstate, _name):
+        setattr(journaleddirstate, _name, _journaled(_name))
+for _name in ('setparents', 'copy', 'clear', 'rebuild'):
+    if hasattr(dirstate.dirstate, _name):
+        setattr(journaleddirstate, _name, _rewritten(_name))
+
+# -- kbfwatch client ---------------------------------------------------
+
+# Files shared with the kbfwatch daemon (see bfinotify.py), all in
+# .hg/kilnbfiles:
+#   watch.state     "<pid> <token>" then one watched directory per line
+#   watch.dirty     "<token> <base>" then one "f <file>" or "r <dir>" (every
+#                   file under dir) line per change seen since the daemon
+#                   started; base is the number of lines dropped from the
+#                   front by the daemon since then
+#   watch.synced    "<token> <offset>" then the files that were not clean
+#                   when a full status was last done under that token,
+#                   after reading the first offset lines of watch.dirty.
+#                   The daemon drops those lines when this is rewritten.
+#   watch.cookie.*  created by clients, removed by the daemon once it has
+#                   written out every event queued before the cookie's
+watch_state = 'watch.state'
+watch_dirty = 'watch.dirty'
+watch_synced = 'watch.synced'
+watch_cookie = 'watch.cookie.'
+
+# Rewrite watch.synced, and so let the daemon compact watch.dirty, once
+# this many lines were added to watch.dirty since it was last written.
+_watch_compact = 1000
+
+def _readlines(path):
+    try:
+        fd = open(path, 'rb')
+    except IOError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+    try:
+        data = fd.read()
+    finally:
+        fd.close()
+    # Ignore a partially written last line.
+    return data.split('\n')[:-1]
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno == errno.EPERM
+    return True
+
+class watchstate(object):
+    '''What the kbfwatch daemon knows about changed big files.  synced
+    is None if no full status has been done since the daemon (re)started,
+    in which case the daemon's journal alone cannot be trusted.  offset
+    is the number of journal lines read, and syncedat the number that
+    synced accounts for.'''
+    def __init__(self, admin, token, dirs, files, recursive, synced,
+                 offset, syncedat):
+        self.admin = admin
+        self.token = token
+        self.dirs = dirs
+        self.files = files
+        self.recursive = recursive
+        self.synced = synced
+        self.offset = offset
+        self.syncedat = syncedat
+
+    def dirty(self, fn):
+        '''Return True unless the daemon guarantees that fn has not
+        changed since the last full status.'''
+        if fn in self.files or fn in self.synced:
+            return True
+        dir = os.path.dirname(fn)
+        if dir not in self.dirs:
+            return True
+        while True:
+            if dir in self.recursive:
+                return True
+            if not dir:
+                return False
+            dir = os.path.dirname(dir)
+
+    def sync(self, notclean):
+        path = os.path.join(self.admin, watch_synced)
+        fd = util.atomictempfile(path, 'wb')
+        header = '%s %d' % (self.token, self.offset)
+        fd.write(''.join(['%s\n' % l for l in [header] + sorted(notclean)]))
+        fd.rename()
+
+def read_watch(ui, admin):
+    '''Return a watchstate if a kbfwatch daemon is watching this working
+    copy and has caught up with every change made so far, or None if
+    status must look at every big file.'''
+    if os.name != 'posix':
+        return None
+    state = _readlines(os.path.join(admin, watch_state))
+    if not state:
+        return None
+    try:
+        pid, token = state[0].split(' ', 1)
+        pid = int(pid)
+    except ValueError:
+        return None
+    if not _process_alive(pid):
+        return None
+
+    # Wait for the daemon to see a cookie of ours: it removes the cookie
+    # only after writing out every event queued before it, so any change
+    # made before this status started is then in watch.dirty.
+    try:
+        timeout = float(ui.config(long_name, 'watchtimeout', '2'))
+    except ValueError:
+        timeout = 2.0
+    cookie = os.path.join(admin, '%s%d' % (watch_cookie, os.getpid()))
+    open(cookie, 'wb').close()
+    deadline = time.time() + timeout
+    while os.path.exists(cookie):
+        if time.time() > deadline:
+            try:
+                os.unlink(cookie)
+            except OSError:
+                pass
+            ui.debug('kbfwatch daemon did not answer, checking all bfiles\n')
+            return None
+        time.sleep(0.005)
+
+    dirty = _readlines(os.path.join(admin, watch_dirty))
+    if not dirty:
+        return None
+    try:
+        dirtytoken, base = dirty[0].split(' ')
+        base = int(base)
+    except ValueError:
+        return None
+    if dirtytoken != token:
+        return None
+    offset = base + len(dirty) - 1
+    files, recursive, dirs = set(), set(), set(state[1:])
+    for line in dirty[1:]:
+        if line[:1] == 'f':
+            files.add(line[2:])
+        else:
+            recursive.add(line[2:])
+    # The daemon may have restarted or overflowed while we were reading.
+    again = _readlines(os.path.join(admin, watch_state))
+    if not again or again[0] != state[0]:
+        return None
+
+    # synced only accounts for the journal lines before syncedat, so
+    # the journal must still hold all of the lines after that.
+    synced = _readlines(os.path.join(admin, watch_synced))
+    syncedat = 0
+    try:
+        syncedtoken, syncedat = synced[0].split(' ')
+        syncedat = int(syncedat)
+    except (TypeError, IndexError, ValueError):
+        syncedtoken = None
+    if syncedtoken == token and base <= syncedat <= offset:
+        synced = set(synced[1:])
+    else:
+        synced = None
+    return watchstate(admin, token, dirs, files, recursive, synced,
+                      offset, syncedat)
+
 # -- Private worker functions ------------------------------------------
 
 if os.name == 'nt':
@@ -92,6 +475,113 @@ def link(src, dest):
         shutil.copyfile(src, dest)
         os.chmod(dest, os.stat(src).st_mode)
 
+# ioctl(2) request to clone a file on copy-on-write filesystems (Linux)
+_FICLONE = 0x40049409
+
+# (source, destination) devices between which cloning failed.
+_noclone = set()
+
+def reflink(src, dest):
+    '''Make dest a copy-on-write clone of src.  Raise OSError or IOError
+    if the platform or filesystem cannot do that.'''
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+    import fcntl
+    infile = open(src, 'rb')
+    try:
+        outfile = open(dest, 'wb')
+        try:
+            fcntl.ioctl(outfile.fileno(), _FICLONE, infile.fileno())
+        finally:
+            outfile.close()
+    finally:
+        infile.close()
+
+def materialize(ui, src, dest):
+    '''Put a copy of the cached file src at dest in the working copy, the
+    way [kilnbfiles] wcopy says: "reflink" (the default) clones the file
+    where the filesystem supports it, "hardlink" links it (editing it in
+    place then modifies the cache too!) and "copy" always copies.  Fall
+    back to copying if need be, and return how dest was made: "reflink",
+    "hardlink", "stream" (decompressed or unpacked) or "copy".  The
+    caller sets the mode of dest, with set_mode().'''
+    how = ui.config(long_name, 'wcopy', 'reflink')
+    if is_compressed(src) or is_packed(src):
+        how = 'stream'
+    destdir = os.path.dirname(dest)
+    util.makedirs(destdir)
+    if how == 'hardlink':
+        if os.path.exists(dest):
+            os.remove(dest)
+        link(src, dest)
+        return how
+    (tmpfd, tmpfilename) = tempfile.mkstemp(dir=destdir,
+                                            prefix=os.path.basename(dest))
+    os.close(tmpfd)
+    try:
+        cloned = False
+        if how == 'stream':
+            outfile = open(tmpfilename, 'wb')
+            try:
+                for data in cachedstream(src):
+                    outfile.write(data)
+            finally:
+                outfile.close()
+            cloned = True
+        elif how == 'reflink':
+            devs = (os.stat(src).st_dev, os.stat(destdir).st_dev)
+            if devs not in _noclone:
+                try:
+                    reflink(src, tmpfilename)
+                    cloned = True
+                except (IOError, OSError):
+                    _noclone.add(devs)
+        if not cloned:
+            shutil.copyfile(src, tmpfilename)
+            how = 'copy'
+        if os.path.exists(dest):          # for windows
+            os.remove(dest)
+        os.rename(tmpfilename, dest)
+    except:
+        try:
+            os.unlink(tmpfilename)
+        except OSError:
+            pass
+        raise
+    return how
+
+def report_copies(ui, hows):
+    '''Tell the user how many of the files materialize() made (hows
+    being what it returned) it had to copy instead of cloning.'''
+    copies = len([how for how in hows if how == 'copy'])
+    if copies and ui.config(long_name, 'wcopy', 'reflink') == 'reflink':
+        ui.note(_('%d big files copied: the filesystem cannot clone '
+                  'files\n') % copies)
+
+def set_mode(path, mode):
+    '''Give the working copy file path the mode of its standin.  A file
+    hard linked to the cache by materialize() is copied first: the mode
+    belongs to the inode, and so to the cached object too.'''
+    st = os.stat(path)
+    if stat.S_IMODE(st.st_mode) == stat.S_IMODE(mode):
+        return
+    if st.st_nlink > 1:
+        (tmpfd, tmpfilename) = tempfile.mkstemp(dir=os.path.dirname(path),
+                                                prefix=os.path.basename(path))
+        os.close(tmpfd)
+        try:
+            shutil.copyfile(path, tmpfilename)
+            if os.name == 'nt':
+                os.remove(path)
+            os.rename(tmpfilename, path)
+        except:
+            try:
+                os.unlink(tmpfilename)
+            except OSError:
+                pass
+            raise
+    os.chmod(path, mode)
+
 def system_cache_path(ui, hash):
     path = ui.config(long_name, 'systemcache', None)
     if path:
@@ -105,29 +595,493 @@ def system_cache_path(ui, hash):
             raise util.Abort(_('Unknown operating system: %s\n') % os.name)
     return path
 
+class filelock(object):
+    '''Exclusive advisory lock (flock(2)) on path, which is created if
+    needed.  Where flock is not available this does not lock at all, so
+    callers must still only ever expose complete files by renaming.'''
+    def __init__(self, path):
+        self.fd = None
+        try:
+            import fcntl
+        except ImportError:
+            return
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                break
+            except IOError, err:
+                if err.errno != errno.EINTR:
+                    os.close(self.fd)
+                    raise
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def lock_system_cache(ui, hash):
+    '''Lock hash in the system cache.  Locks are striped by the first
+    two hex digits of the hash: writers of different hashes rarely wait
+    for each other, and there are never more than 256 lock files.'''
+    lockdir = os.path.join(os.path.dirname(system_cache_path(ui, hash)), '.locks')
+    create_dir(lockdir)
+    return filelock(os.path.join(lockdir, hash[:2]))
+
+# Compressed objects in the system cache are named <hash>.z and hold
+# this header (with the uncompressed size) followed by a zlib stream.
+_zsuffix = '.z'
+_zheader = '>4sQ'
+_zmagic = 'kbfz'
+
+def is_compressed(path):
+    return path.endswith(_zsuffix)
+
+def cachedstream(path):
+    '''Generator that yields the contents of the cached object at path,
+    decompressing it or reading it out of its pack if need be.'''
+    if is_packed(path):
+        for data in _packedstream(path):
+            yield data
+        return
+    try:
+        infile = open(path, 'rb')
+    except IOError, err:
+        newpath = err.errno == errno.ENOENT and _relocate(path)
+        if not newpath:
+            raise err
+        for data in cachedstream(newpath):
+            yield data
+        return
+    if not is_compressed(path):
+        for data in blockstream(infile):
+            yield data
+        return
+    try:
+        magic, size = struct.unpack(_zheader, infile.read(struct.calcsize(_zheader)))
+        if magic != _zmagic:
+            raise util.Abort(_('%s: not a compressed big file') % path)
+        decompressor = zlib.decompressobj()
+        while True:
+            data = infile.read(128*1024)
+            if not data:
+                break
+            data = decompressor.decompress(data)
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+    finally:
+        infile.close()
+
+def cached_object_size(path):
+    '''Return the uncompressed size of the cached object at path.'''
+    try:
+        if is_packed(path):
+            return _packentry(os.path.dirname(path), os.path.basename(path))[2]
+        if not is_compressed(path):
+            return os.path.getsize(path)
+        infile = open(path, 'rb')
+    except EnvironmentError, err:
+        newpath = err.errno == errno.ENOENT and _relocate(path)
+        if not newpath:
+            raise err
+        return cached_object_size(newpath)
+    try:
+        magic, size = struct.unpack(_zheader, infile.read(struct.calcsize(_zheader)))
+    finally:
+        infile.close()
+    return size
+
+def hashcached(path):
+    '''Return the hash of the (uncompressed) cached object at path.'''
+    hasher = util.sha1('')
+    for data in cachedstream(path):
+        hasher.update(data)
+    return hasher.hexdigest()
+
+def _compress(ui, src, cachedir, hash):
+    '''Write a compressed copy of src to a temporary file in cachedir and
+    return its name, or return None if src does not compress to at most
+    [kilnbfiles] compressratio (default: 0.9) of its size.'''
+    ratio = float(ui.config(long_name, 'compressratio', '0.9'))
+    size = os.path.getsize(src)
+    (tmpfd, tmpfilename) = tempfile.mkstemp(dir=cachedir, prefix='.tmp-' + hash)
+    outfile = os.fdopen(tmpfd, 'wb')
+    try:
+        outfile.write(struct.pack(_zheader, _zmagic, size))
+        compressor = zlib.compressobj(int(ui.config(long_name, 'compresslevel', '6')))
+        for data in blockstream(open(src, 'rb')):
+            outfile.write(compressor.compress(data))
+        outfile.write(compressor.flush())
+        outfile.close()
+        if os.path.getsize(tmpfilename) > size * ratio:
+            os.unlink(tmpfilename)
+            return None
+        return tmpfilename
+    except:
+        outfile.close()
+        os.unlink(tmpfilename)
+        raise
+
+# kbfrepack moves small objects out of a cache directory into packs in
+# its .packs directory: pack-<id>.pack holds their data back to back,
+# and pack-<id>.idx a sorted table of (binary hash, offset, length,
+# size) records.  Data shorter than its size is a zlib stream.  The
+# object hash in pack P is named P/hash (see is_packed()), which every
+# reader of cached objects understands.
+_packdir = '.packs'
+_packmagic = 'kbfpack1'
+_packrecord = '>20sQQQ'
+_packrecordsize = struct.calcsize(_packrecord)
+
+# Packs of each cache directory, and the index of each pack, read once
+# per process (and again when the directory changes).  A listing is only
+# trusted while the directory's mtime is unchanged and was already
+# _packslack seconds old when it was listed: filesystems with coarse
+# timestamps give two changes in the same second the same mtime.
+_packlists = {}
+_packindexes = {}
+_packslack = 2
+
+def is_packed(path):
+    return os.path.dirname(path).endswith('.pack')
+
+def pack_dir(cachedir):
+    return os.path.join(cachedir, _packdir)
+
+def list_packs(cachedir):
+    '''Return the paths of the packs in cachedir.'''
+    packdir = pack_dir(cachedir)
+    try:
+        mtime = os.stat(packdir).st_mtime
+    except OSError:
+        return []
+    if (packdir not in _packlists or _packlists[packdir][0] != mtime or
+        _packlists[packdir][1] < mtime + _packslack):
+        listedat = time.time()
+        packs = [os.path.join(packdir, name[:-len('.idx')] + '.pack')
+                 for name in sorted(os.listdir(packdir))
+                 if name.startswith('pack-') and name.endswith('.idx')]
+        for pack in _packlists.get(packdir, (None, None, []))[2]:
+            if pack not in packs:
+                _packindexes.pop(pack, None)
+        _packlists[packdir] = (mtime, listedat, packs)
+    return _packlists[packdir][2]
+
+def _packindex(pack):
+    if pack not in _packindexes:
+        fd = open(pack[:-len('.pack')] + '.idx', 'rb')
+        try:
+            size = os.fstat(fd.fileno()).st_size
+            if size:
+                _packindexes[pack] = mmap.mmap(fd.fileno(), size,
+                                               access=mmap.ACCESS_READ)
+            else:
+                _packindexes[pack] = ''
+        finally:
+            fd.close()
+    return _packindexes[pack]
+
+def _packentry(pack, hash):
+    '''Return (offset, length, size) of hash in pack, or None.'''
+    index = _packindex(pack)
+    key = binascii.unhexlify(hash)
+    lo, hi = 0, len(index) // _packrecordsize
+    while lo < hi:
+        mid = (lo + hi) // 2
+        record = index[mid * _packrecordsize:(mid + 1) * _packrecordsize]
+        if record[:20] < key:
+            lo = mid + 1
+        elif record[:20] > key:
+            hi = mid
+        else:
+            return struct.unpack(_packrecord, record)[1:]
+    return None
+
+def pack_entries(pack):
+    '''Generator that yields (hash, offset, length, size) for every
+    object in pack.'''
+    index = _packindex(pack)
+    for i in xrange(0, len(index), _packrecordsize):
+        key, offset, length, size = struct.unpack(
+            _packrecord, index[i:i + _packrecordsize])
+        yield (binascii.hexlify(key), offset, length, size)
+
+def find_in_packs(cachedir, hash):
+    '''Return the path of hash in the packs of cachedir, or None.'''
+    if len(hash) != 40:
+        return None
+    for pack in list_packs(cachedir):
+        try:
+            if _packentry(pack, hash) is not None:
+                return os.path.join(pack, hash)
+        except (IOError, OSError):
+            # Removed by a concurrent repack: its objects are elsewhere.
+            pass
+    return None
+
+def _relocate(path):
+    '''Return where the cached object at path went if a concurrent repack
+    removed it (a loose object it packed, or an old pack it replaced),
+    or None if it is not in the packs of its cache directory either.'''
+    if is_packed(path):
+        pack, hash = os.path.split(path)
+        cachedir = os.path.dirname(os.path.dirname(pack))
+        _packindexes.pop(pack, None)
+    else:
+        cachedir, hash = os.path.split(path)
+        hash = hash[:40]
+    _packlists.pop(pack_dir(cachedir), None)
+    newpath = find_in_packs(cachedir, hash)
+    if newpath == path:
+        return None
+    return newpath
+
+def _packedstream(path):
+    pack, hash = os.path.split(path)
+    try:
+        entry = _packentry(pack, hash)
+        infile = open(pack, 'rb')
+    except EnvironmentError, err:
+        # A pack that is already open stays readable after a repack
+        # removes it, but one that is not must be looked for again.
+        newpath = err.errno == errno.ENOENT and _relocate(path)
+        if not newpath:
+            raise err
+        for data in cachedstream(newpath):
+            yield data
+        return
+    if entry is None:
+        infile.close()
+        raise util.Abort(_('%s: not in pack %s') % (hash, pack))
+    offset, length, size = entry
+    try:
+        infile.seek(offset)
+        if length == size:
+            for data in readchunks(infile, length):
+                yield data
+            return
+        decompressor = zlib.decompressobj()
+        for data in readchunks(infile, length):
+            data = decompressor.decompress(data)
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+    finally:
+        infile.close()
+
+def put_in_system_cache(ui, hash, src, move=False):
+    '''Put src, a complete file that is known to hash to hash, into the
+    system cache.  If move is True src is renamed, so it must be on the
+    same filesystem; otherwise it is linked or copied.  With [kilnbfiles]
+    compress enabled, objects that compress well are stored compressed.
+
+    The object is written to a temporary name and renamed into place
+    under the hash's lock, so a crash or another process can never leave
+    a partial object under the final name.  An existing object is only
+    checked for its size, not hashed: one of the right size is kept, and
+    one of the wrong size (left by older versions that wrote in place)
+    is replaced.'''
+    path = system_cache_path(ui, hash)
+    cachedir = os.path.dirname(path)
+    create_dir(cachedir)
+    lock = lock_system_cache(ui, hash)
+    try:
+        if (os.path.exists(path + _zsuffix) or
+            find_in_packs(cachedir, hash) is not None or
+            (os.path.exists(path) and
+             os.path.getsize(path) == os.path.getsize(src))):
+            if move:
+                os.unlink(src)
+            return
+        if ui.configbool(long_name, 'compress', False):
+            tmpfilename = _compress(ui, src, cachedir, hash)
+            if tmpfilename is not None:
+                os.rename(tmpfilename, path + _zsuffix)
+                if os.path.exists(path):
+                    os.unlink(path)
+                if move:
+                    os.unlink(src)
+                return
+        if move:
+            tmpfilename = src
+        else:
+            (tmpfd, tmpfilename) = tempfile.mkstemp(dir=cachedir,
+                                                    prefix='.tmp-' + hash)
+            os.close(tmpfd)
+            os.unlink(tmpfilename)
+        try:
+            if not move:
+                link(src, tmpfilename)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmpfilename, path)
+        except:
+            try:
+                os.unlink(tmpfilename)
+            except OSError:
+                pass
+            raise
+    finally:
+        lock.release()
+
+# Names of the objects in each alternate cache, listed once per process.
+_alternate_objects = {}
+
+def alternate_caches(ui):
+    '''Return the read-only caches listed in [kilnbfiles] alternates,
+    which are searched (in order) after the system cache.'''
+    return [util.expandpath(path)
+            for path in ui.configlist(long_name, 'alternates', [])]
+
+def find_in_alternates(ui, hash):
+    '''Return the path of hash in the first alternate cache that has it,
+    or None.  Alternates are typically on network filesystems, so each
+    is listed once rather than probed once per file.'''
+    for root in alternate_caches(ui):
+        if root not in _alternate_objects:
+            try:
+                _alternate_objects[root] = set(os.listdir(root))
+            except OSError:
+                _alternate_objects[root] = set()
+        for name in (hash, hash + _zsuffix):
+            if name in _alternate_objects[root]:
+                return os.path.join(root, name)
+        if _packdir in _alternate_objects[root]:
+            path = find_in_packs(root, hash)
+            if path is not None:
+                return path
+    return None
+
+def find_system_file(ui, hash):
+    '''Return the path of hash in the system cache or in one of the
+    alternate caches, or None.  The object may be compressed: see
+    is_compressed() and cachedstream().'''
+    path = system_cache_path(ui, hash)
+    if os.path.exists(path):
+        return path
+    if os.path.exists(path + _zsuffix):
+        return path + _zsuffix
+    return (find_in_packs(os.path.dirname(path), hash) or
+            find_in_alternates(ui, hash))
+
 def in_system_cache(ui, hash):
-    return os.path.exists(system_cache_path(ui, hash))
+    return find_system_file(ui, hash) is not None
+
+def raw_file(repo, hash, path):
+    '''Return (rawpath, temporary) for the cached object hash at path (as
+    returned by find_file(), or None): rawpath is an uncompressed file
+    holding hash, or None.  A compressed or packed object is decompressed
+    into a temporary file, which the caller removes when temporary is
+    True, so that no raw copy outlives the upload that needed it.'''
+    if path is None or not (is_compressed(path) or is_packed(path)):
+        return (path, False)
+    admin = repo.join(long_name)
+    create_dir(admin)
+    (tmpfd, tmpfilename) = tempfile.mkstemp(dir=admin, prefix='raw-')
+    os.close(tmpfd)
+    try:
+        materialize(repo.ui, path, tmpfilename)
+    except:
+        os.unlink(tmpfilename)
+        raise
+    return (tmpfilename, True)
 
 def find_file(repo, hash):
-    if in_cache(repo, hash):
+    path = find_cached_file(repo, hash)
+    if path is not None:
         repo.ui.note(_('Found %s in cache\n') % hash)
-        return cache_path(repo, hash)
-    if in_system_cache(repo.ui, hash):
+        return path
+    path = find_system_file(repo.ui, hash)
+    if path is not None:
         repo.ui.note(_('Found %s in system cache\n') % hash)
-        return system_cache_path(repo.ui, hash)
-    return None
+    return path
+
+class resolver(object):
+    '''Finds where many hashes are cached at once.  Rather than trying
+    every possible name of every hash, as find_file() does, a resolver
+    reads a cache directory once and looks hashes up in memory, when the
+    batch is big enough next to the directory for that to be cheaper.
+    Objects added to the caches after that are not seen, so a resolver
+    should only live as long as one command.'''
+
+    # A directory is read when it has at most this many entries per hash
+    # looked up: reading an entry is that much cheaper than the stat()
+    # calls it saves.
+    listratio = 16
+    # Directories take up about this many bytes per entry (as long as a
+    # compressed object's name) on common filesystems, which is how their
+    # number of entries is estimated without reading them.
+    direntsize = 64
 
-def open_bfdirstate(ui, repo):
+    def __init__(self, repo):
+        self.repo = repo
+        self.caches = [repo.join(long_name),
+                       os.path.dirname(system_cache_path(repo.ui, 'x'))]
+        self._names = {}
+
+    def find(self, hashes):
+        '''Return a dict from each of hashes to its path, as find_file()
+        would return it, or None if it is not cached.'''
+        hashes = set(hashes)
+        for cachedir in self.caches:
+            if (cachedir not in self._names and
+                self._worthreading(cachedir, len(hashes))):
+                try:
+                    self._names[cachedir] = set(os.listdir(cachedir))
+                except OSError:
+                    self._names[cachedir] = set()
+        return dict([(hash, self._find(hash)) for hash in hashes])
+
+    def _worthreading(self, cachedir, count):
+        try:
+            size = os.stat(cachedir).st_size
+        except OSError:
+            return True
+        # Some filesystems (NTFS) do not report the size of directories.
+        return bool(size) and size // self.direntsize <= count * self.listratio
+
+    def _find(self, hash):
+        ui = self.repo.ui
+        path = self._lookup(self.caches[0], hash)
+        if path is not None:
+            ui.note(_('Found %s in cache\n') % hash)
+            return path
+        path = (self._lookup(self.caches[1], hash) or
+                find_in_alternates(ui, hash))
+        if path is not None:
+            ui.note(_('Found %s in system cache\n') % hash)
+        return path
+
+    def _lookup(self, cachedir, hash):
+        names = self._names.get(cachedir)
+        for name in (hash, hash + _zsuffix):
+            if names is None:
+                if os.path.exists(os.path.join(cachedir, name)):
+                    return os.path.join(cachedir, name)
+            elif name in names:
+                return os.path.join(cachedir, name)
+        if names is None or _packdir in names:
+            return find_in_packs(cachedir, hash)
+        return None
+
+def open_bfdirstate(ui, repo, create=True):
     '''
     Return a dirstate object that tracks big files: i.e. its root is the
-    repo root, but it is saved in .hg/bfiles/dirstate.
+    repo root, but it is saved in .hg/bfiles/dirstate.  If it does not
+    exist yet and create is False, return None instead of building it:
+    building it writes to .hg/bfiles, which needs the wlock.
     '''
     admin = repo.join(long_name)
     opener = util.opener(admin)
     if hasattr(repo.dirstate, '_validate'):
-        bfdirstate = dirstate.dirstate(opener, ui, repo.root, repo.dirstate._validate)
+        bfdirstate = journaleddirstate(admin, opener, ui, repo.root, repo.dirstate._validate)
     else:
-        bfdirstate = dirstate.dirstate(opener, ui, repo.root)
+        bfdirstate = journaleddirstate(admin, opener, ui, repo.root)
 
     # If the bfiles dirstate does not exist, populate and create it.  This
     # ensures that we create it on the first meaningful bfiles operation in
@@ -139,27 +1093,132 @@ def open_bfdirstate(ui, repo):
     # (although that can lose data, e.g. pending big file revisions in
     # .hg/bfiles/{pending,committed}).
     if not os.path.exists(os.path.join(admin, 'dirstate')):
+        if not create:
+            return None
         util.makedirs(admin)
-        matcher = get_standin_matcher(repo)
-        for standin in dirstate_walk(repo.dirstate, matcher):
-            bigfile = split_standin(standin)
-            hash = read_standin(repo, standin)
-            try:
-                curhash = hashfile(bigfile)
-            except IOError, err:
-                if err.errno == errno.ENOENT:
-                    dirstate_normaldirty(bfdirstate, bigfile)
-                else:
-                    raise
+        rebuild_bfdirstate(ui, repo, bfdirstate)
+
+    return bfdirstate
+
+def rebuild_bfdirstate(ui, repo, bfdirstate):
+    '''Populate an empty bfdirstate by comparing every big file in the
+    working copy against its standin.
+
+    Big files whose size differs from the cached revision named by their
+    standin are marked dirty without being read.  The rest are hashed by a
+    pool of worker threads.  Every result is appended to a checkpoint file
+    so that an interrupted rebuild only has to hash the files it had not
+    reached yet (or that changed since).'''
+    checkpoint = repo.join(os.path.join(long_name, 'rebuild'))
+    done = _read_rebuild_checkpoint(checkpoint)
+
+    tohash = []
+    matcher = get_standin_matcher(repo)
+    for standin in dirstate_walk(repo.dirstate, matcher):
+        bigfile = split_standin(standin)
+        hash = read_standin(repo, standin)
+        try:
+            st = os.lstat(repo.wjoin(bigfile))
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            dirstate_normaldirty(bfdirstate, unixpath(bigfile))
+            continue
+        key = (st.st_size, int(st.st_mtime))
+        if done.get(bigfile, (None, None))[:2] == key:
+            curhash = done[bigfile][2]
+        elif cached_size(repo, hash) not in (None, st.st_size):
+            curhash = None
+        else:
+            tohash.append((bigfile, key, hash))
+            continue
+        if curhash == hash:
+            bfdirstate.normal(unixpath(bigfile))
+        else:
+            dirstate_normaldirty(bfdirstate, unixpath(bigfile))
+
+    def hashone(item):
+        try:
+            return hashfile(repo.wjoin(item[0]))
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+
+    ckfile = open(checkpoint, 'ab')
+    try:
+        at = 0
+        for (bigfile, key, hash), curhash in threadmap(hashone, tohash, get_workers(ui)):
+            ui.progress(_('Rebuilding bfiles dirstate'), at, unit=_('bfile'),
+                        total=len(tohash))
+            at += 1
+            if curhash is not None:
+                ckfile.write('%s %d %d %s\n' % (curhash, key[0], key[1], bigfile))
+                ckfile.flush()
+            if curhash == hash:
+                bfdirstate.normal(unixpath(bigfile))
             else:
-                if curhash == hash:
-                    bfdirstate.normal(unixpath(bigfile))
-                else:
-                    dirstate_normaldirty(bfdirstate, bigfile)
+                dirstate_normaldirty(bfdirstate, unixpath(bigfile))
+        ui.progress(_('Rebuilding bfiles dirstate'), None)
+    finally:
+        ckfile.close()
 
-        bfdirstate.write()
+    bfdirstate.write()
+    os.unlink(checkpoint)
 
-    return bfdirstate
+def _read_rebuild_checkpoint(checkpoint):
+    '''Return {bfile: (size, mtime, hash)} for every big file hashed by
+    an earlier, interrupted rebuild.'''
+    done = {}
+    try:
+        fd = open(checkpoint, 'rb')
+    except IOError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return done
+    try:
+        for line in fd:
+            # A partially written last line is simply ignored.
+            if not line.endswith('\n'):
+                break
+            try:
+                hash, size, mtime, bfile = line[:-1].split(' ', 3)
+                done[bfile] = (int(size), int(mtime), hash)
+            except ValueError:
+                break
+    finally:
+        fd.close()
+    return done
+
+def stat_key(repo, bfile):
+    '''Return what stat() says about bfile that changes whenever its
+    contents do, or None if it is missing.'''
+    try:
+        st = os.lstat(repo.wjoin(bfile))
+    except OSError:
+        return None
+    return (st.st_mode, st.st_size, st.st_mtime, st.st_ino)
+
+def mark_clean(ui, repo, checked):
+    '''Mark the bfiles in checked, a list of (bfile, stat_key() from
+    before bfile was found to be clean), normal in the bfdirstate,
+    unless they have changed since.  This does not wait for the wlock:
+    if someone else holds it, the bfiles are just checked again by the
+    next status.'''
+    try:
+        wlock = repo.wlock(False)
+    except error.LockError:
+        return
+    try:
+        bfdirstate = open_bfdirstate(ui, repo)
+        for bfile, key in checked:
+            bfile = unixpath(bfile)
+            if (bfile in bfdirstate and bfdirstate[bfile] == 'n' and
+                stat_key(repo, bfile) == key):
+                bfdirstate.normal(bfile)
+        bfdirstate.write()
+    finally:
+        wlock.release()
 
 def bfdirstate_status(bfdirstate, repo, rev):
     wlock = repo.wlock()
@@ -168,7 +1227,8 @@ def bfdirstate_status(bfdirstate, repo, rev):
         s = bfdirstate.status(match, [], False, False, False)
         (unsure, modified, added, removed, missing, unknown, ignored, clean) = s
         for bfile in unsure:
-            if repo[rev][standin(bfile)].data().strip() != hashfile(repo.wjoin(bfile)):
+            hash = standin_hash(repo[rev][standin(bfile)].data())
+            if size_changed(repo, bfile, hash) or hash != hashfile(repo.wjoin(bfile)):
                 modified.append(bfile)
             else:
                 clean.append(bfile)
@@ -196,28 +1256,115 @@ def list_bfiles(repo, rev=None, matcher=None):
             bfiles.append(filename)
     return bfiles
 
+def cached_size(repo, hash):
+    '''Return the size of the cached revision hash, or None if it is not
+    in any local cache.'''
+    path = find_file(repo, hash)
+    if path is None:
+        return None
+    return cached_object_size(path)
+
+def find_cached_file(repo, hash):
+    '''Return the path of hash in the repository cache, loose or packed,
+    or None.'''
+    path = cache_path(repo, hash)
+    if os.path.exists(path):
+        return path
+    if os.path.exists(path + _zsuffix):
+        return path + _zsuffix
+    return find_in_packs(repo.join(long_name), hash)
+
 def in_cache(repo, hash):
-    return os.path.exists(cache_path(repo, hash))
+    return find_cached_file(repo, hash) is not None
 
 def create_dir(dir):
+    # Worker threads may race to create the same directory.
     if not os.path.exists(dir):
-        os.makedirs(dir)
+        try:
+            os.makedirs(dir)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
 
 def cache_path(repo, hash):
     return repo.join(os.path.join(long_name, hash))
 
+def link_to_cache(repo, hash):
+    '''Link the system cache object hash, raw or compressed, into the
+    repository cache under the same name, so that both caches share one
+    copy of it.  A raw copy already in the repository cache is dropped
+    when the system cache holds the object compressed.  Return False if
+    the object is not loose in the system cache.'''
+    path = system_cache_path(repo.ui, hash)
+    dest = cache_path(repo, hash)
+    if os.path.exists(path + _zsuffix):
+        path += _zsuffix
+        dest += _zsuffix
+    elif not os.path.exists(path):
+        return False
+    create_dir(os.path.dirname(dest))
+    if not os.path.exists(dest):
+        link(path, dest)
+    if is_compressed(dest) and os.path.exists(cache_path(repo, hash)):
+        os.unlink(cache_path(repo, hash))
+    return True
+
 def copy_to_cache(repo, rev, file, uploaded=False):
     hash = read_standin(repo, standin(file))
     if in_cache(repo, hash):
         return
+    if link_to_cache(repo, hash) or in_system_cache(repo.ui, hash):
+        # Otherwise it is packed or in an alternate cache: find_file()
+        # will find it there.
+        return
     create_dir(os.path.dirname(cache_path(repo, hash)))
-    if in_system_cache(repo.ui, hash):
-        link(system_cache_path(repo.ui, hash), cache_path(repo, hash))
-    else:
-        shutil.copyfile(repo.wjoin(file), cache_path(repo, hash))
-        os.chmod(cache_path(repo, hash), os.stat(repo.wjoin(file)).st_mode)
-        create_dir(os.path.dirname(system_cache_path(repo.ui, hash)))
-        link(cache_path(repo, hash), system_cache_path(repo.ui, hash))
+    shutil.copyfile(repo.wjoin(file), cache_path(repo, hash))
+    os.chmod(cache_path(repo, hash), os.stat(repo.wjoin(file)).st_mode)
+    put_in_system_cache(repo.ui, hash, cache_path(repo, hash))
+    link_to_cache(repo, hash)
+
+def _unchanged(repo, file, hash):
+    '''Return True if the working copy file is the cached object hash,
+    which must be in both caches.  Only a file of the right size is read.
+    A hard link to the cached object is read too: editing it in place
+    (with [kilnbfiles] wcopy = hardlink) changes the object as well.'''
+    if not in_system_cache(repo.ui, hash):
+        return False
+    path = find_cached_file(repo, hash)
+    if path is None:
+        return False
+    return (os.path.getsize(repo.wjoin(file)) == cached_object_size(path) and
+            hashfile(repo.wjoin(file)) == hash)
+
+def ingest(repo, file, oldhash=None):
+    '''Put the working copy file into the repository cache, hashing it
+    as it is copied, and link it into the system cache.  The file is only
+    read once, unless it is the size of oldhash (its last known hash):
+    then it is hashed first, and not copied if it is unchanged.  Return
+    its hex hash.
+
+    If the system cache compresses it, the repository cache keeps a link
+    to the compressed object rather than a raw copy.'''
+    if oldhash and _unchanged(repo, file, oldhash):
+        return oldhash
+    admin = repo.join(long_name)
+    create_dir(admin)
+    (tmpfd, tmpfilename) = tempfile.mkstemp(dir=admin, prefix='ingest-')
+    try:
+        hash = binascii.hexlify(copy_and_hash(
+            blockstream(open(repo.wjoin(file), 'rb')), os.fdopen(tmpfd, 'wb')))
+        os.chmod(tmpfilename, os.stat(repo.wjoin(file)).st_mode)
+        src = tmpfilename
+        if not in_cache(repo, hash):
+            os.rename(tmpfilename, cache_path(repo, hash))
+            src = cache_path(repo, hash)
+        if not in_system_cache(repo.ui, hash):
+            put_in_system_cache(repo.ui, hash, src)
+        link_to_cache(repo, hash)
+    finally:
+        if os.path.exists(tmpfilename):
+            os.unlink(tmpfilename)
+    return hash
 
 def get_standin_matcher(repo, pats=[], opts={}):
     '''Return a match object that applies pats to <repo>/.kbf.'''
@@ -284,19 +1431,72 @@ def split_standin(filename):
     else:
         return None
 
-def update_standin(repo, standin):
+def update_standin(repo, standin, cache=False):
+    '''Write the hash of the big file to its standin, and its size with
+    [kilnbfiles] standinsizes.  If cache is True the big file is also
+    put into the caches (in the same pass).'''
     file = repo.wjoin(split_standin(standin))
-    hash = hashfile(file)
+    oldhash = oldsize = None
+    if os.path.exists(repo.wjoin(standin)):
+        (oldhash, oldsize) = read_standin_entry(repo, standin)
+    if cache:
+        hash = ingest(repo, split_standin(standin), oldhash)
+    else:
+        hash = hashfile(file)
     executable = get_executable(file)
-    write_standin(repo, standin, hash, executable)
+    size = None
+    if repo.ui.configbool(long_name, 'standinsizes', False):
+        size = os.path.getsize(file)
+    if oldhash is not None:
+        if oldhash == hash:
+            # Same contents: keep the standin as it is, so that adding
+            # or dropping the size does not make it modified.
+            size = oldsize
+    write_standin(repo, standin, hash, executable, size)
 
 def read_standin(repo, standin):
     '''read hex hash from <repo.root>/<standin>'''
     return read_hash(repo.wjoin(standin))
 
-def write_standin(repo, standin, hash, executable):
-    '''write hhash to <repo.root>/<standin>'''
-    write_hash(hash, repo.wjoin(standin), executable)
+def read_standin_entry(repo, standin):
+    '''Return (hash, size) from <repo.root>/<standin>: see
+    parse_standin().'''
+    rfile = open(repo.wjoin(standin), 'rb')
+    try:
+        return parse_standin(rfile.read())
+    finally:
+        rfile.close()
+
+def write_standin(repo, standin, hash, executable, size=None):
+    '''write hhash (and size, if given) to <repo.root>/<standin>'''
+    write_hash(hash, repo.wjoin(standin), executable, size)
+
+def parse_standin(data):
+    '''Return (hash, size) from the contents of a standin, which is
+    either "<hash>\n" or, with [kilnbfiles] standinsizes, "<hash>
+    <size>\n".  size is None for the former.'''
+    fields = data.split()
+    if not fields:
+        return ('', None)
+    size = None
+    if len(fields) > 1 and fields[1].isdigit():
+        size = int(fields[1])
+    return (fields[0], size)
+
+def standin_hash(data):
+    '''Return the hash from the contents of a standin.'''
+    return parse_standin(data)[0]
+
+def size_changed(repo, bfile, hash):
+    '''Return True if the working copy standin of bfile is for hash and
+    records a size that bfile no longer has: then bfile is modified,
+    without having to hash it.'''
+    try:
+        (standinhash, size) = read_standin_entry(repo, standin(bfile))
+        return (standinhash == hash and size is not None and
+                size != os.path.getsize(repo.wjoin(bfile)))
+    except (IOError, OSError):
+        return False
 
 def copy_and_hash(instream, outfile):
     '''Read bytes from instream (iterable) and write them to outfile,
@@ -324,6 +1524,15 @@ def hashfile(file):
             hasher.update(data)
     return hasher.hexdigest()
 
+def readchunks(infile, length, blocksize=128*1024):
+    '''Generator that yields exactly length bytes of infile, in blocks.'''
+    while length > 0:
+        data = infile.read(min(length, blocksize))
+        if not data:
+            raise IOError(_('unexpected end of stream'))
+        length -= len(data)
+        yield data
+
 def blockstream(infile, blocksize=128*1024):
     """Generator that yields blocks of data from infile and closes infile."""
     while True:
@@ -343,7 +1552,7 @@ def read_hash(filename):
                          % (filename, len(hash)))
     return hash
 
-def write_hash(hash, filename, executable):
+def write_hash(hash, filename, executable, size=None):
     util.makedirs(os.path.dirname(filename))
     if os.path.exists(filename):
         os.unlink(filename)
@@ -358,6 +1567,8 @@ def write_hash(hash, filename, executable):
 
     try:
         wfile.write(hash)
+        if size is not None:
+            wfile.write(' %d' % size)
         wfile.write('\n')
     finally:
         wfile.close()
@@ -372,6 +1583,118 @@ def get_mode(executable):
     else:
         return 0644
 
+def get_workers(ui):
+    '''Return the number of worker threads used for parallel I/O, as set
+    by [kilnbfiles] workers.'''
+    workers = ui.config(long_name, 'workers', default='4')
+    try:
+        return max(1, int(workers))
+    except ValueError:
+        raise util.Abort(_('kilnbfiles.workers must be integer, was %s\n') % workers)
+
+def threadmap(fn, items, workers):
+    '''Call fn on every element of items using a pool of worker threads
+    and yield (item, result) pairs as they complete.  Results come back in
+    completion order, not in the order of items.  If fn raises, the
+    remaining items are abandoned and the exception is re-raised in the
+    calling thread.  If fn raises or the caller stops early, the items
+    already started are waited for before returning.  fn must not touch
+    ui: only the caller may do that.'''
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield item, fn(item)
+        return
+
+    todo = Queue.Queue()
+    results = Queue.Queue()
+    for item in items:
+        todo.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results.put((item, fn(item), None))
+            except:
+                results.put((item, None, sys.exc_info()))
+
+    threads = []
+    for i in xrange(min(workers, len(items))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+
+    try:
+        for i in xrange(len(items)):
+            while True:
+                # Block with a timeout so that KeyboardInterrupt is
+                # still delivered to the main thread.
+                try:
+                    item, result, excinfo = results.get(True, 1.0)
+                    break
+                except Queue.Empty:
+                    pass
+            if excinfo:
+                raise excinfo[0], excinfo[1], excinfo[2]
+            yield item, result
+    finally:
+        # Stop handing out work if we are bailing out early.
+        while True:
+            try:
+                todo.get_nowait()
+            except Queue.Empty:
+                break
+        for t in threads:
+            while t.isAlive():
+                t.join(1.0)
+
+class backgroundmap(object):
+    '''Run threadmap(fn, items, workers) in a background thread, so that
+    the caller can do something else (like talking to the user) in the
+    meantime.  result() waits for it and returns the (item, result)
+    pairs, re-raising any exception raised by fn.  cancel() abandons the
+    items not started yet and waits for the others.'''
+    def __init__(self, fn, items, workers):
+        self._results = []
+        self._excinfo = None
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._run,
+                                        args=(fn, items, workers))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self, fn, items, workers):
+        results = threadmap(fn, items, workers)
+        try:
+            try:
+                for result in results:
+                    self._results.append(result)
+                    if self._cancelled:
+                        break
+            except:
+                self._excinfo = sys.exc_info()
+        finally:
+            results.close()
+
+    def _wait(self):
+        while self._thread.isAlive():
+            self._thread.join(1.0)
+
+    def result(self):
+        self._wait()
+        if self._excinfo:
+            raise self._excinfo[0], self._excinfo[1], self._excinfo[2]
+        return self._results
+
+    def cancel(self):
+        self._cancelled = True
+        self._wait()
+
 def urljoin(first, second, *arg):
     def join(left, right):
         if not left.endswith('/'):
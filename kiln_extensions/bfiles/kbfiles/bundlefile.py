@@ -0,0 +1,100 @@
+'''Big file bundles: a single file holding a set of big file revisions,
+for moving them between machines without a store.
+
+A bundle starts with an index and is followed by the data of every
+object, in index order:
+
+  kbfbundle 1
+  <number of objects>
+  <hash> <size>        (one line per object)
+  <data of the first object><data of the second object>...
+
+Both writing and reading stream the objects in blocks, so objects of any
+size can be handled, and a reader can use the index to skip the objects
+it already has.
+'''
+
+import os
+import tempfile
+import binascii
+
+from mercurial import util
+from mercurial.i18n import _
+
+import bfutil
+
+_magic = 'kbfbundle 1\n'
+
+def write(ui, filename, sources):
+    '''Write a bundle holding sources, a list of (hash, path) pairs.'''
+    sizes = [bfutil.cached_object_size(path) for (hash, path) in sources]
+    # An unfinished bundle is removed when fd is garbage collected.
+    fd = util.atomictempfile(filename, 'wb')
+    fd.write(_magic)
+    fd.write('%d\n' % len(sources))
+    for (hash, path), size in zip(sources, sizes):
+        fd.write('%s %d\n' % (hash, size))
+    at = 0
+    for (hash, path), size in zip(sources, sizes):
+        ui.progress(_('Bundling bfiles'), at, unit=_('bfile'), total=len(sources))
+        at += 1
+        written = 0
+        for data in bfutil.cachedstream(path):
+            fd.write(data)
+            written += len(data)
+        if written != size:
+            raise util.Abort(_('%s changed while it was being bundled') % path)
+    ui.progress(_('Bundling bfiles'), None)
+    fd.rename()
+
+def read(ui, filename):
+    '''Add the objects in the bundle filename to the system cache.
+    Return (added, skipped): how many objects were added and how many
+    were there already.'''
+    infile = open(filename, 'rb')
+    try:
+        if infile.readline() != _magic:
+            raise util.Abort(_('%s: not a big file bundle') % filename)
+        try:
+            count = int(infile.readline())
+            index = []
+            for i in xrange(count):
+                hash, size = infile.readline().split()
+                index.append((hash, int(size)))
+        except ValueError:
+            raise util.Abort(_('%s: damaged big file bundle') % filename)
+
+        added = 0
+        skipped = 0
+        at = 0
+        for hash, size in index:
+            ui.progress(_('Unbundling bfiles'), at, unit=_('bfile'), total=len(index))
+            at += 1
+            if bfutil.in_system_cache(ui, hash):
+                infile.seek(size, os.SEEK_CUR)
+                skipped += 1
+                continue
+            try:
+                _receive(ui, hash, infile, size)
+            except IOError:
+                raise util.Abort(_('%s: truncated big file bundle') % filename)
+            added += 1
+        ui.progress(_('Unbundling bfiles'), None)
+        return (added, skipped)
+    finally:
+        infile.close()
+
+def _receive(ui, hash, infile, size):
+    cachedir = os.path.dirname(bfutil.system_cache_path(ui, hash))
+    bfutil.create_dir(cachedir)
+    (tmpfd, tmpfilename) = tempfile.mkstemp(dir=cachedir, prefix='.tmp-' + hash)
+    try:
+        hhash = binascii.hexlify(bfutil.copy_and_hash(
+            bfutil.readchunks(infile, size), os.fdopen(tmpfd, 'wb')))
+        if hhash != hash:
+            raise util.Abort(_('%s: data corruption in bundle (got %s)')
+                             % (hash, hhash))
+        bfutil.put_in_system_cache(ui, hash, tmpfilename, move=True)
+    finally:
+        if os.path.exists(tmpfilename):
+            os.unlink(tmpfilename)
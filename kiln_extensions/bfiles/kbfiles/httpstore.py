@@ -1,16 +1,35 @@
 '''HTTP-based store.'''
 
+import os
+import socket
+import tempfile
+import binascii
 import urlparse
 import urllib2
 
 from mercurial import util, url as url_
 from mercurial.i18n import _
 
-import bfutil, basestore
+import bfutil, basestore, bftransfer
+
+class _limitedsendfile(url_.httpsendfile):
+    '''httpsendfile whose reads are paced by a ratelimiter.'''
+    ratelimit = None
+
+    def read(self, *args):
+        data = url_.httpsendfile.read(self, *args)
+        if self.ratelimit:
+            self.ratelimit.consume(len(data))
+        return data
 
 class httpstore(basestore.basestore):
     """A store accessed via HTTP"""
+    remote = True
+
     def __init__(self, ui, repo, url):
+        self.location = url
+        # set by the upload queue to limit upload bandwidth
+        self.ratelimit = None
         url = bfutil.urljoin(url, 'bfile')
         super(httpstore, self).__init__(ui, repo, url)
         self.rawurl, self.path = urlparse.urlsplit(self.url)[1:3]
@@ -19,24 +38,31 @@ class httpstore(basestore.basestore):
 
     def put(self, source, hash):
         self.sendfile(source, hash)
-        self.ui.debug('put %s to remote store\n' % source)
+        self._say('debug', 'put %s to remote store\n' % source)
 
     def exists(self, hash):
-        return self._verify(hash)
+        if hash in self.ledger():
+            return True
+        if self._verify(hash):
+            self.ledger().add([hash])
+            return True
+        return False
 
     def sendfile(self, filename, hash):
-        if self._verify(hash):
+        if self.exists(hash):
             return
 
-        self.ui.debug('httpstore.sendfile(%s, %s)\n' % (filename, hash))
+        self._say('debug', 'httpstore.sendfile(%s, %s)\n' % (filename, hash))
         baseurl, authinfo = url_.getauthinfo(self.url)
         fd = None
         try:
-            fd = url_.httpsendfile(filename, 'rb')
+            fd = _limitedsendfile(filename, 'rb')
+            fd.ratelimit = self.ratelimit
             request = urllib2.Request(bfutil.urljoin(baseurl, hash), fd)
             try:
                 url = self.opener.open(request)
-                self.ui.note(_('[OK] %s/%s\n') % (self.rawurl, url.geturl()))
+                self._say('note', _('[OK] %s/%s\n') % (self.rawurl, url.geturl()))
+                self.ledger().add([hash])
             except urllib2.HTTPError, e:
                 raise util.Abort(_('unable to POST: %s\n') % e.msg)
         except Exception, e:
@@ -44,6 +70,75 @@ class httpstore(basestore.basestore):
         finally:
             if fd: fd.close()
 
+    def _prefetch(self, hashes):
+        bftransfer.prefetch(self.ui, self.location, hashes)
+
+        # Get whatever is still missing in batches, one response each.
+        hashes = [hash for hash in hashes
+                  if not bfutil.in_system_cache(self.ui, hash)]
+        batchsize = int(self.ui.config(bfutil.long_name, 'batchsize', '100') or 100)
+        at = 0
+        for i in xrange(0, len(hashes), batchsize):
+            self.ui.progress(_('Getting kbfiles'), at, unit='kbfile', total=len(hashes))
+            if not self._getmulti(hashes[i:i + batchsize]):
+                break
+            at += len(hashes[i:i + batchsize])
+        self.ui.progress(_('Getting kbfiles'), None)
+
+    def _getmulti(self, hashes):
+        '''Get hashes into the system cache with a single request: the
+        store answers with a "<hash> <length>" line followed by the data
+        for each hash it has ("<hash> -" for the others).  Return False
+        if the store does not understand such requests.'''
+        (baseurl, authinfo) = url_.getauthinfo(self.url)
+        request = urllib2.Request(bfutil.urljoin(baseurl, 'multi'),
+                                  ''.join(['%s\n' % hash for hash in hashes]))
+        request.add_header('Content-Type', 'application/x-kbfiles-hashes')
+        try:
+            infile = self.opener.open(request)
+        except (urllib2.HTTPError, urllib2.URLError), err:
+            self.ui.debug('multi-object get not available: %s\n' % err)
+            return False
+        try:
+            if infile.info().get('Content-Type') != 'application/x-kbfiles-multi':
+                self.ui.debug('multi-object get not supported by %s\n' % baseurl)
+                return False
+            try:
+                while True:
+                    header = infile.readline()
+                    if not header:
+                        break
+                    hash, length = header.rstrip('\n').split(' ')
+                    if length != '-':
+                        self._receive(hash, infile, int(length))
+            except (ValueError, IOError, socket.error), err:
+                # Whatever we did not get will be fetched one by one.
+                self.ui.debug('multi-object get failed: %s\n' % err)
+            return True
+        finally:
+            infile.close()
+
+    def _receive(self, hash, infile, length):
+        '''Read the next length bytes of infile into the system cache as
+        hash, if that is what they hash to.'''
+        cachedir = os.path.dirname(bfutil.system_cache_path(self.ui, hash))
+        bfutil.create_dir(cachedir)
+        (tmpfd, tmpfilename) = tempfile.mkstemp(dir=cachedir, prefix='.tmp-' + hash)
+        try:
+            hhash = binascii.hexlify(bfutil.copy_and_hash(
+                bfutil.readchunks(infile, length), os.fdopen(tmpfd, 'w')))
+            if hhash != hash:
+                self.ui.warn(_('%s: data corruption (expected %s, got %s)\n')
+                             % (self.rawurl, hash, hhash))
+                os.remove(tmpfilename)
+                return
+            bfutil.put_in_system_cache(self.ui, hash, tmpfilename, move=True)
+            self.ledger().add([hash])
+        except:
+            if os.path.exists(tmpfilename):
+                os.remove(tmpfilename)
+            raise
+
     def _getfile(self, tmpfile, filename, hash):
         (baseurl, authinfo) = url_.getauthinfo(self.url)
         url = bfutil.urljoin(baseurl, hash)
@@ -88,6 +183,8 @@ class httpstore(basestore.basestore):
         expect_hash = fctx.data()[0:40]
         store_path = bfutil.urljoin(baseurl, expect_hash)
         verified.add(key)
+        if expect_hash in self.ledger():
+            return False
 
         request = urllib2.Request(store_path)
         request.add_header('SHA1-Request',expect_hash)
@@ -96,6 +193,7 @@ class httpstore(basestore.basestore):
             if 'Content-SHA1' in url.info():
                 rhash = url.info()['Content-SHA1']
                 if rhash == expect_hash:
+                    self.ledger().add([expect_hash])
                     return False
                 else:
                     self.ui.warn(
@@ -115,4 +213,3 @@ class httpstore(basestore.basestore):
             else:
                 raise util.Abort(_('check failed, unexpected response'
                                    'status: %d: %s') % (e.code, e.msg))
-
@@ -1,29 +1,61 @@
 '''Store class for local filesystem.'''
 
 import os
+import tempfile
 
 from mercurial import util
 from mercurial.i18n import _
 import bfutil, basestore
 
 class localstore(basestore.basestore):
-    '''Because there is a system wide cache, the local store always uses that cache.
-       Since the cache is updated elsewhere, we can just read from it here as if it were the store.'''
+    '''The cache of another repository on this machine, <repo>/.hg/kilnbfiles.
+       Files are read from there, or from the system wide cache that all
+       local repositories share; they are put there (and only there).'''
 
     def __init__(self, ui, repo, url):
         url = os.path.join(url, '.hg', bfutil.long_name)
         super(localstore, self).__init__(ui, repo, util.expandpath(url))
 
-    def put(self, source, filename, hash):
-        '''Any file that is put must already be in the system wide cache so do nothing.'''
-        return
+    def put(self, source, hash):
+        '''Link (or copy) source into the repository cache.  source may
+        be a compressed cached object, which keeps its .z name there.'''
+        if self._find(hash) is not None:
+            return
+        name = hash
+        if bfutil.is_compressed(source):
+            name += bfutil._zsuffix
+        bfutil.create_dir(self.url)
+        (tmpfd, tmpfilename) = tempfile.mkstemp(dir=self.url,
+                                                prefix='.tmp-' + hash)
+        os.close(tmpfd)
+        os.unlink(tmpfilename)
+        try:
+            bfutil.link(source, tmpfilename)
+            os.rename(tmpfilename, os.path.join(self.url, name))
+        except:
+            try:
+                os.unlink(tmpfilename)
+            except OSError:
+                pass
+            raise
 
     def exists(self, hash):
-        return bfutil.in_system_cache(self.repo.ui, hash)
+        return self._find(hash) is not None
+
+    def _find(self, hash):
+        '''Return the path of hash in the repository cache, loose or
+        packed, or None.'''
+        path = os.path.join(self.url, hash)
+        if os.path.exists(path):
+            return path
+        if os.path.exists(path + bfutil._zsuffix):
+            return path + bfutil._zsuffix
+        return bfutil.find_in_packs(self.url, hash)
 
     def _getfile(self, tmpfile, filename, hash):
-        if bfutil.in_system_cache(self.ui, hash):
-            return bfutil.system_cache_path(self.ui, hash)
+        path = self._find(hash) or bfutil.find_system_file(self.ui, hash)
+        if path is not None:
+            return bfutil.copy_and_hash(bfutil.cachedstream(path), tmpfile)
         raise basestore.StoreError(filename, hash, '', _("Can't get file locally"))
 
     def _verifyfile(self, cctx, cset, contents, standin, verified):
@@ -37,16 +69,18 @@ class localstore(basestore.basestore):
 
         expect_hash = fctx.data()[0:40]
         verified.add(key)
-        if not bfutil.in_system_cache(self.ui, expect_hash):
+        # where _getfile() would read it from
+        store_path = (self._find(expect_hash) or
+                      bfutil.find_system_file(self.ui, expect_hash))
+        if store_path is None:
             self.ui.warn(
                 _('changeset %s: %s missing\n'
-                  '  (%s: %s)\n')
-                % (cset, filename, expect_hash, err.strerror))
+                  '  (%s)\n')
+                % (cset, filename, expect_hash))
             return True                 # failed
 
         if contents:
-            store_path = bfutil.system_cache_path(self.ui, expect_hash)
-            actual_hash = bfutil.hashfile(store_path)
+            actual_hash = bfutil.hashcached(store_path)
             if actual_hash != expect_hash:
                 self.ui.warn(
                     _('changeset %s: %s: contents differ\n'
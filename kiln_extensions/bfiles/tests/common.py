@@ -1,6 +1,8 @@
 import sys
 import os
 import stat
+import time
+import socket
 import subprocess
 
 import hgtest
@@ -141,6 +143,54 @@ class BfilesTester(hgtest.Tester):
         user = os.environ.get('LOGNAME', os.environ.get('USER'))
         return "ssh://%s@localhost/%s" % (user, STOREDIR)
 
+    def storeserver(self, repo='remote', storedir='httpstore'):
+        '''Return a StoreServer for repo, with its big files in storedir
+        (both relative to the current directory).'''
+        return StoreServer(self, repo, storedir)
+
+class StoreServer(object):
+    '''An HTTP central store (storeserver.py) on $HGPORT, serving a
+    Mercurial repository and big files the way Kiln does.  start() and
+    stop() may be called any number of times, from any directory.'''
+    def __init__(self, hgt, repo, storedir):
+        self.hgt = hgt
+        self.repo = os.path.abspath(repo)
+        self.storedir = os.path.abspath(storedir)
+        self.port = int(os.environ.get('HGPORT', '20059'))
+        self.url = 'http://localhost:%d/' % self.port
+        self.process = None
+
+    def start(self, *args):
+        '''(Re)start the server with the extra storeserver.py options in
+        args, and wait until it accepts connections.'''
+        self.stop()
+        self.process = subprocess.Popen(
+            [sys.executable, self.hgt.tjoin('storeserver.py')] + list(args) +
+            [self.repo, self.storedir, str(self.port)])
+        for i in xrange(100):
+            try:
+                socket.create_connection(('localhost', self.port)).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        self.hgt.asserttrue(False, 'store server did not start')
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    def requests(self):
+        '''Return the big file requests logged since the last call, as
+        lists of fields such as ['get', hash], and clear the log.'''
+        log = os.path.join(self.storedir, 'requests.log')
+        if not os.path.exists(log):
+            return []
+        lines = self.hgt.readfile(log).splitlines()
+        os.unlink(log)
+        return [line.split(' ') for line in lines]
+
 # This deliberately does not use mercurial.util.sha1() -- don't want to
 # depend on code that we might be testing.
 try:
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+#
+# Minimal HTTP central store for tests: serves the Mercurial repository
+# REPO with hgweb, and big files from STOREDIR under /bfile/ the way
+# Kiln does:
+#
+#   GET  /bfile/<hash>          the file (with a SHA1-Request header:
+#                               only its hash, in Content-SHA1)
+#   POST /bfile/<hash>          upload the file
+#   POST /bfile/multi           several files in one response (unless
+#                               --no-multi is given)
+#
+# Every big file request is logged to STOREDIR/requests.log.
+#
+# usage: storeserver.py [--no-multi] REPO STOREDIR PORT
+
+import os
+import sys
+import hashlib
+from wsgiref import simple_server
+
+from mercurial.hgweb import hgweb
+
+def storeapp(repo, storedir, multi):
+    web = hgweb(repo)
+    def log(msg):
+        fd = open(os.path.join(storedir, 'requests.log'), 'a')
+        fd.write(msg + '\n')
+        fd.close()
+
+    def app(environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith('/bfile/'):
+            return web(environ, start_response)
+        name = path[len('/bfile/'):]
+        method = environ['REQUEST_METHOD']
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+
+        if name == 'multi' and method == 'POST' and multi:
+            hashes = environ['wsgi.input'].read(length).split()
+            log('multi %d' % len(hashes))
+            start_response('200 OK', [('Content-Type', 'application/x-kbfiles-multi')])
+            out = []
+            for hash in hashes:
+                filename = os.path.join(storedir, hash)
+                if os.path.isfile(filename):
+                    data = open(filename, 'rb').read()
+                    out.append('%s %d\n%s' % (hash, len(data), data))
+                else:
+                    out.append('%s -\n' % hash)
+            return out
+
+        filename = os.path.join(storedir, name)
+        if len(name) != 40 or method not in ('GET', 'POST'):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['not found\n']
+        if method == 'POST':
+            data = environ['wsgi.input'].read(length)
+            log('put %s' % name)
+            if hashlib.sha1(data).hexdigest() != name:
+                start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+                return ['hash mismatch\n']
+            open(filename, 'wb').write(data)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['ok\n']
+        if not os.path.isfile(filename):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['not found\n']
+        data = open(filename, 'rb').read()
+        if environ.get('HTTP_SHA1_REQUEST'):
+            log('exists %s' % name)
+            start_response('200 OK', [('Content-Type', 'text/plain'),
+                                      ('Content-SHA1', hashlib.sha1(data).hexdigest())])
+            return ['']
+        log('get %s' % name)
+        start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                                  ('Content-Length', str(len(data)))])
+        return [data]
+    return app
+
+class quiethandler(simple_server.WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    multi = '--no-multi' not in args
+    args = [arg for arg in args if arg != '--no-multi']
+    repo, storedir, port = args
+    if not os.path.isdir(storedir):
+        os.makedirs(storedir)
+    server = simple_server.make_server('localhost', int(port),
+                                       storeapp(repo, storedir, multi),
+                                       handler_class=quiethandler)
+    server.serve_forever()
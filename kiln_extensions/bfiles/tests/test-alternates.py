@@ -0,0 +1,38 @@
+#!/usr/bin/python
+#
+# Test getting bfiles from read-only alternate caches
+
+import os
+import common
+
+hgt = common.BfilesTester()
+
+hgt.updaterc()
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('n1', 'n1')
+hgt.writefile('b1', 'b1')
+hgt.writefile('dir/b2', 'b2')
+hgt.hg(['add', 'n1'])
+hgt.hg(['add', '--bf', 'b1', 'dir/b2'])
+hgt.hg(['commit', '-m', 'add files'])
+hashes = [common.sha1('b1'), common.sha1('dir/b2')]
+os.chdir('..')
+
+hgt.announce('clone from an alternate')
+os.rename('bfilesstore', 'alternate')
+hgt.updaterc({'kilnbfiles': [('alternates', os.path.abspath('alternate'))]})
+hgt.hg(['clone', 'repo1', 'repo2'],
+        stdout='''updating to branch default
+3 files updated, 0 files merged, 0 files removed, 0 files unresolved
+Getting changed bfiles
+2 big files updated, 0 removed
+''')
+hgt.assertequals('b1', hgt.readfile('repo2/b1'))
+hgt.assertequals('b2', hgt.readfile('repo2/dir/b2'))
+# nothing was copied out of the alternate
+for hash in hashes:
+    hgt.assertfilegone(os.path.join('bfilesstore', hash))
+    hgt.assertfilegone(os.path.join('repo2', '.hg', 'kilnbfiles', hash))
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+#
+# Test moving bfiles with kbfbundle and kbfunbundle
+
+import os
+import shutil
+import common
+
+hgt = common.BfilesTester()
+
+hgt.updaterc()
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('n1', 'n1')
+hgt.writefile('b1', 'b1')
+hgt.writefile('dir/b2', 'b2')
+hgt.hg(['add', 'n1'])
+hgt.hg(['add', '--bf', 'b1', 'dir/b2'])
+hgt.hg(['commit', '-m', 'add files'])
+hgt.writefile('b1', 'b11')
+hgt.hg(['commit', '-m', 'change b1'])
+
+hgt.announce('bundle')
+hgt.hg(['kbfbundle', '-r', '0', '../rev0.kbf'],
+        stdout='''2 big files written to ../rev0.kbf
+''')
+hgt.hg(['kbfbundle', '../all.kbf'],
+        stdout='''3 big files written to ../all.kbf
+''')
+os.chdir('..')
+
+hgt.announce('unbundle')
+shutil.rmtree('bfilesstore')
+hgt.hg(['kbfunbundle', 'rev0.kbf'],
+        stdout='''2 big files added, 0 already present
+''')
+hgt.hg(['kbfunbundle', 'all.kbf'],
+        stdout='''1 big files added, 2 already present
+''')
+hgt.hg(['clone', 'repo1', 'repo2'],
+        stdout='''updating to branch default
+3 files updated, 0 files merged, 0 files removed, 0 files unresolved
+Getting changed bfiles
+2 big files updated, 0 removed
+''')
+hgt.assertequals('b11', hgt.readfile('repo2/b1'))
+hgt.assertequals('b2', hgt.readfile('repo2/dir/b2'))
+
+hgt.announce('damaged bundle')
+hgt.writefile('bad.kbf', 'not a bundle\n')
+hgt.hg(['kbfunbundle', 'bad.kbf'],
+        stderr='''abort: bad.kbf: not a big file bundle
+''', status=255)
@@ -55,3 +55,34 @@ A dir/n2
 ''')
 hgt.hg(['commit', '-m', 'adding', 'dir/b2', 'dir/n2'])
 hgt.hg(['status'])
+
+hgt.announce('commit only refreshes the standins of dirty bfiles')
+# Change b1 behind the dirstate's back, keeping its size and mtime: a
+# commit that rehashed every bfile would pick the change up, one that
+# only looks at the dirty bfiles leaves its standin alone.
+os.utime('b1', (1000000000, 1000000000))
+hgt.hg(['status'])
+standin = hgt.readfile('.kbf/b1')
+hgt.writefile('b1', 'x1')
+os.utime('b1', (1000000000, 1000000000))
+hgt.writefile('dir/b2', 'b22')
+hgt.writefile('n1', 'n11')
+hgt.hg(['commit', '-m', 'change dir/b2 and n1'])
+hgt.assertequals(standin, hgt.readfile('.kbf/b1'))
+hgt.assertequals(common.sha1('dir/b2') + '\n', hgt.readfile('.kbf/dir/b2'))
+hgt.hg(['status'])
+
+if os.name == 'posix':
+    hgt.announce('commit an in-place edit of a hard linked bfile')
+    hgt.updaterc({'kilnbfiles': [('wcopy', 'hardlink')]})
+    hgt.hg(['update', 'null'], stdout=hgt.ANYTHING)
+    hgt.hg(['update'], stdout=hgt.ANYTHING)
+    oldstandin = hgt.readfile('.kbf/dir/b2')
+    # Same size, same inode as the cached object: only hashing tells.
+    fd = open('dir/b2', 'r+b')
+    fd.write('x22')
+    fd.close()
+    hgt.hg(['commit', '-m', 'edit dir/b2 in place'])
+    hgt.assertequals(common.sha1('dir/b2') + '\n', hgt.readfile('.kbf/dir/b2'))
+    hgt.asserttrue(oldstandin != hgt.readfile('.kbf/dir/b2'), 'edit not committed')
+    hgt.hg(['status'])
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+#
+# Test keeping bfiles compressed in the system cache
+
+import os
+import common
+
+hgt = common.BfilesTester()
+
+def diskusage(*dirs):
+    '''Return the bytes used by the files under dirs, counting files
+    that are hard links to each other once.'''
+    seen = set()
+    total = 0
+    for dir in dirs:
+        for root, dirnames, filenames in os.walk(dir):
+            for name in filenames:
+                st = os.lstat(os.path.join(root, name))
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    total += st.st_size
+    return total
+
+hgt.updaterc({'kilnbfiles': [('compress', 'true')]})
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('b1', 'a' * 100000)
+hgt.writefile('b2', os.urandom(10000))
+hgt.hg(['add', '--bf', 'b1', 'b2'])
+hgt.hg(['commit', '-m', 'add bfiles'])
+hash1 = common.sha1('b1')
+hash2 = common.sha1('b2')
+os.chdir('..')
+
+hgt.announce('only compressible bfiles are compressed')
+hgt.assertfile(os.path.join('bfilesstore', hash1 + '.z'))
+hgt.assertfilegone(os.path.join('bfilesstore', hash1))
+hgt.assertfile(os.path.join('bfilesstore', hash2))
+hgt.assertfilegone(os.path.join('bfilesstore', hash2 + '.z'))
+
+hgt.announce('the repository cache keeps no raw copy of compressed bfiles')
+hgt.assertfile(os.path.join('repo1', '.hg', 'kilnbfiles', hash1 + '.z'))
+hgt.assertfilegone(os.path.join('repo1', '.hg', 'kilnbfiles', hash1))
+# b2 (10000 bytes, shared by both caches) plus b1 compressed and the
+# bookkeeping files, far less than b1 (100000 bytes) kept raw.
+usage = diskusage('bfilesstore', os.path.join('repo1', '.hg', 'kilnbfiles'))
+hgt.asserttrue(usage < 20000, 'caches use %d bytes' % usage)
+
+hgt.announce('clone from the compressed cache')
+hgt.hg(['clone', 'repo1', 'repo2'],
+        stdout='''updating to branch default
+2 files updated, 0 files merged, 0 files removed, 0 files unresolved
+Getting changed bfiles
+2 big files updated, 0 removed
+''')
+hgt.assertequals('a' * 100000, hgt.readfile('repo2/b1'))
+hgt.assertequals(hgt.readfile('repo1/b2'), hgt.readfile('repo2/b2'))
+hgt.assertfilegone(os.path.join('repo2', '.hg', 'kilnbfiles', hash1))
+usage = diskusage('bfilesstore', os.path.join('repo1', '.hg', 'kilnbfiles'),
+                  os.path.join('repo2', '.hg', 'kilnbfiles'))
+hgt.asserttrue(usage < 20000, 'caches use %d bytes' % usage)
+
+hgt.announce('verify the compressed cache')
+os.chdir('repo2')
+hgt.hg(['verify', '--bf'], stdout=hgt.ANYTHING)
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+#
+# Test checking the integrity of the bfile caches
+
+import os
+import hashlib
+import common
+
+hgt = common.BfilesTester()
+
+def quarantine(cachedir):
+    qdir = os.path.join(cachedir, '.quarantine')
+    if not os.path.isdir(qdir):
+        return []
+    return sorted(os.listdir(qdir))
+
+hgt.updaterc()
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('b1', 'b1')
+hgt.writefile('b2', 'b2')
+hgt.writefile('b3', 'b3')
+hgt.hg(['add', '--bf', 'b1', 'b2', 'b3'])
+hgt.hg(['commit', '-m', 'add bfiles'])
+hash1 = common.sha1('b1')
+store = os.path.join('..', 'bfilesstore')
+
+hgt.announce('intact caches')
+hgt.hg(['kbffsck'], stdout=hgt.ANYTHING)
+hgt.assertequals([], quarantine(store))
+
+hgt.announce('resume a check interrupted in the repository cache')
+# The repository cache is checked first, then the system cache, although
+# the system cache's path sorts first here.
+cachedirs = [os.path.realpath(os.path.join('.hg', 'kilnbfiles')),
+             os.path.abspath(store)]
+checkpoint = os.path.join(store, '.fsck',
+                          hashlib.sha1('\0'.join(cachedirs)).hexdigest())
+last = max([name for name in os.listdir(cachedirs[0]) if len(name) == 40])
+hgt.writefile(checkpoint, '0\0' + last, 'wb')
+hgt.hg(['kbffsck'],
+        stdout='''resuming interrupted check
+checking 3 big files
+checked 3 big files (6 bytes), 0 damaged
+''')
+hgt.assertfilegone(checkpoint)
+
+hgt.announce('damaged loose file')
+os.unlink(os.path.join(store, hash1))
+hgt.writefile(os.path.join(store, hash1), 'damaged')
+hgt.hg(['kbffsck'], stdout=hgt.ANYTHING, stderr=hgt.ANYTHING, status=1)
+hgt.assertequals([hash1], quarantine(store))
+hgt.assertfilegone(os.path.join(store, hash1))
+hgt.hg(['kbffsck'], stdout=hgt.ANYTHING)
+
+hgt.announce('damaged pack')
+hgt.hg(['kbfrepack'], stdout=hgt.ANYTHING)
+packs = [name for name in os.listdir(os.path.join(store, '.packs'))
+         if name.endswith('.pack')]
+hgt.assertequals(1, len(packs))
+pack = os.path.join(store, '.packs', packs[0])
+data = hgt.readfile(pack, 'rb')
+# the first object starts right after the 8 byte header
+hgt.writefile(pack, data[:8] + 'x' + data[9:], 'wb')
+hgt.hg(['kbffsck'], stdout=hgt.ANYTHING, stderr=hgt.ANYTHING, status=1)
+hgt.assertequals([hash1, packs[0][:-len('.pack')] + '.idx', packs[0]],
+                 quarantine(store))
+# the intact objects were unpacked
+hgt.assertequals([], [name for name in os.listdir(os.path.join(store, '.packs'))
+                      if name.startswith('pack-')])
+hgt.hg(['kbffsck'], stdout=hgt.ANYTHING)
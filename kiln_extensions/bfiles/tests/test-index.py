@@ -0,0 +1,68 @@
+#!/usr/bin/python
+#
+# Test the persistent index of the big files in each changeset
+
+import os
+import common
+
+hgt = common.BfilesTester()
+
+index = '.hg/kilnbfiles/standins.i'
+record = 40
+
+def indexed():
+    return os.path.getsize(index) // record
+
+hgt.updaterc()
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('b1', 'b1')
+hgt.writefile('b2', 'b2')
+hgt.hg(['add', '--bf', 'b1', 'b2'])
+hgt.hg(['commit', '-m', 'add bfiles'])
+hgt.writefile('b1', 'b11')
+hgt.hg(['commit', '-m', 'change b1'])
+hgt.hg(['rm', 'b2'])
+hgt.hg(['commit', '-m', 'remove b2'])
+
+hgt.announce('first use indexes every revision')
+hgt.hg(['status'])
+hgt.assertequals(3, indexed())
+hgt.hg(['status', '--rev', '0'],
+        stdout='''M b1
+R b2
+''')
+
+hgt.announce('incremental update')
+size = os.path.getsize('.hg/kilnbfiles/standins.d')
+hgt.writefile('b3', 'b3')
+hgt.hg(['add', '--bf', 'b3'])
+hgt.hg(['commit', '-m', 'add b3'])
+hgt.hg(['status'])
+hgt.assertequals(4, indexed())
+hgt.asserttrue(os.path.getsize('.hg/kilnbfiles/standins.d') > size,
+               'index data not appended')
+hgt.hg(['status', '--rev', '1'],
+        stdout='''A b3
+R b2
+''')
+
+hgt.announce('rollback drops the stale record')
+hgt.hg(['rollback'], stdout=hgt.ANYTHING)
+hgt.hg(['status'],
+        stdout='''A b3
+''')
+hgt.assertequals(3, indexed())
+hgt.hg(['commit', '-m', 'add b3 again'])
+
+hgt.announce('rebuild after the index is removed')
+os.unlink(index)
+os.unlink('.hg/kilnbfiles/standins.d')
+hgt.hg(['status', '--rev', '0'],
+        stdout='''M b1
+A b3
+R b2
+''')
+hgt.assertequals(4, indexed())
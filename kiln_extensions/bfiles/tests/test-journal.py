@@ -0,0 +1,95 @@
+#!/usr/bin/python
+#
+# Test the journal of small bfdirstate changes: appending, replaying,
+# compacting, and recovering from torn or stale journals
+
+import os
+import common
+
+hgt = common.BfilesTester()
+
+journal = os.path.join('.hg', 'kilnbfiles', 'dirstate.journal')
+clock = [1000000]
+
+def touch(*names):
+    '''Change the mtime of names but not their contents, so that the
+    next status has to hash them and mark them clean again.'''
+    for name in names:
+        clock[0] += 10
+        os.utime(name, (clock[0], clock[0]))
+
+def readjournal():
+    if not os.path.exists(journal):
+        return None
+    return hgt.readfile(journal, 'rb')
+
+hgt.updaterc({'kilnbfiles': [('journalentries', '4')]})
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('b1', 'b1')
+hgt.writefile('b2', 'b2')
+hgt.writefile('b3', 'b3')
+hgt.hg(['add', '--bf', 'b1', 'b2', 'b3'])
+hgt.hg(['commit', '-m', 'add bfiles'])
+hgt.hg(['status'])
+if os.path.exists(journal):
+    os.unlink(journal)
+
+hgt.announce('append')
+touch('b1')
+hgt.hg(['status'])
+data = readjournal()
+hgt.asserttrue(data is not None and data.startswith('kbfjournal '),
+               'no journal written')
+dirstate = hgt.readfile(os.path.join('.hg', 'kilnbfiles', 'dirstate'), 'rb')
+
+hgt.announce('replay')
+# b1 is clean according to the journal, so nothing is written again
+hgt.hg(['status'])
+hgt.assertequals(data, readjournal())
+hgt.assertequals(dirstate,
+                 hgt.readfile(os.path.join('.hg', 'kilnbfiles', 'dirstate'), 'rb'))
+touch('b2', 'b3')
+hgt.hg(['status'])
+hgt.asserttrue(len(readjournal()) > len(data), 'journal not appended to')
+
+hgt.announce('compact')
+touch('b1', 'b2', 'b3')
+hgt.hg(['status'])
+hgt.assertequals(None, readjournal())
+hgt.hg(['status'])
+hgt.assertequals(None, readjournal())
+
+hgt.announce('torn tail')
+touch('b1')
+hgt.hg(['status'])
+data = readjournal()
+hgt.writefile(journal, data + 'n\0\0', 'ab')
+hgt.hg(['status'])
+hgt.assertequals(data + 'n\0\0', readjournal())
+# the next change rewrites the dirstate rather than appending
+touch('b2')
+hgt.hg(['status'])
+hgt.assertequals(None, readjournal())
+hgt.hg(['status'])
+hgt.assertequals(None, readjournal())
+
+hgt.announce('stale header')
+touch('b1')
+hgt.hg(['status'])
+data = readjournal()
+stale = 'kbfjournal 1 2 3\n' + data[data.index('\n') + 1:]
+hgt.writefile(journal, stale, 'wb')
+# the journal is ignored, so b1 is hashed again and a new journal started
+hgt.hg(['status'])
+data = readjournal()
+hgt.asserttrue(data is not None and data != stale and
+               data.startswith('kbfjournal '), 'stale journal kept')
+hgt.hg(['status'])
+hgt.assertequals(data, readjournal())
+hgt.writefile('b1', 'changed')
+hgt.hg(['status'],
+        stdout='''M b1
+''')
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+#
+# Test the ledger of bfiles known to be in a central store
+
+import os
+import shutil
+import binascii
+import common
+
+hgt = common.BfilesTester()
+
+hgt.updaterc()
+server = hgt.storeserver()
+url = server.url
+present = os.path.abspath('bfilesstore/.present')
+
+def ledger():
+    '''Return the sorted hashes in every ledger, sorted part and
+    journal alike.'''
+    hashes = set()
+    if not os.path.isdir(present):
+        return []
+    for name in os.listdir(present):
+        if name.endswith('.lock'):
+            continue
+        data = hgt.readfile(os.path.join(present, name), 'rb')
+        hashes.update([binascii.hexlify(data[i:i + 20])
+                       for i in xrange(0, len(data), 20)])
+    return sorted(hashes)
+
+hgt.announce('setup')
+hgt.hg(['init', 'remote'])
+hgt.writefile('remote/.hg/hgrc', '[web]\npush_ssl = false\nallow_push = *\n')
+server.start()
+try:
+    hgt.hg(['clone', url, 'repo1'], stdout=hgt.ANYTHING)
+    os.chdir('repo1')
+    hgt.writefile('b1', 'b1')
+    hgt.writefile('b2', 'b2')
+    hgt.hg(['add', '--bf', 'b1', 'b2'])
+    hgt.hg(['commit', '-m', 'add b1 and b2'])
+    b1, b2 = common.sha1('b1'), common.sha1('b2')
+
+    hgt.announce('push records uploaded bfiles')
+    hgt.hg(['push'], stdout=hgt.ANYTHING)
+    hgt.assertequals(sorted([b1, b2]), ledger())
+    os.chdir('..')
+
+    hgt.announce('clone records downloaded bfiles')
+    shutil.rmtree('bfilesstore')
+    hgt.hg(['clone', url, 'repo2'], stdout=hgt.ANYTHING)
+    hgt.assertequals(sorted([b1, b2]), ledger())
+
+    hgt.announce('pull records only what it downloads')
+    os.chdir('repo1')
+    hgt.writefile('b3', 'b3')
+    hgt.hg(['add', '--bf', 'b3'])
+    hgt.hg(['commit', '-m', 'add b3'])
+    b3 = common.sha1('b3')
+    hgt.hg(['push'], stdout=hgt.ANYTHING)
+    os.chdir('..')
+    shutil.rmtree('bfilesstore')
+    os.chdir('repo2')
+    hgt.hg(['pull', '--update'], stdout=hgt.ANYTHING)
+    hgt.assertequals('b3', hgt.readfile('b3'))
+    hgt.assertequals([b3], ledger())
+    os.chdir('..')
+
+    hgt.announce('local stores keep no ledger')
+    shutil.rmtree('bfilesstore')
+    hgt.hg(['clone', 'repo1', 'repo3'], stdout=hgt.ANYTHING)
+    hgt.assertequals('b3', hgt.readfile('repo3/b3'))
+    hgt.assertequals([], ledger())
+finally:
+    server.stop()
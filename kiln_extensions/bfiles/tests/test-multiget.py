@@ -0,0 +1,65 @@
+#!/usr/bin/python
+#
+# Test getting many bfiles from an HTTP store in one request, and falling
+# back to one request per bfile for stores that cannot do that
+
+import os
+import shutil
+import common
+
+hgt = common.BfilesTester()
+
+hgt.updaterc()
+server = hgt.storeserver()
+url = server.url
+
+def requests():
+    return [fields[0] for fields in server.requests()]
+
+hgt.announce('setup')
+hgt.hg(['init', 'remote'])
+hgt.writefile('remote/.hg/hgrc', '[web]\npush_ssl = false\nallow_push = *\n')
+server.start()
+try:
+    hgt.hg(['clone', url, 'repo1'], stdout=hgt.ANYTHING)
+    os.chdir('repo1')
+    hgt.writefile('b1', 'b1')
+    hgt.writefile('dir/b2', 'b2')
+    hgt.writefile('dir/b3', 'b1')
+    hgt.hg(['add', '--bf', 'b1', 'dir/b2', 'dir/b3'])
+    hgt.hg(['commit', '-m', 'add bfiles'])
+    hgt.hg(['push'], stdout=hgt.ANYTHING)
+    hgt.assertequals(['put', 'put'], [r for r in requests() if r == 'put'])
+    os.chdir('..')
+
+    hgt.announce('one request for all bfiles')
+    shutil.rmtree('bfilesstore')
+    hgt.hg(['clone', url, 'repo2'], stdout=hgt.ANYTHING)
+    hgt.assertequals(['multi'], [r for r in requests() if r != 'exists'])
+    hgt.assertequals('b1', hgt.readfile('repo2/b1'))
+    hgt.assertequals('b2', hgt.readfile('repo2/dir/b2'))
+    hgt.assertequals('b1', hgt.readfile('repo2/dir/b3'))
+
+    hgt.announce('fall back to one request per bfile')
+    server.start('--no-multi')
+    shutil.rmtree('bfilesstore')
+    hgt.hg(['clone', url, 'repo3'], stdout=hgt.ANYTHING)
+    hgt.assertequals(['get', 'get'], [r for r in requests() if r != 'exists'])
+    hgt.assertequals('b1', hgt.readfile('repo3/b1'))
+    hgt.assertequals('b2', hgt.readfile('repo3/dir/b2'))
+    hgt.assertequals('b1', hgt.readfile('repo3/dir/b3'))
+
+    hgt.announce('bfiles with the same contents are fetched once')
+    shutil.rmtree('bfilesstore')
+    os.chdir('repo3')
+    shutil.rmtree('.hg/kilnbfiles')
+    os.unlink('b1')
+    os.unlink('dir/b3')
+    hgt.hg(['revert', '--all'], stdout=hgt.ANYTHING)
+    hgt.assertequals(['get'], [r for r in requests() if r != 'exists'])
+    hgt.assertequals('b1', hgt.readfile('b1'))
+    hgt.assertequals('b1', hgt.readfile('dir/b3'))
+    hgt.hg(['status'])
+    os.chdir('..')
+finally:
+    server.stop()
@@ -3,6 +3,7 @@
 # Test summary
 
 import os
+import re
 import common
 
 hgt = common.BfilesTester()
@@ -65,3 +66,13 @@ kbfiles to upload:
 b1
 
 ''')
+
+hgt.announce('outgoing sizes count each revision once')
+hgt.writefile('dir/b2', 'b11')
+hgt.hg(['commit', '-m', 'copy b1 contents to b2'])
+hgt.hg(['out', '--bf'],
+        stdout=re.compile(r'kbfiles to upload:\nb1\ndir/b2\n\n$'))
+hgt.hg(['out', '--bf', '--verbose'],
+        stdout=re.compile(r'kbfiles to upload:\nb1\ndir/b2\ntotal: 3 bytes\n\n$'))
+hgt.hg(['summary', '--bf', '--verbose'],
+        stdout=re.compile(r'kbfiles: 2 to upload \(3 bytes\)\n$'))
@@ -161,3 +161,26 @@ Getting changed bfiles
 3 big files updated, 0 removed
 ''')
 common.checkrepos(hgt, 'repo1', 'repo2', [0, 1, 2, 3])
+
+if not windows:
+    hgt.announce('hard linked bfiles keep the mode of the cache')
+    hgt.updaterc({'kilnbfiles': [('wcopy', 'hardlink')]})
+    os.mkdir('repo3')
+    os.chdir('repo3')
+    hgt.hg(['init'])
+    hgt.writefile('e1', 'same')
+    hgt.writefile('p1', 'same')
+    os.chmod('e1', 0755)
+    os.chmod('p1', 0644)
+    hgt.hg(['add', '--bf', 'e1', 'p1'])
+    hgt.hg(['commit', '-m', 'same contents, different modes'])
+    cached = os.path.join('..', 'bfilesstore', common.sha1('p1'))
+    cachedmode = os.stat(cached).st_mode & mask
+    hgt.hg(['update', 'null'], stdout=hgt.ANYTHING)
+    hgt.hg(['update'], stdout=hgt.ANYTHING)
+    hgt.asserttrue(os.stat('e1').st_mode & mask == 0755, 'permissions dont match')
+    hgt.asserttrue(os.stat('p1').st_mode & mask == 0644, 'permissions dont match')
+    hgt.asserttrue(os.stat(cached).st_mode & mask == cachedmode,
+                   'cached object mode changed')
+    hgt.hg(['status'])
+    os.chdir('..')
@@ -3,6 +3,8 @@
 # Test push pull
 
 import os
+import re
+import shutil
 import common
 
 hgt = common.BfilesTester()
@@ -350,3 +352,27 @@ Getting changed bfiles
 ''')
 os.chdir('..')
 common.checkrepos(hgt, 'repo1', 'repo2', [0, 3, 4, 5, 8, 11, 14, 17])
+
+hgt.announce('push to a local repository links bfiles into its cache')
+hgt.hg(['init', 'repo5'])
+os.chdir('repo1')
+hgt.hg(['push', '../repo5'], stdout=hgt.ANYTHING)
+for standin in hgt.walk('.kbf'):
+    hash = hgt.readfile(os.path.join('.kbf', standin))[:40]
+    hgt.assertfile(os.path.join('..', 'repo5', '.hg', 'kilnbfiles', hash))
+os.chdir('..')
+
+hgt.announce('clone and verify from the cache of a local repository')
+shutil.rmtree('bfilesstore')
+hgt.hg(['clone', 'repo5', 'repo6'], stdout=hgt.ANYTHING)
+hgt.asserttrue(common.checkdirs('repo1', 'repo6'), 'repos dont match')
+os.chdir('repo6')
+hgt.hg(['verify', '--bf'], stdout=hgt.ANYTHING)
+
+hgt.announce('verify reports bfiles missing from a local store')
+hash = common.sha1('b1')
+os.unlink(os.path.join('..', 'repo5', '.hg', 'kilnbfiles', hash))
+os.unlink(os.path.join('..', 'bfilesstore', hash))
+hgt.hg(['verify', '--bf'], status=1, stdout=hgt.ANYTHING,
+        stderr=re.compile(r'b1 missing\n  \(%s\)\n' % hash))
+os.chdir('..')
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+#
+# Test rebuilding the bfiles dirstate
+
+import os
+import common
+
+hgt = common.BfilesTester()
+
+hgt.updaterc({'kilnbfiles': [('workers', '2')]})
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('n1', 'n1')
+hgt.writefile('b1', 'b1')
+hgt.writefile('dir/b2', 'b2')
+hgt.writefile('dir/b3', 'b3')
+hgt.hg(['add', 'n1'])
+hgt.hg(['add', '--bf', 'b1', 'dir/b2', 'dir/b3'])
+hgt.hg(['commit', '-m', 'add files'])
+
+hgt.announce('rebuild after removing dirstate')
+hgt.writefile('b1', 'b11')
+hgt.writefile('dir/b2', 'b2')
+os.unlink('dir/b3')
+os.unlink(os.path.join('.hg', 'kilnbfiles', 'dirstate'))
+hgt.hg(['status'],
+        stdout='''M b1
+! dir/b3
+''')
+hgt.assertfile(os.path.join('.hg', 'kilnbfiles', 'dirstate'))
+hgt.assertfilegone(os.path.join('.hg', 'kilnbfiles', 'rebuild'))
+
+hgt.announce('explicit rebuild')
+hgt.hg(['kbfrebuild'])
+hgt.hg(['status'],
+        stdout='''M b1
+! dir/b3
+''')
+hgt.hg(['revert', '--all'],
+        stdout='''reverting .kbf/b1
+''')
+hgt.hg(['kbfrebuild'])
+hgt.hg(['status'])
+
+hgt.announce('resume from checkpoint')
+# A checkpoint entry that matches the file's size and mtime is trusted
+# instead of rehashing the file.
+st = os.stat('b1')
+hgt.writefile(os.path.join('.hg', 'kilnbfiles', 'rebuild'),
+              '%s %d %d b1\n' % ('0' * 40, st.st_size, int(st.st_mtime)))
+hgt.hg(['kbfrebuild'])
+hgt.hg(['status'],
+        stdout='''M b1
+''')
+hgt.assertfilegone(os.path.join('.hg', 'kilnbfiles', 'rebuild'))
+hgt.hg(['kbfrebuild'])
+hgt.hg(['status'])
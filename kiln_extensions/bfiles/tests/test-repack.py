@@ -0,0 +1,81 @@
+#!/usr/bin/python
+#
+# Test packing small bfiles in the caches
+
+import os
+import sys
+import hashlib
+import common
+
+hgt = common.BfilesTester()
+
+def loose(cachedir):
+    return sorted([name for name in os.listdir(cachedir) if len(name) == 40])
+
+hgt.updaterc()
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('b1', 'b1')
+hgt.writefile('dir/b2', 'b2')
+hgt.writefile('big', 'x' * 2000)
+hgt.hg(['add', '--bf', 'b1', 'dir/b2', 'big'])
+hgt.hg(['commit', '-m', 'add bfiles'])
+hgt.writefile('b1', 'b1 changed')
+hgt.hg(['commit', '-m', 'change b1'])
+bighash = common.sha1('big')
+os.chdir('..')
+
+hgt.announce('repack')
+os.chdir('repo1')
+hgt.hg(['kbfrepack', '--max-size', '1000'], stdout=hgt.ANYTHING)
+hgt.assertequals([bighash], loose(os.path.join('.hg', 'kilnbfiles')))
+hgt.assertequals([bighash], loose(os.path.join('..', 'bfilesstore')))
+
+hgt.announce('update from packs')
+hgt.hg(['update', '0'],
+        stdout='''1 files updated, 0 files merged, 0 files removed, 0 files unresolved
+Getting changed bfiles
+1 big files updated, 0 removed
+''')
+hgt.assertequals('b1', hgt.readfile('b1'))
+hgt.hg(['verify', '--bf'], stdout=hgt.ANYTHING)
+os.chdir('..')
+
+hgt.announce('clone from packs')
+hgt.hg(['clone', 'repo1', 'repo2'],
+        stdout='''updating to branch default
+3 files updated, 0 files merged, 0 files removed, 0 files unresolved
+Getting changed bfiles
+3 big files updated, 0 removed
+''')
+hgt.assertequals('b1', hgt.readfile('repo2/b1'))
+hgt.assertequals('b2', hgt.readfile('repo2/dir/b2'))
+hgt.assertequals('x' * 2000, hgt.readfile('repo2/big'))
+
+hgt.announce('repack again merges packs')
+os.chdir('repo1')
+hgt.writefile('b3', 'b3')
+hgt.hg(['add', '--bf', 'b3'])
+hgt.hg(['commit', '-m', 'add b3'])
+hgt.hg(['kbfrepack', '--max-size', '1000'], stdout=hgt.ANYTHING)
+packs = [name for name in os.listdir(os.path.join('..', 'bfilesstore', '.packs'))
+         if name.endswith('.pack')]
+hgt.assertequals(1, len(packs))
+hgt.hg(['kbfrepack', '--max-size', '1000'], stdout=hgt.ANYTHING)
+hgt.hg(['verify', '--bf', '--bfa', '--bfc'], stdout=hgt.ANYTHING)
+
+hgt.announce('readers follow an object out of a removed pack')
+sys.path.insert(0, hgt.tjoin('..'))
+from kbfiles import bfutil
+cachedir = os.path.join('..', 'bfilesstore')
+oldpath = bfutil.find_in_packs(cachedir, hashlib.sha1('b3').hexdigest())
+hgt.asserttrue(oldpath is not None, 'b3 not packed')
+hgt.writefile('b4', 'b4')
+hgt.hg(['add', '--bf', 'b4'])
+hgt.hg(['commit', '-m', 'add b4'])
+hgt.hg(['kbfrepack', '--max-size', '1000'], stdout=hgt.ANYTHING)
+hgt.assertfilegone(os.path.dirname(oldpath))
+hgt.assertequals(2, bfutil.cached_object_size(oldpath))
+hgt.assertequals('b3', ''.join(bfutil.cachedstream(oldpath)))
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+#
+# Test commands that find many cached bfiles at once, which read the
+# cache directories instead of looking for each bfile separately
+
+import os
+import re
+import hashlib
+import common
+
+hgt = common.BfilesTester()
+
+count = 40
+names = ['b%02d' % i for i in xrange(count)]
+
+hgt.updaterc()
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+for name in names:
+    hgt.writefile(name, name)
+hgt.hg(['add', '--bf'] + names)
+hgt.hg(['commit', '-m', 'add bfiles'])
+os.chdir('..')
+
+hgt.announce('update')
+hgt.hg(['clone', 'repo1', 'repo2'],
+        stdout='''updating to branch default
+%d files updated, 0 files merged, 0 files removed, 0 files unresolved
+Getting changed bfiles
+%d big files updated, 0 removed
+''' % (count, count))
+for name in names:
+    hgt.assertequals(name, hgt.readfile(os.path.join('repo2', name)))
+
+hgt.announce('revert')
+os.chdir('repo2')
+for name in names:
+    hgt.writefile(name, 'changed')
+hgt.hg(['revert', '--all', '--no-backup'], stdout=hgt.ANYTHING)
+for name in names:
+    hgt.assertequals(name, hgt.readfile(name))
+
+hgt.announce('say where each bfile was found')
+hgt.writefile('b00', 'changed')
+hgt.hg(['revert', '--verbose', '--no-backup', 'b00'],
+        stdout=re.compile(r'Found %s in cache\n' % hashlib.sha1('b00').hexdigest()))
+hgt.assertequals('b00', hgt.readfile('b00'))
+
+hgt.announce('archive from packs')
+hgt.hg(['kbfrepack'], stdout=hgt.ANYTHING)
+hgt.hg(['archive', '../archive'])
+for name in names:
+    hgt.assertequals(name, hgt.readfile(os.path.join('..', 'archive', name)))
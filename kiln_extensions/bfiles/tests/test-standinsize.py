@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#
+# Test standins that record the size of their bfile, and their
+# coexistence with standins that only hold the hash
+
+import os
+import hashlib
+import common
+
+hgt = common.BfilesTester()
+
+hgt.updaterc()
+hgt.announce('setup with hash-only standins')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('b1', 'b1')
+hgt.writefile('b2', 'b2')
+hgt.hg(['add', '--bf', 'b1', 'b2'])
+hgt.hg(['commit', '-m', 'add bfiles'])
+hgt.assertequals(common.sha1('b1') + '\n', hgt.readfile('.kbf/b1'))
+
+hgt.announce('standins with sizes')
+hgt.updaterc({'kilnbfiles': [('standinsizes', 'true')]})
+hgt.writefile('b1', 'b1 changed')
+hgt.writefile('b3', 'b3')
+hgt.hg(['add', '--bf', 'b3'])
+hgt.hg(['commit', '-m', 'change b1, add b3'])
+hgt.assertequals('%s 10\n' % common.sha1('b1'), hgt.readfile('.kbf/b1'))
+hgt.assertequals('%s 2\n' % common.sha1('b3'), hgt.readfile('.kbf/b3'))
+# unchanged bfiles keep their old standins
+hgt.assertequals(common.sha1('b2') + '\n', hgt.readfile('.kbf/b2'))
+hgt.hg(['status'])
+
+hgt.announce('size change shows as modified')
+hgt.writefile('b1', 'b1 changed again')
+hgt.writefile('b3', 'b4')
+hgt.hg(['status'],
+        stdout='''M b1
+M b3
+''')
+hgt.hg(['revert', '--all', '--no-backup'], stdout=hgt.ANYTHING)
+hgt.hg(['status'])
+os.chdir('..')
+
+hgt.announce('clone and update across both formats')
+hgt.hg(['clone', 'repo1', 'repo2'],
+        stdout='''updating to branch default
+3 files updated, 0 files merged, 0 files removed, 0 files unresolved
+Getting changed bfiles
+3 big files updated, 0 removed
+''')
+os.chdir('repo2')
+hgt.assertequals('b1 changed', hgt.readfile('b1'))
+hgt.assertequals('b3', hgt.readfile('b3'))
+hgt.hg(['update', '0'],
+        stdout='''1 files updated, 0 files merged, 1 files removed, 0 files unresolved
+Getting changed bfiles
+1 big files updated, 1 removed
+''')
+hgt.assertequals('b1', hgt.readfile('b1'))
+hgt.assertfilegone('b3')
+os.chdir('..')
+
+hgt.announce('convert records sizes in committed standins')
+hgt.updaterc({'kilnbfiles': [('standinsizes', 'true'), ('size', '10'),
+                             ('patterns', 'glob:**.dat')]})
+os.mkdir('plain')
+os.chdir('plain')
+hgt.hg(['init'])
+hgt.writefile('a.dat', 'a' * 5)
+hgt.writefile('b.dat', 'b' * 7)
+hgt.writefile('normal', 'normal')
+hgt.hg(['add', 'a.dat', 'b.dat', 'normal'])
+hgt.hg(['commit', '-m', 'add files'])
+os.chdir('..')
+hgt.hg(['kbfconvert', 'plain', 'converted'],
+        stdout='initializing destination converted\n')
+os.chdir('converted')
+hgt.hg(['cat', '-r', '0', '.kbf/a.dat'],
+        stdout='%s 5\n' % hashlib.sha1('a' * 5).hexdigest())
+hgt.hg(['cat', '-r', '0', '.kbf/b.dat'],
+        stdout='%s 7\n' % hashlib.sha1('b' * 7).hexdigest())
+hgt.hg(['cat', '-r', '0', 'normal'], stdout='normal')
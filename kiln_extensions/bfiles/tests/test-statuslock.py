@@ -0,0 +1,41 @@
+#!/usr/bin/python
+#
+# Test that status does not wait for the wlock to check bfiles
+
+import os
+import socket
+import common
+
+hgt = common.BfilesTester()
+
+hgt.updaterc({'ui': [('timeout', '1')]})
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('b1', 'b1')
+hgt.writefile('b2', 'b2')
+hgt.hg(['add', '--bf', 'b1', 'b2'])
+hgt.hg(['commit', '-m', 'add bfiles'])
+
+hgt.announce('status while somebody else holds the wlock')
+# Same size, different mtime: status has to hash them.
+os.utime('b1', (0, 0))
+hgt.writefile('b2', 'bb')
+os.utime('b2', (0, 0))
+os.symlink('%s:%d' % (socket.gethostname(), os.getpid()),
+           os.path.join('.hg', 'wlock'))
+hgt.hg(['status'],
+        stdout='''M b2
+''')
+hgt.hg(['status'],
+        stdout='''M b2
+''')
+
+hgt.announce('status once the wlock is free')
+os.unlink(os.path.join('.hg', 'wlock'))
+hgt.hg(['status'],
+        stdout='''M b2
+''')
+hgt.hg(['revert', '--all', '--no-backup'], stdout=hgt.ANYTHING)
+hgt.hg(['status'])
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+#
+# Test kbfsync between two local repositories
+
+import os
+import re
+import common
+
+hgt = common.BfilesTester()
+
+hgt.updaterc()
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('b1', 'b1')
+hgt.writefile('b2', 'b22')
+hgt.hg(['add', '--bf', 'b1', 'b2'])
+hgt.hg(['commit', '-m', 'add bfiles'])
+b1, b2 = common.sha1('b1'), common.sha1('b2')
+os.chdir('..')
+hgt.hg(['clone', '--noupdate', 'repo1', 'repo2'])
+
+hgt.announce('sync to a local repository')
+os.chdir('repo1')
+hgt.hg(['kbfsync', '.', '../repo2'],
+        stdout=re.compile(r'^checking 2 big files in \.\./repo2\n'
+                          r'copying 2 big files to \.\./repo2\n'
+                          r'copied 2 big files \(5 bytes\) in '))
+hgt.asserttrue(os.path.exists('../repo2/.hg/kilnbfiles/' + b1), 'b1 not copied')
+hgt.asserttrue(os.path.exists('../repo2/.hg/kilnbfiles/' + b2), 'b2 not copied')
+hgt.assertequals('b22', hgt.readfile('../repo2/.hg/kilnbfiles/' + b2))
+
+hgt.announce('sync again copies nothing')
+hgt.hg(['kbfsync', '.', '../repo2'],
+        stdout='''checking 2 big files in ../repo2
+no big files to copy
+''')
+
+hgt.announce('sync to something that is not a repository')
+hgt.writefile('../notarepo', '')
+hgt.hg(['kbfsync', '.', '../notarepo'], status=255,
+        stderr='abort: repository ../notarepo not found!\n')
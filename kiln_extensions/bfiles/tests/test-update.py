@@ -184,3 +184,30 @@ Getting changed bfiles
 ''')
 os.chdir('..')
 checkfiles(2)
+
+hgt.announce('update only looks at bfiles that changed')
+os.chdir('..')
+os.mkdir('repo2')
+os.chdir('repo2')
+hgt.hg(['init', '-q'])
+hgt.writefile('b1', 'b1')
+hgt.writefile('b2', 'b2')
+hgt.hg(['add', '--bf', 'b1', 'b2'])
+hgt.hg(['commit', '-m', 'add bfiles'])
+hgt.writefile('b1', 'b11')
+hgt.hg(['commit', '-m', 'change b1'])
+# Record b2 as clean with an mtime well in the past, then change its
+# contents behind the dirstate's back.  An update that rehashed every
+# bfile would notice and restore it; one that only looks at the bfiles
+# whose standins changed leaves it alone.
+os.utime('b2', (1000000000, 1000000000))
+hgt.hg(['status'])
+hgt.writefile('b2', 'x2')
+os.utime('b2', (1000000000, 1000000000))
+hgt.hg(['update', '0'],
+        stdout='''1 files updated, 0 files merged, 0 files removed, 0 files unresolved
+Getting changed bfiles
+1 big files updated, 0 removed
+''')
+hgt.assertequals('b1', hgt.readfile('b1'))
+hgt.assertequals('x2', hgt.readfile('b2'))
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+#
+# Test the background upload queue: commits queue their bfiles, a
+# background kbfupload uploads them, and push waits for what is left
+
+import os
+import time
+import common
+
+hgt = common.BfilesTester()
+
+hgt.updaterc({'kilnbfiles': [('uploadqueue', 'true')]})
+server = hgt.storeserver()
+url = server.url
+
+def puts():
+    return [fields[1] for fields in server.requests() if fields[0] == 'put']
+
+def queued():
+    try:
+        names = os.listdir('.hg/kilnbfiles/uploads')
+    except OSError:
+        return []
+    return sorted([name for name in names if len(name) == 40])
+
+def waitfor(test, msg):
+    for i in xrange(300):
+        if test():
+            return
+        time.sleep(0.1)
+    hgt.asserttrue(False, msg)
+
+def drained():
+    return not queued() and not os.path.exists('.hg/kilnbfiles/upload.lock')
+
+def uploadfailed():
+    log = '.hg/kilnbfiles/upload.log'
+    return os.path.exists(log) and 'could not upload' in hgt.readfile(log)
+
+hgt.announce('setup')
+hgt.hg(['init', 'remote'])
+hgt.writefile('remote/.hg/hgrc', '[web]\npush_ssl = false\nallow_push = *\n')
+server.start()
+try:
+    hgt.hg(['clone', url, 'repo1'], stdout=hgt.ANYTHING)
+    os.chdir('repo1')
+
+    hgt.announce('commit uploads in the background')
+    hgt.writefile('b1', 'b1')
+    hgt.hg(['add', '--bf', 'b1'])
+    hgt.hg(['commit', '-m', 'add b1'])
+    waitfor(drained, 'queue not drained')
+    hgt.assertequals([common.sha1('b1')], puts())
+
+    hgt.announce('push waits for queued uploads')
+    hgt.writefile('b2', 'b2')
+    hgt.hg(['add', '--bf', 'b2'])
+    hgt.hg(['commit', '-m', 'add b2'])
+    hgt.hg(['push'], stdout=hgt.ANYTHING)
+    hgt.assertequals([], queued())
+    waitfor(drained, 'queue not drained')
+    hgt.assertequals([common.sha1('b2')], puts())
+
+    hgt.announce('failed uploads stay queued')
+    server.stop()
+    hgt.writefile('b3', 'b3')
+    hgt.hg(['add', '--bf', 'b3'])
+    hgt.hg(['commit', '-m', 'add b3'])
+    waitfor(uploadfailed, 'upload did not fail')
+    waitfor(lambda: not os.path.exists('.hg/kilnbfiles/upload.lock'),
+            'drainer did not stop')
+    hgt.assertequals([common.sha1('b3')], queued())
+    server.start()
+    hgt.hg(['push'], stdout=hgt.ANYTHING)
+    hgt.assertequals([], queued())
+    hgt.assertequals([common.sha1('b3')], puts())
+finally:
+    server.stop()
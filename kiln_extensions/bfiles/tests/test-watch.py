@@ -0,0 +1,75 @@
+#!/usr/bin/python
+#
+# Test status with the kbfwatch daemon running
+
+import os
+import sys
+import common
+
+if not sys.platform.startswith('linux'):
+    sys.exit(80)
+
+hgt = common.BfilesTester()
+
+hgt.updaterc()
+hgt.announce('setup')
+os.mkdir('repo1')
+os.chdir('repo1')
+hgt.hg(['init'])
+hgt.writefile('n1', 'n1')
+hgt.writefile('b1', 'b1')
+hgt.writefile('dir/b2', 'b2')
+hgt.writefile('dir/sub/b3', 'b3')
+hgt.hg(['add', 'n1'])
+hgt.hg(['add', '--bf', 'b1', 'dir/b2', 'dir/sub/b3'])
+hgt.hg(['commit', '-m', 'add files'])
+
+hgt.announce('changes made before the daemon starts')
+hgt.writefile('b1', 'b11')
+hgt.hg(['kbfwatch', '--daemon', '--pid-file', 'hg.pid'],
+        stdout=hgt.ANYTHING)
+hgt.hg(['status'],
+        stdout='''M b1
+''')
+hgt.hg(['status'],
+        stdout='''M b1
+''')
+
+hgt.announce('changes made while the daemon runs')
+hgt.writefile('dir/b2', 'b22')
+os.unlink('dir/sub/b3')
+hgt.hg(['status'],
+        stdout='''M b1
+M dir/b2
+! dir/sub/b3
+''')
+hgt.hg(['revert', '--all'],
+        stdout=hgt.ANYTHING)
+hgt.hg(['status'])
+
+hgt.announce('journal compacted once clients have synced')
+# The first status records the reverted files as not yet clean, the
+# second as clean, and the third waits for the daemon to catch up.
+hgt.hg(['status'])
+hgt.hg(['status'])
+dirty = hgt.readfile('.hg/kilnbfiles/watch.dirty').splitlines()
+hgt.asserttrue(int(dirty[0].split(' ')[1]) > 0, 'journal not compacted')
+hgt.asserttrue('f dir/b2' not in dirty[1:], 'compacted entry kept')
+
+hgt.announce('directories moved while the daemon runs')
+os.rename('dir', 'dir2')
+hgt.hg(['status'],
+        stdout='''! dir/b2
+! dir/sub/b3
+? dir2/b2
+? dir2/sub/b3
+''')
+os.rename('dir2', 'dir')
+hgt.hg(['status'])
+
+hgt.announce('daemon stopped')
+hgt.hg(['kbfwatch', '--stop'])
+hgt.writefile('b1', 'b12')
+hgt.hg(['status'],
+        stdout='''M b1
+''')